@@ -87,6 +87,17 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared between worker processes so invalidations made by one are seen by all
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
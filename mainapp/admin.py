@@ -1,9 +1,22 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.db.models import Max, Min
 from .models import *
+from .periods import close_periods, reopen_periods
 
-# @admin.register(PCList)
-# class PCListAdmin(admin.ModelAdmin):
-#     list_display = ['date', 'title', 'name', 'case_number', 'diagnosis', 'treatment_1', 'treatment_2', 'treatment_3', 'charge', 'received', 'payment_status', 'payment_type', 'payment_frequency', 'therapist']
+
+@admin.action(description='Close the books through the month of the latest selected visit')
+def close_books(modeladmin, request, queryset):
+    through = queryset.aggregate(d=Max('date'))['d']
+    if not through:
+        modeladmin.message_user(request, 'The selected visits have no date.', messages.ERROR)
+        return
+    try:
+        snapshots = close_periods(modeladmin.model, through, user=request.user)
+    except ValidationError as error:
+        modeladmin.message_user(request, error.messages[0], messages.ERROR)
+        return
+    modeladmin.message_user(request, f'Closed {len(snapshots)} month(s) through {through:%Y-%m}.')
 
 @admin.register(Patient)
 class PatientAdmin(admin.ModelAdmin):
@@ -12,3 +25,56 @@ class PatientAdmin(admin.ModelAdmin):
 @admin.register(DailySheet)
 class DailySheetAdmin(admin.ModelAdmin):
     list_display = ['date', 'name', 'case_number', 'diagnosis', 'charge', 'received', 'payment_status', 'payment_type', 'payment_frequency', 'in_time', 'out_time', 'treatment_1', 'treatment_2', 'treatment_3', 'treatment_4', 'therapist_1', 'therapist_2']
+    actions = [close_books]
+
+@admin.register(PCList)
+class PCListAdmin(admin.ModelAdmin):
+    list_display = ['date', 'name', 'case_number', 'diagnosis', 'charge', 'received', 'payment_status', 'payment_type', 'payment_frequency', 'in_time', 'out_time', 'treatment_1', 'treatment_2', 'treatment_3', 'treatment_4', 'therapist_1']
+    actions = [close_books]
+
+
+@admin.register(PatientBalance)
+class PatientBalanceAdmin(admin.ModelAdmin):
+    list_display = ['patient', 'series', 'total_charge', 'total_received', 'balance', 'visit_count', 'last_visit_date']
+    list_filter = ['series']
+    search_fields = ['patient__name', 'patient__case_number']
+
+
+@admin.register(PeriodSnapshot)
+class PeriodSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['series', 'month', 'charge', 'received', 'opening', 'closing', 'visit_count', 'closed_at', 'closed_by']
+    list_filter = ['series']
+    actions = ['reopen']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # Deleting a month out of the middle would break the chain of openings
+        return False
+
+    @admin.action(description='Reopen the selected months and every later closed month')
+    def reopen(self, request, queryset):
+        for series, model in (('UM', DailySheet), ('PC', PCList)):
+            month = queryset.filter(series=series).aggregate(m=Min('month'))['m']
+            if month:
+                count = reopen_periods(model, month)
+                self.message_user(request, f'{series}: reopened {count} month(s) from {month:%Y-%m}.')
+
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'original_name', 'all_sheets', 'status', 'rows_processed', 'imported', 'updated', 'error_count', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = ['next_row', 'rows_processed', 'imported', 'updated', 'error_count', 'report_name', 'started_at', 'heartbeat_at', 'finished_at', 'summary']
+
+
+@admin.register(StatementJob)
+class StatementJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'series', 'status', 'done', 'total', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['series', 'status']
+    readonly_fields = ['total', 'done', 'archive', 'started_at', 'heartbeat_at', 'finished_at']
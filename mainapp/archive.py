@@ -0,0 +1,177 @@
+"""
+Month-partitioned columnar snapshots of the visit and patient tables.
+
+Each table is written as one file per month (visits by their date,
+patients by created_at) under an archive directory, with a manifest.json
+that records every partition's row count, latest updated_at and SHA-256.
+A partition is rewritten only when its row count or latest updated_at
+differs from the manifest, so a run after a day of data entry touches the
+current month alone. Writes that skip save() (update(), bulk_update())
+must set updated_at themselves, or the archive will not see them. Files
+are Parquet when pyarrow is installed, otherwise gzip CSV written with a
+fixed gzip timestamp, so unchanged data always produces the same checksum.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from importlib.util import find_spec
+
+import pandas as pd
+from django.db.models import Count, Max
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import DailySheet, Patient, PCList
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# Table name in the archive -> (model, field the partitions are taken from)
+ARCHIVE_TABLES = {
+    'daily_sheet': (DailySheet, 'date'),
+    'pc_list': (PCList, 'date'),
+    'patient': (Patient, 'created_at'),
+}
+
+# Rows without a value in the partition field
+UNDATED = 'undated'
+
+ARCHIVE_FORMATS = ['parquet', 'csv.gz']
+
+
+def default_format():
+    return 'parquet' if find_spec('pyarrow') else 'csv.gz'
+
+
+def load_manifest(directory):
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'tables': {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_manifest(directory, manifest):
+    write_atomic(os.path.join(directory, MANIFEST_NAME), lambda path: write_json(path, manifest))
+
+
+def write_json(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+
+
+def write_atomic(path, write):
+    """Call write(temp_path) and move the finished file to `path`"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def partition_versions(model, field):
+    """{month: (row count, latest updated_at)} for every month that has rows"""
+    rows = (
+        model.objects.order_by()
+        .annotate(month=TruncMonth(field))
+        .values('month')
+        .annotate(rows=Count('pk'), updated=Max('updated_at'))
+    )
+    return {
+        (row['month'].strftime('%Y-%m') if row['month'] else UNDATED): (row['rows'], row['updated'].isoformat())
+        for row in rows
+    }
+
+
+def partition_rows(model, field, month):
+    """Queryset of one partition's rows"""
+    if month == UNDATED:
+        return model.objects.filter(**{f'{field}__isnull': True})
+    year, number = map(int, month.split('-'))
+    return model.objects.filter(**{f'{field}__year': year, f'{field}__month': number})
+
+
+def partition_frame(model, rows):
+    columns = [field.attname for field in model._meta.concrete_fields]
+    return pd.DataFrame.from_records(rows.order_by('pk').values_list(*columns).iterator(), columns=columns)
+
+
+def write_partition(df, path, fmt):
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False, compression={'method': 'gzip', 'mtime': 0})
+
+
+def snapshot_table(directory, manifest, name, fmt, full=False):
+    """Bring one table's partitions up to date; returns (written, unchanged, removed) month lists"""
+    model, field = ARCHIVE_TABLES[name]
+    table_dir = os.path.join(directory, name)
+    os.makedirs(table_dir, exist_ok=True)
+    entry = manifest['tables'].setdefault(name, {'partitions': {}})
+    partitions = entry['partitions']
+    if entry.get('format') != fmt:
+        full = True
+    entry['format'] = fmt
+
+    written, unchanged = [], []
+    for month, (count, updated) in sorted(partition_versions(model, field).items()):
+        known = partitions.get(month)
+        path = os.path.join(table_dir, f'month={month}.{fmt}')
+        if not full and known and (known['rows'], known['updated_at']) == (count, updated) and os.path.exists(path):
+            unchanged.append(month)
+            continue
+
+        df = partition_frame(model, partition_rows(model, field, month))
+        write_atomic(path, lambda temp_path: write_partition(df, temp_path, fmt))
+        if known and known['file'] != os.path.basename(path):
+            remove_file(os.path.join(table_dir, known['file']))
+        partitions[month] = {
+            'file': os.path.basename(path),
+            'rows': len(df),
+            'updated_at': updated,
+            'sha256': file_checksum(path),
+            'written_at': timezone.now().isoformat(),
+        }
+        written.append(month)
+
+    current = set(written) | set(unchanged)
+    removed = sorted(month for month in partitions if month not in current)
+    for month in removed:
+        remove_file(os.path.join(table_dir, partitions.pop(month)['file']))
+
+    entry['snapshot_at'] = timezone.now().isoformat()
+    entry['rows'] = sum(partition['rows'] for partition in partitions.values())
+    return written, unchanged, removed
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def verify_archive(directory):
+    """(table, month, problem) for every partition whose file is missing or fails its checksum"""
+    problems = []
+    for name, entry in sorted(load_manifest(directory)['tables'].items()):
+        for month, partition in sorted(entry['partitions'].items()):
+            path = os.path.join(directory, name, partition['file'])
+            if not os.path.exists(path):
+                problems.append((name, month, 'file is missing'))
+            elif file_checksum(path) != partition['sha256']:
+                problems.append((name, month, 'checksum does not match'))
+    return problems
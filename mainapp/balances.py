@@ -0,0 +1,103 @@
+"""
+Balance engine for the accounts screens.
+
+A patient's balance is Sum(received) - Sum(charge) over their visits, so a
+negative balance is money still pending and a positive one is an advance.
+Balances are kept per patient and series in PatientBalance: DailySheet rows
+feed the UM series and PCList rows the PC series. Writes refresh only the
+patients they touch, so reading a balance is a single indexed row.
+"""
+from decimal import Decimal
+
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, DecimalField, Max, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import DailySheet, PatientBalance, PCList
+
+
+SERIES = {
+    DailySheet: 'UM',
+    PCList: 'PC',
+}
+
+SORT_FIELDS = {
+    'name': ('patient__name', 'patient__case_number'),
+    'case_number': ('patient__case_number',),
+}
+
+BALANCES_PER_PAGE = 50
+
+# Keeps `patient_id IN (...)` well below SQLite's bound-parameter limit
+REFRESH_CHUNK_SIZE = 500
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+ZERO = Value(Decimal('0'), output_field=MONEY)
+
+BALANCE_FIELDS = ['total_charge', 'total_received', 'balance', 'visit_count', 'last_visit_date', 'updated_at']
+
+
+def refresh_balances(model, patient_ids):
+    """Recompute the PatientBalance rows of the given patients from one visit table"""
+    patient_ids = sorted({pk for pk in patient_ids if pk})
+    series = SERIES[model]
+
+    with transaction.atomic():
+        for start in range(0, len(patient_ids), REFRESH_CHUNK_SIZE):
+            chunk = patient_ids[start:start + REFRESH_CHUNK_SIZE]
+            totals = model.objects.filter(patient_id__in=chunk).values('patient_id').annotate(
+                total_charge=Coalesce(Sum('charge'), ZERO, output_field=MONEY),
+                total_received=Coalesce(Sum('received'), ZERO, output_field=MONEY),
+                visit_count=Count('id'),
+                last_visit_date=Max('date'),
+            ).order_by()
+
+            rows = [
+                PatientBalance(
+                    patient_id=t['patient_id'],
+                    series=series,
+                    total_charge=t['total_charge'],
+                    total_received=t['total_received'],
+                    balance=t['total_received'] - t['total_charge'],
+                    visit_count=t['visit_count'],
+                    last_visit_date=t['last_visit_date'],
+                )
+                for t in totals
+            ]
+            PatientBalance.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['patient', 'series'],
+                update_fields=BALANCE_FIELDS,
+            )
+
+            # Patients whose last visit in this series went away
+            seen = {row.patient_id for row in rows}
+            stale = [pk for pk in chunk if pk not in seen]
+            if stale:
+                PatientBalance.objects.filter(series=series, patient_id__in=stale).delete()
+
+
+def patient_balance(patient, model):
+    """The stored balance of one patient for one visit table (0 if they have no visits)"""
+    row = PatientBalance.objects.filter(patient=patient, series=SERIES[model]).values_list('balance', flat=True).first()
+    return row if row is not None else Decimal('0')
+
+
+def pending_patients(model, sort='amount'):
+    """Balance rows of patients who owe money; `pending` is the owed amount"""
+    queryset = PatientBalance.objects.filter(series=SERIES[model], balance__lt=0).select_related('patient')
+    return queryset.order_by(*SORT_FIELDS.get(sort, ('balance', 'patient__name')))
+
+
+def advance_patients(model, sort='amount'):
+    """Balance rows of patients who paid ahead; `advance` is the surplus"""
+    queryset = PatientBalance.objects.filter(series=SERIES[model], balance__gt=0).select_related('patient')
+    return queryset.order_by(*SORT_FIELDS.get(sort, ('-balance', 'patient__name')))
+
+
+def paginate_balances(request, queryset, per_page=BALANCES_PER_PAGE):
+    """Return the requested page; costs one COUNT and one page query"""
+    paginator = Paginator(queryset, per_page)
+    return paginator.get_page(request.GET.get('page'))
@@ -0,0 +1,156 @@
+"""
+Batch imports: a zip of workbooks or CSV files, or one workbook with a tab per month.
+
+Each sheet is parsed and validated in a pool of worker processes, since
+that part is CPU-bound pandas/openpyxl work. The parent process does every
+database write as the sheets come back, all inside one transaction, so a
+batch is imported completely or not at all. The outcome includes a summary
+of rows and timings per sheet.
+"""
+import io
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import openpyxl
+from django.conf import settings
+from django.db import transaction
+
+from .balances import SERIES
+from .importers import BULK_BATCH_SIZE, ImportFileError, ImportResult, build_visits, link_patients, sniff_format
+from .reports import closed_through
+from .sheet_worker import init_worker, parse_sheet
+from .signals import visits_changed
+
+
+BATCH_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# Files inside a zip that are imported; anything else (readme, images) is ignored
+ARCHIVE_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.gz')
+
+
+class BatchCancelled(Exception):
+    pass
+
+
+def is_archive(file):
+    """True for a zip of files, as opposed to an .xlsx workbook (which is a zip too)"""
+    file.seek(0)
+    if not zipfile.is_zipfile(file):
+        file.seek(0)
+        return False
+    file.seek(0)
+    with zipfile.ZipFile(file) as archive:
+        names = archive.namelist()
+    file.seek(0)
+    return '[Content_Types].xml' not in names
+
+
+def workbook_sheets(file):
+    wb = openpyxl.load_workbook(file, read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+
+def list_sheets(path):
+    """(zip member, sheet name) of every sheet in an upload; either is None where it does not apply"""
+    with open(path, 'rb') as file:
+        if not is_archive(file):
+            if sniff_format(file) == 'xlsx':
+                return [(None, name) for name in workbook_sheets(file)]
+            return [(None, None)]
+
+        sheets = []
+        with zipfile.ZipFile(file) as archive:
+            for member in sorted(archive.namelist()):
+                name = os.path.basename(member)
+                if member.startswith('__MACOSX/') or not name or name.startswith('.'):
+                    continue
+                if not name.lower().endswith(ARCHIVE_EXTENSIONS):
+                    continue
+                data = io.BytesIO(archive.read(member))
+                if sniff_format(data) == 'xlsx':
+                    sheets.extend((member, sheet) for sheet in workbook_sheets(data))
+                else:
+                    sheets.append((member, None))
+        return sheets
+
+
+def sheet_label(member, sheet, default):
+    return ' / '.join(part for part in (member, sheet) if part) or default
+
+
+def run_batch(path, model, name, cancelled=lambda: False):
+    """Import every sheet of the upload at `path` into `model`
+
+    `cancelled` is polled between sheets; when it returns True the whole
+    batch is rolled back and BatchCancelled is raised. Returns the
+    ImportResult and a summary dict with totals and one entry per sheet.
+    """
+    started = time.perf_counter()
+    units = list_sheets(path)
+    if not units:
+        raise ImportFileError('The zip file contains no .xlsx, .xls or .csv files')
+
+    closed = closed_through(SERIES[model])
+    result = ImportResult()
+    sheets = []
+    patient_ids = set()
+    workers = min(BATCH_WORKERS, len(units))
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(settings.SETTINGS_MODULE,),
+    )
+    try:
+        futures = {
+            pool.submit(parse_sheet, path, member, sheet, model._meta.label, closed): sheet_label(member, sheet, name)
+            for member, sheet in units
+        }
+        with transaction.atomic():
+            for future in as_completed(futures):
+                label = futures[future]
+                parsed = future.result()
+                if cancelled():
+                    raise BatchCancelled
+
+                writing = time.perf_counter()
+                imported = 0
+                if parsed['records'] is not None:
+                    visits = model.objects.bulk_create(
+                        build_visits(model, link_patients(parsed['records'])), batch_size=BULK_BATCH_SIZE,
+                    )
+                    patient_ids.update(visit.patient_id_id for visit in visits)
+                    imported = len(visits)
+                    errors = parsed['errors']
+                    result.add_errors(errors.assign(sheet=label)[['sheet', *errors.columns]])
+                result.imported += imported
+
+                sheets.append({
+                    'sheet': label,
+                    'rows': parsed['rows'],
+                    'imported': imported,
+                    'errors': 0 if parsed['errors'] is None else len(parsed['errors']),
+                    'message': parsed['message'],
+                    'parse_seconds': round(parsed['seconds'], 3),
+                    'write_seconds': round(time.perf_counter() - writing, 3),
+                    'worker': parsed['pid'],
+                })
+            visits_changed(model, patient_ids)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    sheets.sort(key=lambda entry: entry['sheet'])
+    return result, {
+        'workers': workers,
+        'rows': sum(entry['rows'] for entry in sheets),
+        'wall_seconds': round(time.perf_counter() - started, 3),
+        'parse_seconds': round(sum(entry['parse_seconds'] for entry in sheets), 3),
+        'write_seconds': round(sum(entry['write_seconds'] for entry in sheets), 3),
+        'sheets': sheets,
+    }
@@ -0,0 +1,100 @@
+"""
+Structured case numbers.
+
+A case number is a series (UM, PC) followed by a number, e.g. UM1204 or
+PC-077. Patient, DailySheet and PCList keep the parts in the indexed
+case_series, case_seq and case_seq_length columns, set on save() and by
+the importers, so case-number lookups use the (case_series, case_seq,
+case_seq_length) index instead of a LIKE scan. The length is the number of
+digits as written, so UM12 and UM0012 stay apart.
+
+Lookups understood by case_number_query():
+  =UM1204         exactly that case
+  UM              every case of the series
+  UM12            UM12, UM120-UM129, UM1200-UM1299, ... (prefix of the digits)
+  UM1200-UM1300   a range of numbers ("UM1200-1300" and ".." work too)
+
+Terms that are not one of these, or whose letters are not a known series,
+are left to the substring search.
+"""
+import re
+
+from django.db.models import Q
+
+
+CASE_SERIES = ('UM', 'PC')
+
+# Series letters, an optional separator, then the number; anything after it is ignored
+CASE_NUMBER_PATTERN = r'^\s*([A-Za-z]*)[\s\-/.]*(\d*)'
+
+# Longest number a lookup is expanded to; longer terms are left to the substring search
+MAX_SEQ_DIGITS = 9
+
+EXACT_RE = re.compile(r'^\s*=\s*([A-Za-z]+)[\s\-/.]*(\d+)\s*$')
+RANGE_RE = re.compile(
+    r'^\s*([A-Za-z]+)[\s\-/.]*(\d+)\s*(?:-|–|—|\.\.|to)\s*(?:([A-Za-z]+)[\s\-/.]*)?(\d+)\s*$',
+    re.IGNORECASE,
+)
+PREFIX_RE = re.compile(r'^\s*([A-Za-z]+)[\s\-/.]*(\d*)\s*$')
+
+
+def split_case_number(value):
+    """
+    (series, number, digits) of a case number; the series is upper-cased,
+    digits is how many digits the number is written with, and both are None
+    if there is no number
+    """
+    series, digits = re.match(CASE_NUMBER_PATTERN, value or '').groups()
+    if not digits:
+        return series.upper(), None, None
+    return series.upper(), int(digits), len(digits)
+
+
+def has_case_series(case_number):
+    """True if `case_number` starts with one of CASE_SERIES, in capitals"""
+    return case_number.startswith(CASE_SERIES)
+
+
+def prefix_ranges(digits):
+    """(length, low, high) of the numbers whose digits start with `digits`, one per length"""
+    number = int(digits)
+    ranges = []
+    for extra in range(MAX_SEQ_DIGITS - len(digits) + 1):
+        scale = 10 ** extra
+        ranges.append((len(digits) + extra, number * scale, (number + 1) * scale - 1))
+    return ranges
+
+
+def case_number_query(term):
+    """Q object for a case-number lookup on the structured columns, or None if `term` is not one"""
+    match = EXACT_RE.match(term)
+    if match:
+        series, digits = match.groups()
+        if series.upper() not in CASE_SERIES or len(digits) > MAX_SEQ_DIGITS:
+            return None
+        return Q(case_series=series.upper(), case_seq=int(digits), case_seq_length=len(digits))
+
+    match = RANGE_RE.match(term)
+    if match:
+        series, low, other, high = match.groups()
+        if series.upper() not in CASE_SERIES or (other and other.upper() != series.upper()):
+            return None
+        if max(len(low), len(high)) > MAX_SEQ_DIGITS:
+            return None
+        low, high = sorted((int(low), int(high)))
+        return Q(case_series=series.upper(), case_seq__range=(low, high))
+
+    match = PREFIX_RE.match(term)
+    if match:
+        series, digits = match.groups()
+        if series.upper() not in CASE_SERIES or len(digits) > MAX_SEQ_DIGITS:
+            return None
+        if not digits:
+            return Q(case_series=series.upper())
+        # One (series, range, length) term per length, so each is an index range seek
+        condition = Q()
+        for length, low, high in prefix_ranges(digits):
+            condition |= Q(case_series=series.upper(), case_seq__range=(low, high), case_seq_length=length)
+        # An empty Q() would match every row
+        return condition if condition else None
+    return None
@@ -0,0 +1,140 @@
+"""
+Cached counters for the landing dashboard.
+
+Counts live in the cache, one key per counter. Daily counters are namespaced
+by the local (Asia/Kolkata) date and expire after midnight, so a new day
+starts from fresh keys. Model signals bump the counters as rows change.
+Bulk writes drop them instead, and the next read or the reconcile_counters
+command recomputes them from the database. That also corrects any drift from
+the non-atomic cache backends.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import DailySheet, Patient, PCList
+
+
+TOTAL_COUNTERS = ['patients_total']
+DAILY_COUNTERS = ['patients_today', 'sheets_today', 'pc_lists_today', 'in_progress_today', 'revenue_today']
+
+# Which daily counter counts the visits of each table
+VISIT_COUNTERS = {
+    DailySheet: 'sheets_today',
+    PCList: 'pc_lists_today',
+}
+
+
+def counter_key(name, day=None):
+    if name in TOTAL_COUNTERS:
+        return f'counters:{name}'
+    return f'counters:{day or timezone.localdate()}:{name}'
+
+
+def day_start(day):
+    """Local midnight at the start of `day`; created_at ranges from it can use an index, __date cannot"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def seconds_until_midnight():
+    """Lifetime of a daily counter: until the next local midnight, plus a minute of slack"""
+    now = timezone.localtime()
+    midnight = day_start(now.date() + timedelta(days=1))
+    return int((midnight - now).total_seconds()) + 60
+
+
+def to_paise(amount):
+    # cache.incr() only handles integers, so revenue is kept in paise
+    return int((amount or Decimal('0')) * 100)
+
+
+def compute_counters(day=None):
+    """Recompute every counter from the database"""
+    day = day or timezone.localdate()
+    counts = {
+        'patients_total': Patient.objects.count(),
+        'patients_today': Patient.objects.filter(
+            created_at__gte=day_start(day), created_at__lt=day_start(day + timedelta(days=1)),
+        ).count(),
+        'in_progress_today': 0,
+        'revenue_today': 0,
+    }
+    in_progress = Q(in_time__isnull=False, out_time__isnull=True)
+    for model, name in VISIT_COUNTERS.items():
+        totals = model.objects.filter(date=day).aggregate(
+            visits=Count('id'),
+            in_progress=Count('id', filter=in_progress),
+            revenue=Sum('received'),
+        )
+        counts[name] = totals['visits']
+        counts['in_progress_today'] += totals['in_progress']
+        counts['revenue_today'] += to_paise(totals['revenue'])
+    return counts
+
+
+def reconcile_counters(day=None):
+    """Overwrite the cached counters with fresh database counts and return them"""
+    day = day or timezone.localdate()
+    counts = compute_counters(day)
+    cache.set_many({counter_key(n, day): counts[n] for n in TOTAL_COUNTERS}, counter_timeout(TOTAL_COUNTERS[0]))
+    cache.set_many({counter_key(n, day): counts[n] for n in DAILY_COUNTERS}, counter_timeout(DAILY_COUNTERS[0]))
+    return counts
+
+
+def dashboard_counters():
+    """Current counters for the dashboard; reads only the cache once they are primed"""
+    day = timezone.localdate()
+    names = TOTAL_COUNTERS + DAILY_COUNTERS
+    keys = {counter_key(name, day): name for name in names}
+    cached = cache.get_many(list(keys))
+    if len(cached) < len(keys):
+        counts = reconcile_counters(day)
+    else:
+        counts = {keys[key]: value for key, value in cached.items()}
+    counts['revenue_today'] = Decimal(counts['revenue_today']) / 100
+    return counts
+
+
+def counter_timeout(name):
+    return None if name in TOTAL_COUNTERS else seconds_until_midnight()
+
+
+def bump(deltas, day=None):
+    """Apply counter deltas; counters not in the cache are left for the next reconcile"""
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        key = counter_key(name, day)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            continue
+        # Some backends (file, database) reset the expiry on incr()
+        cache.touch(key, counter_timeout(name))
+
+
+def invalidate_counters():
+    """Drop today's counters after writes that bypass the signals"""
+    day = timezone.localdate()
+    cache.delete_many([counter_key(name, day) for name in TOTAL_COUNTERS + DAILY_COUNTERS])
+
+
+def visit_counts(model, date, in_time, out_time, received):
+    """What one visit row contributes to today's counters"""
+    if date != timezone.localdate():
+        return {}
+    return {
+        VISIT_COUNTERS[model]: 1,
+        'in_progress_today': 1 if in_time and not out_time else 0,
+        'revenue_today': to_paise(received),
+    }
+
+
+def visit_changed(model, before, after):
+    """Bump the counters by the difference between two visit states (either may be None)"""
+    before = visit_counts(model, *before) if before else {}
+    after = visit_counts(model, *after) if after else {}
+    bump({name: after.get(name, 0) - before.get(name, 0) for name in set(before) | set(after)})
@@ -0,0 +1,405 @@
+"""
+Streaming spreadsheet exports.
+
+XlsxWriter writes a single-sheet .xlsx in one pass over the rows: each row
+is rendered to XML into a spooled temp file while the column widths are
+tracked, and the workbook zip is assembled at the end with the widths in
+front of the rows, where Excel expects them. Nothing per cell is kept in
+memory, unlike an openpyxl Workbook (whose write-only mode needs the widths
+before the first row).
+
+Finished files are cached on disk, keyed by the export's query and a
+version of its rows (count and latest updated_at), and served again with
+an ETag until the rows change.
+"""
+import csv
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+
+from .ledger import Echo
+
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_CHUNK_SIZE = 2000
+SPOOL_BYTES = 10 * 1024 * 1024
+MAX_COLUMN_WIDTH = 50
+
+# Finished exports are kept here (under MEDIA_ROOT), least recently used deleted first
+EXPORT_CACHE_DIR = 'export_cache'
+EXPORT_CACHE_BYTES = 500 * 1024 * 1024
+
+# Bump when the layout of the exported files changes, so cached copies are not served
+EXPORT_FORMAT_VERSION = 1
+
+# Characters XML 1.0 does not allow, which openpyxl would reject as well
+ILLEGAL_CHARACTERS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+EXCEL_EPOCH = date(1899, 12, 30)
+
+# Cell styles in STYLES_XML: 0 plain, 1 header, 2 date
+HEADER_STYLE = 1
+DATE_STYLE = 2
+
+CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+
+ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+WORKBOOK_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name={name} sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+WORKBOOK_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+# Same look as the old openpyxl exports: bold white headers on blue, yyyy-mm-dd dates
+STYLES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/></numFmts>'
+    '<fonts count="2">'
+    '<font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><color rgb="FFFFFFFF"/><name val="Calibri"/></font>'
+    '</fonts>'
+    '<fills count="3">'
+    '<fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill>'
+    '<fill><patternFill patternType="solid"><fgColor rgb="FF4472C4"/><bgColor rgb="FF4472C4"/></patternFill></fill>'
+    '</fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="2" borderId="0" xfId="0" applyFont="1" applyFill="1" applyAlignment="1">'
+    '<alignment horizontal="center" vertical="center"/></xf>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+SHEET_HEAD_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+)
+
+
+def column_letter(index):
+    """Excel column name of a 1-based column index"""
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+class XlsxWriter:
+    """One-sheet .xlsx written row by row
+
+    Strings, numbers, dates and times are supported; None and '' leave the
+    cell empty. Call save() once with a binary file object.
+    """
+
+    def __init__(self, headers, sheet_name='Sheet1'):
+        self.sheet_name = sheet_name
+        self.columns = [column_letter(i) for i in range(1, len(headers) + 1)]
+        self.widths = [0] * len(headers)
+        self.rows = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        self.row_count = 0
+        self.append(headers, style=HEADER_STYLE)
+
+    def cell(self, ref, value, style):
+        if isinstance(value, bool):
+            return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>', str(value)
+        if isinstance(value, (int, float, Decimal)):
+            return f'<c r="{ref}"{style}><v>{value}</v></c>', str(value)
+        if isinstance(value, datetime):
+            value = timezone.localtime(value) if timezone.is_aware(value) else value
+            value = value.strftime('%Y-%m-%d %H:%M')
+        elif isinstance(value, date):
+            return f'<c r="{ref}" s="{DATE_STYLE}"><v>{(value - EXCEL_EPOCH).days}</v></c>', value.isoformat()
+        elif isinstance(value, time):
+            value = value.strftime('%H:%M')
+        text = ILLEGAL_CHARACTERS.sub('', str(value))
+        return f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>', text
+
+    def append(self, values, style=None):
+        self.row_count += 1
+        number = self.row_count
+        style = f' s="{style}"' if style else ''
+        cells = []
+        for i, value in enumerate(values):
+            if value is None or value == '':
+                continue
+            xml, text = self.cell(f'{self.columns[i]}{number}', value, style)
+            cells.append(xml)
+            if len(text) > self.widths[i]:
+                self.widths[i] = len(text)
+        self.rows.write(f'<row r="{number}">{"".join(cells)}</row>'.encode())
+
+    def cols_xml(self):
+        cols = ''.join(
+            f'<col min="{i}" max="{i}" width="{min(width + 2, MAX_COLUMN_WIDTH)}" customWidth="1"/>'
+            for i, width in enumerate(self.widths, 1)
+        )
+        return f'<cols>{cols}</cols>'
+
+    def save(self, output):
+        self.rows.seek(0)
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as workbook:
+            workbook.writestr('[Content_Types].xml', CONTENT_TYPES_XML)
+            workbook.writestr('_rels/.rels', ROOT_RELS_XML)
+            workbook.writestr('xl/workbook.xml', WORKBOOK_XML.format(name=quoteattr(self.sheet_name[:31])))
+            workbook.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS_XML)
+            workbook.writestr('xl/styles.xml', STYLES_XML)
+            with workbook.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+                sheet.write(f'{SHEET_HEAD_XML}{self.cols_xml()}<sheetData>'.encode())
+                shutil.copyfileobj(self.rows, sheet)
+                sheet.write(b'</sheetData></worksheet>')
+        self.rows.close()
+
+
+def csv_lines(headers, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def export_cache_dir():
+    path = os.path.join(settings.MEDIA_ROOT, EXPORT_CACHE_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def export_etag(queryset, columns, sheet_name, fmt):
+    """ETag of an export: its query, columns and format plus the row count and latest updated_at of the rows"""
+    version = queryset.order_by().aggregate(rows=Count('pk'), updated=Max('updated_at'))
+    sql, params = queryset.query.sql_with_params()
+    key = repr((EXPORT_FORMAT_VERSION, fmt, sheet_name, [name for _, name, _ in columns], sql, params, version))
+    return '"%s"' % hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def evict_exports():
+    """Delete the least recently used cached exports until the cache fits in EXPORT_CACHE_BYTES"""
+    directory = export_cache_dir()
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.startswith('.'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= EXPORT_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def store_export(path, write):
+    """Call write(file) on a temp file and move the result to `path` once it is complete"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    evict_exports()
+
+
+def caching_lines(lines, path):
+    """Yield the CSV lines while saving them to `path`, so the download still starts at once"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for line in lines:
+                file.write(line.encode())
+                yield line
+        os.replace(temp_path, path)
+    except BaseException:
+        # Includes GeneratorExit when the client goes away mid-download
+        os.remove(temp_path)
+        raise
+    evict_exports()
+
+
+def filter_by_period(queryset, params):
+    """Apply the export page's filter_type (week/month/year/custom range) to a dated queryset"""
+    filter_type = params.get('filter_type', 'all')
+    custom_start = params.get('custom_start')
+    custom_end = params.get('custom_end')
+    today = timezone.localdate()
+
+    if filter_type == 'week':
+        start_date = today - timedelta(days=today.weekday())
+        return queryset.filter(date__range=[start_date, start_date + timedelta(days=6)])
+    if filter_type == 'month':
+        return queryset.filter(date__year=today.year, date__month=today.month)
+    if filter_type == 'year':
+        return queryset.filter(date__year=today.year)
+    if filter_type == 'custom' and custom_start and custom_end:
+        return queryset.filter(date__range=[custom_start, custom_end])
+    return queryset
+
+
+# (header, field, show the choice label instead of the stored value)
+VISIT_EXPORT_COLUMNS = [
+    ('Date', 'date', False),
+    ('Name', 'name', False),
+    ('Case Number', 'case_number', False),
+    ('Diagnosis', 'diagnosis', False),
+    ('Charge', 'charge', False),
+    ('Received', 'received', False),
+    ('Payment Status', 'payment_status', True),
+    ('Payment Type', 'payment_type', True),
+    ('Payment Frequency', 'payment_frequency', True),
+    ('In Time', 'in_time', False),
+    ('Out Time', 'out_time', False),
+    ('Treatment 1', 'treatment_1', False),
+    ('Treatment 2', 'treatment_2', False),
+    ('Treatment 3', 'treatment_3', False),
+    ('Treatment 4', 'treatment_4', False),
+    ('Therapist 1', 'therapist_1', True),
+    ('Therapist 2', 'therapist_2', True),
+]
+
+MONEY_FIELDS = {'charge', 'received'}
+
+
+def export_columns(model, columns):
+    """The columns that exist on `model`, with a value -> label dict for choice columns"""
+    fields = {field.name: field for field in model._meta.get_fields()}
+    return [
+        (header, name, dict(fields[name].flatchoices) if labels else None)
+        for header, name, labels in columns
+        if name in fields
+    ]
+
+
+def export_rows(queryset, columns):
+    """Yield one list of cell values per row, read with values_list() in chunks"""
+    names = [name for _, name, _ in columns]
+    for values in queryset.values_list(*names).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        row = []
+        for (_, name, labels), value in zip(columns, values):
+            if name in MONEY_FIELDS:
+                value = float(value or 0)
+            elif labels is not None and value:
+                value = labels.get(value, value)
+            row.append(value)
+        yield row
+
+
+def export_response(path, fmt, filename):
+    """The cached export at `path` as a download; raises FileNotFoundError if it has been evicted"""
+    # Touch first: if the file is evicted in between, open() fails and nothing is left open
+    os.utime(path)
+    file = open(path, 'rb')
+    content_type = 'text/csv' if fmt == 'csv' else XLSX_CONTENT_TYPE
+    return FileResponse(file, as_attachment=True, filename=f'{filename}.{fmt}', content_type=content_type)
+
+
+def queryset_export(request, queryset, columns, sheet_name, filename, fmt='xlsx'):
+    """.xlsx download of a queryset's `columns`, or streamed CSV with fmt='csv'; filename has no extension
+
+    Exports are cached under MEDIA_ROOT/export_cache by ETag. A repeat
+    request for unchanged rows is served from there, or answered with 304
+    Not Modified when the browser already has it.
+    """
+    fmt = 'csv' if fmt == 'csv' else 'xlsx'
+    columns = export_columns(queryset.model, columns)
+    headers = [header for header, _, _ in columns]
+    etag = export_etag(queryset, columns, sheet_name, fmt)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        path = os.path.join(export_cache_dir(), etag.strip('"') + f'.{fmt}')
+        try:
+            response = export_response(path, fmt, filename)
+        except FileNotFoundError:
+            if fmt == 'csv':
+                lines = caching_lines(csv_lines(headers, export_rows(queryset, columns)), path)
+                response = StreamingHttpResponse(lines, content_type='text/csv')
+                response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+            else:
+                writer = XlsxWriter(headers, sheet_name)
+                for row in export_rows(queryset, columns):
+                    writer.append(row)
+                store_export(path, writer.save)
+                response = export_response(path, fmt, filename)
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def visit_export(request, queryset, sheet_name, prefix, fmt='xlsx'):
+    """Download of DailySheet or PCList rows"""
+    filename = f"{prefix}_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}"
+    return queryset_export(request, queryset, VISIT_EXPORT_COLUMNS, sheet_name, filename, fmt)
+
+
+PATIENT_EXPORT_COLUMNS = [
+    ('Name', 'name', False),
+    ('Case Number', 'case_number', False),
+    ('Age', 'age', False),
+    ('Gender', 'gender', True),
+    ('Chief Complaint', 'chief_complaint', False),
+    ('Reference', 'reference', False),
+    ('Contact', 'contact', False),
+    ('Address', 'address', False),
+]
+
+
+def patient_export(request, queryset, fmt='xlsx'):
+    """Download of Patient rows"""
+    return queryset_export(request, queryset, PATIENT_EXPORT_COLUMNS, 'Patients', 'patients', fmt)
@@ -1,8 +1,11 @@
 
 from django import forms
 from .models import *
+from .case_numbers import has_case_series
+from .periods import PeriodClosedError, check_period_open
 from django.forms import DateInput, DateTimeInput, TimeInput, CheckboxInput, Textarea, TextInput 
-from django.db.models.functions import ExtractYear
+from django.utils import timezone
+from datetime import date
 
 class LoginForm(forms.Form):
     email=forms.CharField()
@@ -64,7 +67,7 @@ class PatientForm(forms.ModelForm):
         """Validate that case number is unique"""
         case_number = self.cleaned_data.get('case_number')
 
-        if case_number and not (case_number.startswith('UM') or case_number.startswith('PC')):
+        if case_number and not has_case_series(case_number):
             raise forms.ValidationError("Case number must start with 'UM' or 'PC'.")
         
         # Check if this is an update (instance exists) or create (new instance)
@@ -80,6 +83,15 @@ class PatientForm(forms.ModelForm):
         return case_number
 
 
+def created_year_choices(model):
+    """Year choices from the first to the last created_at: two index lookups instead of a pass over the table"""
+    created = model.objects.values_list('created_at', flat=True)
+    first = created.order_by('created_at').first()
+    last = created.order_by('-created_at').first()
+    years = range(timezone.localtime(last).year, timezone.localtime(first).year - 1, -1) if first else []
+    return [('', 'All Years')] + [(str(year), str(year)) for year in years]
+
+
 class PatientFilterForm(forms.Form):
     """Form for filtering patient records"""
     case_number = forms.CharField(
@@ -131,26 +143,44 @@ class PatientFilterForm(forms.Form):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Dynamically populate year choices based on existing records
-        from django.db.models.functions import ExtractYear
-        years = Patient.objects.annotate(year=ExtractYear('created_at')).values_list('year', flat=True).distinct().order_by('-year')
-        year_choices = [('', 'All Years')] + [(str(year), str(year)) for year in years if year]
-        self.fields['year'].choices = year_choices
+        self.fields['year'].choices = created_year_choices(Patient)
 
 class UploadFileForm(forms.Form):
-    file = forms.FileField()
+    file = forms.FileField(
+        widget=forms.FileInput(attrs={'class': 'form-control', 'accept': '.xlsx,.xls,.csv,.gz'})
+    )
 
 
 
 class ExcelUploadForm(forms.Form):
     excel_file = forms.FileField(
-        label='Upload Excel File',
-        help_text='Upload an Excel file (.xlsx, .xls)',
-        widget=forms.FileInput(attrs={'class': 'form-control', 'accept': '.xlsx,.xls'})
+        label='Upload Excel or CSV File',
+        help_text='Upload an Excel file (.xlsx, .xls), a CSV file (.csv, .csv.gz) or a .zip of them',
+        widget=forms.FileInput(attrs={'class': 'form-control', 'accept': '.xlsx,.xls,.csv,.gz,.zip'})
+    )
+    all_sheets = forms.BooleanField(
+        required=False,
+        label='Import every sheet',
+        help_text='For a workbook with one tab per month. A .zip is always imported file by file.',
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
     )
 
 
 
-class DailySheetForm(GenericModelForm):
+class OpenPeriodFormMixin:
+    """Reject edits to visits dated inside a closed accounting period"""
+
+    def clean(self):
+        cleaned_data = super().clean()
+        previous_date = self.instance.date if self.instance.pk else None
+        try:
+            check_period_open(self._meta.model, cleaned_data.get('date'), previous_date)
+        except PeriodClosedError as error:
+            raise forms.ValidationError(error.messages)
+        return cleaned_data
+
+
+class DailySheetForm(OpenPeriodFormMixin, GenericModelForm):
     class Meta:
         model = DailySheet
         fields = '__all__'
@@ -186,16 +216,13 @@ class DailySheetFilterForm(forms.Form):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Dynamically populate year choices based on existing records
-        from django.db.models.functions import ExtractYear
-        years = Patient.objects.annotate(year=ExtractYear('created_at')).values_list('year', flat=True).distinct().order_by('-year')
-        year_choices = [('', 'All Years')] + [(str(year), str(year)) for year in years if year]
-        self.fields['year'].choices = year_choices
+        self.fields['year'].choices = created_year_choices(Patient)
 
 
 
 
 
-class PCListForm(forms.ModelForm):
+class PCListForm(OpenPeriodFormMixin, forms.ModelForm):
     class Meta:
         model = PCList
         fields = '__all__'
@@ -234,10 +261,30 @@ class PCListFilterForm(forms.Form):
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        years = PCList.objects.annotate(year=ExtractYear('created_at')).values_list('year', flat=True).distinct().order_by('-year')
-        year_choices = [('', 'All Years')] + [(str(year), str(year)) for year in years if year]
-        self.fields['year'].choices = year_choices
+        self.fields['year'].choices = created_year_choices(PCList)
+
+
+class SummaryRangeForm(forms.Form):
+    """Optional date range for the monthly/yearly summaries"""
+    year = forms.IntegerField(required=False, min_value=1900, max_value=2100, widget=forms.NumberInput(attrs={
+        'class': 'form-control',
+        'placeholder': 'Year'
+    }))
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={
+        'type': 'date',
+        'class': 'form-control'
+    }))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={
+        'type': 'date',
+        'class': 'form-control'
+    }))
 
+    def get_range(self):
+        """Return (start, end); a year takes precedence over explicit dates"""
+        if not self.is_valid():
+            return None, None
+        year = self.cleaned_data.get('year')
+        if year:
+            return date(year, 1, 1), date(year, 12, 31)
+        return self.cleaned_data.get('date_from'), self.cleaned_data.get('date_to')
 
- 
-   
\ No newline at end of file
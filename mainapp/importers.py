@@ -0,0 +1,506 @@
+"""
+Spreadsheet import pipeline for patients, DailySheet and PCList.
+
+Uploads are sniffed by content: .xlsx workbooks are read in read-only
+mode, CSV (plain or gzip-compressed) with pandas' chunked C parser, only
+the columns the importer uses and every cell kept as text. Either way rows
+are handed over in fixed-size chunks, so memory stays flat however long
+the sheet is. Each chunk is
+mapped to model fields column by column with pandas: dates, times, amounts
+and choice labels are parsed for the whole chunk at once and every row is
+validated before anything is written. Valid rows are inserted with batched
+bulk_create, all chunks inside one transaction. Rows that fail are appended
+to a CSV error report instead of one message per row.
+"""
+import gzip
+import os
+import uuid
+from decimal import Decimal
+from functools import lru_cache
+
+import openpyxl
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+
+from .balances import SERIES
+from .case_numbers import CASE_NUMBER_PATTERN
+from .counters import invalidate_counters
+from .models import Patient
+from .reports import closed_through
+from .signals import visits_changed
+
+
+BULK_BATCH_SIZE = 1000
+
+# Spreadsheet rows handed to the mapping logic at a time
+IMPORT_CHUNK_SIZE = 2000
+
+REPORT_DIR = 'import_reports'
+
+# Spreadsheet header -> model field
+VISIT_COLUMNS = {
+    'Date': 'date',
+    'Name': 'name',
+    'Case Number': 'case_number',
+    'Diagnosis': 'diagnosis',
+    'Charge': 'charge',
+    'Received': 'received',
+    'Payment Status': 'payment_status',
+    'Payment Type': 'payment_type',
+    'Payment Frequency': 'payment_frequency',
+    'In Time': 'in_time',
+    'Out Time': 'out_time',
+    'Treatment 1': 'treatment_1',
+    'Treatment 2': 'treatment_2',
+    'Treatment 3': 'treatment_3',
+    'Treatment 4': 'treatment_4',
+    'Therapist 1': 'therapist_1',
+    'Therapist 2': 'therapist_2',
+}
+
+VISIT_HEADERS = {field: header for header, field in VISIT_COLUMNS.items()}
+
+REQUIRED_VISIT_COLUMNS = ['Date', 'Case Number', 'Charge', 'Received']
+
+# Value used when a choice cell is blank or not recognised (None leaves it empty)
+CHOICE_DEFAULTS = {
+    'payment_status': 'not_paid',
+    'payment_type': 'cash',
+    'payment_frequency': 'daily',
+    'therapist_1': 'Basidh',
+    'therapist_2': None,
+}
+
+TEXT_FIELDS = ['name', 'case_number', 'diagnosis']
+TREATMENT_FIELDS = ['treatment_1', 'treatment_2', 'treatment_3', 'treatment_4']
+
+# Patient sheets use snake_case headers after normalization
+PATIENT_FIELDS = ['name', 'age', 'gender', 'chief_complaint', 'reference', 'contact', 'address']
+
+# Columns of a patient sheet the importer reads (after header normalization)
+PATIENT_COLUMNS = ['case_number', 'contact_number'] + PATIENT_FIELDS
+
+# Upper bound on the parameters of one IN (...) lookup
+LOOKUP_BATCH_SIZE = 900
+
+
+class ImportFileError(Exception):
+    """The file as a whole cannot be imported (unreadable, or required columns missing)"""
+
+
+class ImportResult:
+    """Counts of an import plus its error report, filled in chunk by chunk"""
+    preview_limit = 20
+
+    def __init__(self, imported=0, error_count=0, report_name=None):
+        self.imported = imported
+        self.error_count = error_count
+        self.preview = []
+        self.report_name = report_name
+
+    def add_errors(self, errors):
+        """Append rejected rows to the CSV report under MEDIA_ROOT"""
+        if errors.empty:
+            return
+        first = self.report_name is None
+        if first:
+            os.makedirs(os.path.join(settings.MEDIA_ROOT, REPORT_DIR), exist_ok=True)
+            self.report_name = f'{uuid.uuid4().hex}.csv'
+        errors.to_csv(report_path(self.report_name), mode='a', header=first, index=False)
+        self.error_count += len(errors)
+        self.preview.extend(errors.head(self.preview_limit - len(self.preview)).to_dict('records'))
+
+    def error_preview(self):
+        return self.preview
+
+
+def sheet_frame(rows, columns, first_row):
+    """DataFrame of raw sheet rows, indexed by their spreadsheet row number"""
+    width = len(columns)
+    rows = [tuple(row[:width]) + (None,) * (width - len(row)) for row in rows]
+    return pd.DataFrame.from_records(
+        rows, columns=columns, index=pd.RangeIndex(first_row, first_row + len(rows)), coerce_float=True,
+    )
+
+
+def normalize_header(name):
+    return str(name).strip().lower().replace(' ', '_')
+
+
+def visit_column(name):
+    """usecols filter for DailySheet and PCList sheets"""
+    return str(name).strip() in VISIT_COLUMNS
+
+
+def patient_column(name):
+    """usecols filter for patient sheets"""
+    return normalize_header(name) in PATIENT_COLUMNS
+
+
+def sniff_format(file):
+    """'xlsx', 'xls', 'csv.gz' or 'csv', judged by the first bytes of the file"""
+    file.seek(0)
+    head = file.read(8)
+    file.seek(0)
+    if head.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    if head.startswith(b'\xd0\xcf\x11\xe0'):
+        return 'xls'
+    if head.startswith(b'\x1f\x8b'):
+        return 'csv.gz'
+    return 'csv'
+
+
+def read_chunks(file, usecols=None, chunk_size=IMPORT_CHUNK_SIZE, start_row=2, sheet=None):
+    """Yield an uploaded sheet as DataFrames of at most `chunk_size` rows, whatever its format
+
+    Frames are indexed by spreadsheet row number (the header is row 1).
+    `usecols` is a predicate on header names; it is applied while parsing
+    CSV so unused columns are never built. `start_row` skips to a row, for
+    resuming an interrupted import. Workbooks are read from their first
+    sheet unless another `sheet` is named.
+    """
+    fmt = sniff_format(file)
+    if fmt == 'xlsx':
+        yield from read_excel_chunks(file, chunk_size, start_row, sheet)
+    elif fmt == 'xls':
+        # Old binary workbooks cannot be streamed; pandas reads them whole
+        df = pd.read_excel(file, sheet_name=sheet or 0, usecols=usecols)
+        df.index += 2
+        yield df.loc[start_row:]
+    else:
+        yield from read_csv_chunks(file, usecols, chunk_size, start_row, compressed=fmt == 'csv.gz')
+
+
+def read_csv_chunks(file, usecols=None, chunk_size=IMPORT_CHUNK_SIZE, start_row=2, compressed=False):
+    source = gzip.GzipFile(fileobj=file, mode='rb') if compressed else file
+    try:
+        reader = pd.read_csv(
+            source,
+            usecols=usecols,
+            dtype=str,
+            keep_default_na=False,
+            na_values=[''],
+            skip_blank_lines=False,
+            skiprows=range(1, start_row - 1),
+            chunksize=chunk_size,
+            encoding='utf-8-sig',
+            encoding_errors='replace',
+        )
+        with reader:
+            for df in reader:
+                df.index += start_row
+                yield df
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, gzip.BadGzipFile) as error:
+        raise ImportFileError(f'Could not read the CSV file: {error}')
+
+
+def read_excel_chunks(file, chunk_size=IMPORT_CHUNK_SIZE, start_row=2, sheet=None):
+    """Stream one sheet (the first by default) of an .xlsx workbook with openpyxl in read-only mode"""
+    file.seek(0)
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        header = next(ws.iter_rows(max_row=1, values_only=True), None)
+        if header is None:
+            raise ImportFileError('The sheet is empty')
+        columns = [f'Unnamed: {i}' if name is None else str(name) for i, name in enumerate(header)]
+
+        chunk = []
+        first_row = start_row
+        for row in ws.iter_rows(min_row=start_row, values_only=True):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield sheet_frame(chunk, columns, first_row)
+                first_row += len(chunk)
+                chunk = []
+        if chunk or first_row == start_row:
+            yield sheet_frame(chunk, columns, first_row)
+    finally:
+        wb.close()
+
+
+def sheet_row_count(file):
+    """Data rows in an upload, or None when counting would mean decompressing or parsing it"""
+    fmt = sniff_format(file)
+    if fmt == 'xlsx':
+        wb = openpyxl.load_workbook(file, read_only=True)
+        try:
+            max_row = wb.worksheets[0].max_row
+        finally:
+            wb.close()
+        file.seek(0)
+        return max_row - 1 if max_row else None
+    if fmt == 'csv':
+        lines = sum(block.count(b'\n') for block in iter(lambda: file.read(1 << 20), b''))
+        file.seek(0)
+        return max(lines - 1, 0)
+    return None
+
+
+def normalize_labels(series):
+    """Lower-case choice labels so 'Dr. Basidh', 'Partially Paid' and 'Daily Basis' match the model choices"""
+    return (
+        series.astype('string').str.strip().str.lower()
+        .str.replace('_', ' ', regex=False)
+        .str.replace(r'^dr\.?\s*', '', regex=True)
+        .str.replace(r'\s+basis$', '', regex=True)
+    )
+
+
+@lru_cache(maxsize=None)
+def choice_lookup(model, field):
+    """Normalized label or value -> stored value for one choice field"""
+    choices = model._meta.get_field(field).choices
+    values = [value for value, _ in choices]
+    keys = normalize_labels(pd.Series(values + [label for _, label in choices]))
+    return dict(zip(keys, values * 2))
+
+
+def map_labels(series, lookup):
+    """Stored choice value of each cell, or NA; each distinct label is normalized only once"""
+    distinct = pd.Series(series.dropna().unique(), dtype=object)
+    return series.map(dict(zip(distinct, normalize_labels(distinct).map(lookup))))
+
+
+def text_column(series):
+    """Strings with blanks as NA; whole-number cells such as case numbers lose their '.0'"""
+    if pd.api.types.is_float_dtype(series):
+        values = series.dropna()
+        if (values == values.round()).all():
+            series = series.astype('Int64')
+    elif series.dtype == object:
+        series = series.map(lambda value: int(value) if isinstance(value, float) and value.is_integer() else value)
+    text = series.astype('string').str.strip()
+    return text.mask(text == '')
+
+
+# Vectorized date formats tried in turn; whatever is left is parsed day-first element by element
+DATE_FORMATS = ['ISO8601', '%d/%m/%Y', '%d-%m-%Y']
+
+
+def parse_dates(series):
+    parsed = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    for fmt in DATE_FORMATS:
+        retry = parsed.isna() & series.notna()
+        if not retry.any():
+            return parsed
+        parsed[retry] = pd.to_datetime(series[retry], format=fmt, errors='coerce')
+    retry = parsed.isna() & series.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(series[retry].astype(str), dayfirst=True, errors='coerce', format='mixed')
+    return parsed
+
+
+TIME_FORMATS = ['%H:%M:%S', '%H:%M']
+
+
+def parse_times(series):
+    text = text_column(series)
+    parsed = pd.Series(pd.NaT, index=text.index, dtype='datetime64[ns]')
+    for fmt in TIME_FORMATS:
+        retry = parsed.isna() & text.notna()
+        if not retry.any():
+            break
+        parsed[retry] = pd.to_datetime(text[retry], format=fmt, errors='coerce')
+    retry = parsed.isna() & text.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(text[retry], errors='coerce', format='mixed')
+    return parsed.dt.time.where(parsed.notna(), None)
+
+
+def prepare_visits(model, df, closed):
+    """Map raw sheet rows to model fields and validate them
+
+    `closed` is the last day of the closed accounting period (or None); rows
+    dated on or before it are rejected. Returns (records, errors): a DataFrame
+    of valid rows keyed by model field, and a DataFrame of (row, case_number,
+    error) for the rejected ones. Rows are reported by the index of `df`,
+    their spreadsheet row number.
+    """
+    df = df.rename(columns=lambda c: str(c).strip())
+    missing = [column for column in REQUIRED_VISIT_COLUMNS if column not in df.columns]
+    if missing:
+        raise ImportFileError(f"Missing required column(s): {', '.join(missing)}")
+
+    df = df.dropna(how='all')
+    blank = pd.Series(pd.NA, index=df.index, dtype='object')
+    model_fields = {f.name for f in model._meta.fields}
+
+    def column(field):
+        header = VISIT_HEADERS[field]
+        return df[header] if header in df.columns else blank
+
+    frame = pd.DataFrame(index=df.index)
+    for field in TEXT_FIELDS:
+        frame[field] = text_column(column(field))
+
+    for field in TREATMENT_FIELDS:
+        text = text_column(column(field))
+        # Known treatments are stored by value; anything else is kept as written
+        frame[field] = map_labels(text, choice_lookup(model, field)).fillna(text)
+
+    for field, default in CHOICE_DEFAULTS.items():
+        if field not in model_fields:
+            continue
+        values = map_labels(column(field), choice_lookup(model, field))
+        frame[field] = values.astype(object).where(values.notna(), default)
+
+    dates = parse_dates(column('date'))
+    frame['date'] = dates.dt.date
+    for field in ('charge', 'received'):
+        frame[field] = pd.to_numeric(column(field), errors='coerce').round(2)
+    frame['in_time'] = parse_times(column('in_time'))
+    frame['out_time'] = parse_times(column('out_time'))
+
+    # Validate the whole frame before writing anything
+    problems = [
+        (dates.isna(), 'Date is missing or not a valid date'),
+        (frame['case_number'].isna(), 'Case Number is missing'),
+        (frame['charge'].isna(), 'Charge is missing or not a number'),
+        (frame['received'].isna(), 'Received is missing or not a number'),
+    ]
+    if closed:
+        problems.append((dates.dt.date.le(closed) & dates.notna(), f'Date falls in a period closed through {closed:%d-%m-%Y}'))
+
+    messages = pd.Series('', index=df.index, dtype='object')
+    for mask, message in problems:
+        messages = messages.mask(mask.fillna(False).astype(bool), messages + message + '; ')
+    invalid = messages != ''
+
+    errors = pd.DataFrame({
+        'row': df.index[invalid],
+        'case_number': frame.loc[invalid, 'case_number'].astype(object).where(frame.loc[invalid, 'case_number'].notna(), ''),
+        'error': messages[invalid].str.rstrip('; '),
+    })
+    return frame[~invalid], errors
+
+
+def case_number_parts(case_numbers):
+    """case_series, case_seq and case_seq_length columns for a column of case numbers, as split_case_number() gives them"""
+    parts = case_numbers.astype('string').str.extract(CASE_NUMBER_PATTERN)
+    digits = parts[1].replace('', pd.NA)
+    return {
+        'case_series': parts[0].fillna('').str.upper().astype(object),
+        'case_seq': pd.to_numeric(digits, errors='coerce').astype('Int64'),
+        'case_seq_length': digits.str.len().astype('Int64'),
+    }
+
+
+def build_visits(model, records):
+    """Model instances for the prepared rows"""
+    # bulk_create() skips save(), so the case-number columns are filled in here
+    records = records.assign(**case_number_parts(records['case_number']))
+    rows = records.astype(object).where(records.notna(), None).to_dict('records')
+    for row in rows:
+        row['charge'] = Decimal(str(row['charge']))
+        row['received'] = Decimal(str(row['received']))
+    return [model(**row) for row in rows]
+
+
+def report_path(name):
+    return os.path.join(settings.MEDIA_ROOT, REPORT_DIR, os.path.basename(name))
+
+
+def report_preview(name, limit=ImportResult.preview_limit):
+    """First rows of a saved error report"""
+    if not name or not os.path.exists(report_path(name)):
+        return []
+    return pd.read_csv(report_path(name), nrows=limit, keep_default_na=False).to_dict('records')
+
+
+def link_patients(records):
+    """Set patient_id from the case numbers with one lookup for the whole chunk"""
+    patient_ids = patient_id_map(records['case_number'].dropna().unique())
+    return records.assign(patient_id_id=records['case_number'].map(patient_ids).astype('Int64'))
+
+
+def import_visit_chunk(model, df):
+    """Insert the valid rows of one chunk; returns (visits, errors)"""
+    records, errors = prepare_visits(model, df, closed_through(SERIES[model]))
+    visits = model.objects.bulk_create(build_visits(model, link_patients(records)), batch_size=BULK_BATCH_SIZE)
+    return visits, errors
+
+
+def import_visits(model, chunks):
+    """Validate sheet chunks and insert their valid rows, all in one transaction"""
+    result = ImportResult()
+    patient_ids = set()
+    with transaction.atomic():
+        for df in chunks:
+            visits, errors = import_visit_chunk(model, df)
+            patient_ids.update(visit.patient_id_id for visit in visits)
+            result.imported += len(visits)
+            result.add_errors(errors)
+        visits_changed(model, patient_ids)
+    return result
+
+
+def prepare_patients(df):
+    """Map a patient sheet to model fields, one row per case number (the last one wins)
+
+    Returns (records, errors) like prepare_visits; rows without a case number are the errors.
+    """
+    df = df.rename(columns=normalize_header)
+    if 'case_number' not in df.columns:
+        raise ImportFileError('Missing required column: case_number')
+
+    df = df.dropna(how='all')
+    blank = pd.Series(pd.NA, index=df.index, dtype='object')
+    frame = pd.DataFrame(index=df.index)
+    frame['case_number'] = text_column(df['case_number'])
+    for field in PATIENT_FIELDS:
+        frame[field] = text_column(df[field]) if field in df.columns else blank
+    if 'contact_number' in df.columns:
+        frame['contact'] = text_column(df['contact_number']).fillna(frame['contact'])
+
+    missing = frame['case_number'].isna()
+    errors = pd.DataFrame({'row': df.index[missing], 'case_number': '', 'error': 'Case Number is missing'})
+    frame = frame[~missing].drop_duplicates('case_number', keep='last')
+    frame = frame.assign(**case_number_parts(frame['case_number']))
+    return frame.astype(object).where(frame.notna(), None), errors
+
+
+def patient_id_map(case_numbers):
+    """case_number -> patient id for the given case numbers, in a few IN (...) queries"""
+    case_numbers = list(case_numbers)
+    found = {}
+    for start in range(0, len(case_numbers), LOOKUP_BATCH_SIZE):
+        batch = case_numbers[start:start + LOOKUP_BATCH_SIZE]
+        found.update(Patient.objects.filter(case_number__in=batch).values_list('case_number', 'pk'))
+    return found
+
+
+def import_patient_chunk(df):
+    """Upsert the patients of one chunk; returns (created, updated, errors)"""
+    records, errors = prepare_patients(df)
+    patients = [Patient(**row) for row in records.to_dict('records')]
+    existing = patient_id_map(patient.case_number for patient in patients)
+    inserts = [patient for patient in patients if patient.case_number not in existing]
+    updates = [patient for patient in patients if patient.case_number in existing]
+    Patient.objects.bulk_create(inserts, batch_size=BULK_BATCH_SIZE)
+    Patient.objects.bulk_create(
+        updates,
+        batch_size=BULK_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['case_number'],
+        update_fields=PATIENT_FIELDS + ['updated_at'],
+    )
+    transaction.on_commit(invalidate_counters)
+    return len(inserts), len(updates), errors
+
+
+def import_patients(chunks):
+    """Insert new patients and overwrite existing ones by case number, all in one transaction
+
+    Returns (created, updated, skipped) where skipped counts rows without a case number.
+    """
+    created = updated = skipped = 0
+    with transaction.atomic():
+        for df in chunks:
+            inserted, changed, errors = import_patient_chunk(df)
+            created += inserted
+            updated += changed
+            skipped += len(errors)
+    return created, updated, skipped
@@ -0,0 +1,214 @@
+"""
+Background import jobs.
+
+An upload is saved under MEDIA_ROOT and recorded as an ImportJob. The
+run_worker management command polls for pending jobs and imports them
+chunk by chunk. Every chunk commits together with the job's progress, so
+a job that is cancelled, fails or loses its worker resumes from the first
+row that was not committed. Small uploads are run straight away in the
+request by the same code. Batch jobs (every sheet of a workbook, or every
+file of a zip) are handed to batches.run_batch and commit all at once.
+They hold the write lock without updating their heartbeat for as long as
+they run, so a running batch job is only taken over once BATCH_MAX_RUNTIME
+has passed since it was claimed; by then its worker is assumed dead and
+its transaction rolled back, so the batch starts again from the top.
+
+Uploads are stored under a random name, since they hold patient details.
+A completed job's upload is deleted straight away; a failed or cancelled
+one is kept for UPLOAD_RETENTION so that it can be resumed.
+"""
+import logging
+import os
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .batches import BatchCancelled, is_archive, run_batch
+from .importers import (
+    ImportFileError, ImportResult, import_patient_chunk, import_visit_chunk, patient_column, read_chunks,
+    sheet_row_count, visit_column,
+)
+from .models import DailySheet, ImportJob, PCList
+from .signals import visits_changed
+
+
+logger = logging.getLogger(__name__)
+
+# Visit table of each job kind; patients have their own upsert
+IMPORT_MODELS = {
+    'patients': None,
+    'daily_sheet': DailySheet,
+    'pc_list': PCList,
+}
+
+# Uploads up to this size are imported inside the request
+INLINE_IMPORT_BYTES = 256 * 1024
+
+# A running job whose worker has been silent this long is picked up again
+STALE_AFTER = timedelta(minutes=10)
+
+# A running batch job claimed this long ago is assumed to have lost its worker
+BATCH_MAX_RUNTIME = timedelta(hours=2)
+
+# How long the upload of a failed or cancelled job is kept for resuming
+UPLOAD_RETENTION = timedelta(days=7)
+
+PROGRESS_FIELDS = [
+    'total_rows', 'next_row', 'rows_processed', 'imported', 'updated',
+    'error_count', 'report_name', 'started_at', 'heartbeat_at',
+]
+
+
+def create_import_job(kind, upload, user=None, all_sheets=False):
+    """Save an upload as a pending job; a zip of files is always imported as a batch"""
+    all_sheets = kind != 'patients' and (all_sheets or is_archive(upload))
+    job = ImportJob(kind=kind, original_name=upload.name, created_by=user, all_sheets=all_sheets)
+    suffix = os.path.splitext(upload.name)[1].lower()
+    job.file.save(f'{uuid.uuid4().hex}{suffix}', upload, save=False)
+    job.save()
+    return job
+
+
+def claimable(now):
+    return Q(status='pending') | Q(status='running', heartbeat_at__lt=now - STALE_AFTER)
+
+
+def claimable_import(now):
+    """Like claimable(), but a silent batch job may still be running its single transaction"""
+    return claimable(now) & ~Q(status='running', all_sheets=True, heartbeat_at__gte=now - BATCH_MAX_RUNTIME)
+
+
+def claim_job(pk):
+    """Mark one job as running; returns it, or None if another worker got there first"""
+    now = timezone.now()
+    if not ImportJob.objects.filter(claimable_import(now), pk=pk).update(status='running', heartbeat_at=now):
+        return None
+    return ImportJob.objects.get(pk=pk)
+
+
+def claim_next_job():
+    """The oldest pending (or abandoned) job, claimed for this worker"""
+    for pk in ImportJob.objects.filter(claimable_import(timezone.now())).order_by('created_at').values_list('pk', flat=True)[:10]:
+        job = claim_job(pk)
+        if job:
+            return job
+    return None
+
+
+def cancel_requested(job):
+    return ImportJob.objects.filter(pk=job.pk, cancel_requested=True).exists()
+
+
+def import_chunk(job, model, df, result):
+    """Import one chunk and record the job's progress in the same transaction"""
+    with transaction.atomic():
+        if model is None:
+            created, updated, errors = import_patient_chunk(df)
+            job.imported += created
+            job.updated += updated
+        else:
+            visits, errors = import_visit_chunk(model, df)
+            visits_changed(model, {visit.patient_id_id for visit in visits})
+            job.imported += len(visits)
+
+        result.add_errors(errors)
+        job.error_count = result.error_count
+        job.report_name = result.report_name
+        job.rows_processed += len(df)
+        if len(df):
+            job.next_row = int(df.index[-1]) + 1
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=PROGRESS_FIELDS)
+
+
+def discard_upload(job):
+    """Delete a job's uploaded file once nothing will read it again"""
+    if job.file:
+        job.file.delete(save=False)
+    job.file.name = ''
+
+
+def finish_job(job, status, message=''):
+    job.status = status
+    job.message = message
+    job.cancel_requested = False
+    job.finished_at = timezone.now()
+    if status == 'completed':
+        discard_upload(job)
+    job.save(update_fields=['status', 'message', 'cancel_requested', 'finished_at', 'file'])
+
+
+def expire_uploads():
+    """Delete the uploads of failed and cancelled jobs that were not resumed in time"""
+    cutoff = timezone.now() - UPLOAD_RETENTION
+    expired = ImportJob.objects.filter(status__in=['failed', 'cancelled'], finished_at__lt=cutoff).exclude(file='')
+    for job in expired:
+        discard_upload(job)
+        job.save(update_fields=['file'])
+
+
+def run_batch_job(job, model):
+    """Import every sheet of a batch job in one transaction; progress is saved once it commits"""
+    job.started_at = job.started_at or timezone.now()
+    job.save(update_fields=PROGRESS_FIELDS)
+    result, summary = run_batch(job.file.path, model, job.original_name, lambda: cancel_requested(job))
+    job.total_rows = job.rows_processed = summary['rows']
+    job.imported = result.imported
+    job.error_count = result.error_count
+    job.report_name = result.report_name
+    job.summary = summary
+    job.heartbeat_at = timezone.now()
+    job.save(update_fields=PROGRESS_FIELDS + ['summary'])
+
+
+def run_import_job(job):
+    """Import a claimed job from its next uncommitted row to the end of the sheet"""
+    model = IMPORT_MODELS[job.kind]
+    result = ImportResult(job.imported, job.error_count, job.report_name)
+    try:
+        if job.all_sheets:
+            run_batch_job(job, model)
+            finish_job(job, 'completed')
+            return job
+
+        with job.file.open('rb') as file:
+            if job.total_rows is None:
+                job.total_rows = sheet_row_count(file)
+            job.started_at = job.started_at or timezone.now()
+            job.save(update_fields=PROGRESS_FIELDS)
+
+            usecols = patient_column if model is None else visit_column
+            for df in read_chunks(file, usecols, start_row=job.next_row):
+                if cancel_requested(job):
+                    finish_job(job, 'cancelled', f'Cancelled before row {job.next_row}.')
+                    return job
+                import_chunk(job, model, df, result)
+    except BatchCancelled:
+        finish_job(job, 'cancelled', 'Cancelled. Nothing from this batch was imported.')
+    except ImportFileError as error:
+        finish_job(job, 'failed', str(error))
+    except Exception as error:
+        logger.exception('Import job %s failed', job.pk)
+        finish_job(job, 'failed', f'Error reading file: {error}')
+    else:
+        finish_job(job, 'completed')
+    return job
+
+
+def cancel_job(job):
+    """Cancel a pending job at once, or ask a running one to stop after its current chunk"""
+    now = timezone.now()
+    if ImportJob.objects.filter(pk=job.pk, status='pending').update(status='cancelled', finished_at=now):
+        return True
+    return bool(ImportJob.objects.filter(pk=job.pk, status='running').update(cancel_requested=True))
+
+
+def resume_job(job):
+    """Queue a failed or cancelled job again; it continues from its next uncommitted row"""
+    resumable = ImportJob.objects.filter(pk=job.pk, status__in=['failed', 'cancelled']).exclude(file='')
+    return bool(resumable.update(
+        status='pending', cancel_requested=False, message='', finished_at=None,
+    ))
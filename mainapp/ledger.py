@@ -0,0 +1,165 @@
+"""
+Paginated and streamed patient ledgers.
+
+Ledger rows are ordered by (date, id) and paged with a keyset cursor taken
+from the last row shown. A page's opening balance is a single aggregate
+over the rows up to the cursor, so every page costs the same to render.
+Rows without a date sort first, the same as SQLite orders NULLs.
+"""
+import csv
+import tempfile
+from datetime import datetime
+
+import openpyxl
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from .balances import MONEY, ZERO
+
+
+LEDGER_PAGE_SIZE = 50
+LEDGER_CHUNK_SIZE = 2000
+
+LEDGER_HEADERS = ['Date', 'Case Number', 'Contact', 'Charge', 'Received', 'Balance']
+
+
+def encode_cursor(date, pk):
+    return f"{date.isoformat() if date else ''}_{pk}"
+
+
+def decode_cursor(cursor):
+    """Return (date, pk) from a cursor string, or None if it is missing or malformed"""
+    try:
+        date, pk = cursor.rsplit('_', 1)
+        return (datetime.strptime(date, '%Y-%m-%d').date() if date else None), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def rows_through(date, pk):
+    """Rows at or before the cursor position in (date, id) order"""
+    if date is None:
+        return Q(date__isnull=True, id__lte=pk)
+    return Q(date__isnull=True) | Q(date__lt=date) | Q(date=date, id__lte=pk)
+
+
+def rows_after(date, pk):
+    """Rows after the cursor position in (date, id) order"""
+    if date is None:
+        return Q(date__isnull=True, id__gt=pk) | Q(date__isnull=False)
+    return Q(date__gt=date) | Q(date=date, id__gt=pk)
+
+
+def ledger_rows(model, patient):
+    return model.objects.filter(patient_id=patient).order_by('date', 'id')
+
+
+def ledger_page(model, patient, cursor=None, size=LEDGER_PAGE_SIZE):
+    """One page of a patient's ledger with its opening balance and the cursor of the next page"""
+    rows = ledger_rows(model, patient)
+    opening = 0
+    position = decode_cursor(cursor)
+    if position:
+        totals = rows.filter(rows_through(*position)).aggregate(
+            charge=Coalesce(Sum('charge'), ZERO, output_field=MONEY),
+            received=Coalesce(Sum('received'), ZERO, output_field=MONEY),
+        )
+        opening = totals['received'] - totals['charge']
+        rows = rows.filter(rows_after(*position))
+
+    page = list(rows.values_list('id', 'date', 'case_number', 'charge', 'received')[:size + 1])
+    has_next = len(page) > size
+    page = page[:size]
+
+    entries = []
+    balance = opening
+    for pk, date, case_number, charge, received in page:
+        charge = charge or 0
+        received = received or 0
+        balance += received - charge
+        entries.append({
+            'date': date,
+            'case_number': case_number,
+            'contact': patient.contact,
+            'charge': charge,
+            'received': received,
+            'balance': balance,
+        })
+
+    return {
+        'entries': entries,
+        'opening': opening,
+        'closing': balance,
+        'next_cursor': encode_cursor(page[-1][1], page[-1][0]) if has_next else None,
+        'is_first': position is None,
+    }
+
+
+def running_ledger(rows):
+    """Ledger entries with a running balance from (date, case_number, charge, received) rows, and the final balance"""
+    balance = 0
+    entries = []
+    for date, case_number, charge, received in rows:
+        charge = charge or 0
+        received = received or 0
+        balance += received - charge
+        entries.append({
+            'date': date,
+            'case_number': case_number,
+            'charge': charge,
+            'received': received,
+            'balance': balance,
+        })
+    return entries, balance
+
+
+def iter_ledger(model, patient):
+    """Yield export rows with a running balance, reading the ledger in chunks"""
+    balance = 0
+    rows = ledger_rows(model, patient).values_list('date', 'case_number', 'charge', 'received')
+    for date, case_number, charge, received in rows.iterator(chunk_size=LEDGER_CHUNK_SIZE):
+        charge = charge or 0
+        received = received or 0
+        balance += received - charge
+        yield [date, case_number or '', patient.contact or '', charge, received, balance]
+
+
+class Echo:
+    """File-like object whose write() hands the line back, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
+
+
+def ledger_download(model, patient, fmt):
+    """Stream the full ledger as CSV, or as XLSX built in a spooled temp file"""
+    filename = f"ledger_{patient.case_number}_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}"
+
+    if fmt == 'xlsx':
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet('Ledger')
+        ws.append(LEDGER_HEADERS)
+        for row in iter_ledger(model, patient):
+            ws.append(row)
+        output = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        wb.save(output)
+        output.seek(0)
+        return FileResponse(
+            output,
+            as_attachment=True,
+            filename=f'{filename}.xlsx',
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        )
+
+    writer = csv.writer(Echo())
+
+    def lines():
+        yield writer.writerow(LEDGER_HEADERS)
+        for row in iter_ledger(model, patient):
+            yield writer.writerow(row)
+
+    response = StreamingHttpResponse(lines(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
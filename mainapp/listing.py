@@ -0,0 +1,177 @@
+"""
+Keyset-paginated patient and visit lists.
+
+Patients are listed newest first in (created_at, id) order and paged with a
+cursor taken from the last row shown, so a deep page costs the same as the
+first one. Only the columns the list renders are read. The total is not
+counted on every request: the unfiltered total comes from the dashboard
+counters, and the total of a filter combination is counted once and cached
+for a few minutes.
+
+The daily sheet and PC lists are paged by whole days, newest first, with
+the cursor taken from the last day shown. The days of a page and their
+subtotals come from one grouped query, their visits from a second one and
+the totals of the list from a third, however long the history is. Without
+a date filter the lists cover only the last few weeks.
+"""
+import hashlib
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .balances import MONEY, ZERO
+from .counters import dashboard_counters
+
+
+PATIENT_PAGE_SIZE = 50
+
+# How long the total of one filter combination is reused
+PATIENT_COUNT_TIMEOUT = 300
+
+PATIENT_LIST_FIELDS = [
+    'id', 'name', 'case_number', 'age', 'gender', 'diagnosis', 'chief_complaint',
+    'reference', 'contact', 'address', 'created_at',
+]
+
+
+def encode_cursor(created_at, pk, shown):
+    return f'{created_at.isoformat()}_{pk}_{shown}'
+
+
+def decode_cursor(cursor):
+    """Return (created_at, pk, rows shown so far) from a cursor string, or None if it is missing or malformed"""
+    try:
+        created_at, pk, shown = cursor.rsplit('_', 2)
+        return datetime.fromisoformat(created_at), int(pk), int(shown)
+    except (AttributeError, ValueError):
+        return None
+
+
+def rows_before(created_at, pk):
+    """Rows listed after the cursor position, i.e. older in (created_at, id) order"""
+    return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+
+
+def filtered_count(records, filtered):
+    """Total of the filtered list, from the dashboard counters or a short-lived cache entry"""
+    if not filtered:
+        return dashboard_counters()['patients_total']
+    sql, params = records.order_by().values('id').query.sql_with_params()
+    key = 'patient_count:' + hashlib.sha256(repr((sql, params)).encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = records.count()
+        cache.set(key, count, PATIENT_COUNT_TIMEOUT)
+    return count
+
+
+def patient_page(records, cursor=None, filtered=False, size=PATIENT_PAGE_SIZE):
+    """One page of a Patient queryset with the cursor of the next page and the (cached) total"""
+    position = decode_cursor(cursor)
+    shown = 0
+    page = records.only(*PATIENT_LIST_FIELDS).order_by('-created_at', '-id')
+    if position:
+        created_at, pk, shown = position
+        page = page.filter(rows_before(created_at, pk))
+
+    patients = list(page[:size + 1])
+    has_next = len(patients) > size
+    patients = patients[:size]
+
+    if position is None and not has_next:
+        # The whole list fits on the first page, so it has been counted already
+        total = len(patients)
+    else:
+        total = filtered_count(records, filtered)
+
+    last = patients[-1] if patients else None
+    return {
+        'patients': patients,
+        'start': shown + 1,
+        'end': shown + len(patients),
+        'total': total,
+        'next_cursor': encode_cursor(last.created_at, last.id, shown + len(patients)) if has_next else None,
+        'is_first': position is None,
+    }
+
+
+VISIT_PAGE_DAYS = 7
+
+# Days shown when no date filter is given
+VISIT_LIST_DAYS = 30
+
+VISIT_LIST_FIELDS = [
+    'id', 'date', 'name', 'case_number', 'diagnosis', 'charge', 'received', 'payment_status',
+    'payment_type', 'payment_frequency', 'in_time', 'out_time', 'treatment_1', 'treatment_2',
+    'treatment_3', 'treatment_4', 'therapist_1', 'therapist_2',
+]
+
+
+def recent_window(visits, filter_form):
+    """Limit an unfiltered-by-date visit list to the last VISIT_LIST_DAYS days; returns (visits, start date)"""
+    data = filter_form.cleaned_data if filter_form.is_valid() else {}
+    if data.get('date_from') or data.get('date_to') or data.get('year'):
+        return visits, None
+    start = timezone.localdate() - timedelta(days=VISIT_LIST_DAYS - 1)
+    return visits.filter(date__gte=start), start
+
+
+def day_totals():
+    return dict(
+        visits=Count('id'),
+        charge=Coalesce(Sum('charge'), ZERO, output_field=MONEY),
+        received=Coalesce(Sum('received'), ZERO, output_field=MONEY),
+    )
+
+
+def days_after(cursor):
+    """Visits listed after the cursor day in (date descending, undated last) order, or None if it is malformed"""
+    try:
+        day = date.fromisoformat(cursor)
+    except (TypeError, ValueError):
+        return None
+    return Q(date__lt=day) | Q(date__isnull=True)
+
+
+def visit_day_page(visits, cursor=None, days=VISIT_PAGE_DAYS):
+    """Whole days of a visit queryset with their subtotals, the list totals and the cursor of the next page"""
+    visits = visits.order_by()
+    listed = visits
+    position = days_after(cursor) if cursor else None
+    if position is not None:
+        listed = listed.filter(position)
+
+    groups = list(
+        listed.values('date')
+        .annotate(**day_totals())
+        .order_by(F('date').desc(nulls_last=True))[:days + 1]
+    )
+    has_next = len(groups) > days
+    groups = groups[:days]
+
+    rows = defaultdict(list)
+    dates = [group['date'] for group in groups if group['date'] is not None]
+    shown = Q(date__in=dates)
+    if any(group['date'] is None for group in groups):
+        shown |= Q(date__isnull=True)
+    if groups:
+        page = visits.filter(shown).only(*visit_list_fields(visits.model))
+        for visit in page.order_by(F('date').desc(nulls_last=True), 'id'):
+            rows[visit.date].append(visit)
+
+    return {
+        'days': [dict(group, rows=rows[group['date']]) for group in groups],
+        'totals': visits.aggregate(**day_totals()),
+        # Undated visits are listed last, so the last day of a page with a next one has a date
+        'next_cursor': groups[-1]['date'].isoformat() if has_next else None,
+        'is_first': position is None,
+    }
+
+
+def visit_list_fields(model):
+    fields = {field.name for field in model._meta.concrete_fields}
+    return [name for name in VISIT_LIST_FIELDS if name in fields]
@@ -0,0 +1,55 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp.archive import (
+    ARCHIVE_FORMATS, ARCHIVE_TABLES, default_format, load_manifest, save_manifest, snapshot_table, verify_archive,
+)
+
+
+class Command(BaseCommand):
+    help = 'Write month-partitioned Parquet (or gzip CSV) snapshots of the visit and patient tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=os.path.join(settings.BASE_DIR, 'archive'), help='Archive directory')
+        parser.add_argument('--table', choices=sorted(ARCHIVE_TABLES) + ['all'], default='all')
+        parser.add_argument(
+            '--format', choices=ARCHIVE_FORMATS,
+            help='File format (default: parquet if pyarrow is installed, otherwise csv.gz)',
+        )
+        parser.add_argument('--full', action='store_true', help='Rewrite every partition, changed or not')
+        parser.add_argument('--verify', action='store_true', help='Only check the files against the manifest')
+
+    def handle(self, *args, **options):
+        directory = options['output']
+
+        if options['verify']:
+            problems = verify_archive(directory)
+            for name, month, problem in problems:
+                self.stdout.write(self.style.ERROR(f'{name} {month}: {problem}'))
+            if problems:
+                raise CommandError(f'{len(problems)} partition(s) failed verification')
+            self.stdout.write(self.style.SUCCESS('All partitions match the manifest'))
+            return
+
+        fmt = options['format'] or default_format()
+        if fmt == 'parquet' and default_format() != 'parquet':
+            raise CommandError('Parquet output needs pyarrow; install it or use --format csv.gz')
+
+        os.makedirs(directory, exist_ok=True)
+        manifest = load_manifest(directory)
+        for name in sorted(ARCHIVE_TABLES):
+            if options['table'] not in ('all', name):
+                continue
+            written, unchanged, removed = snapshot_table(directory, manifest, name, fmt, options['full'])
+            # Saved after every table so an interrupted run keeps what it finished
+            save_manifest(directory, manifest)
+            if written:
+                self.stdout.write(f"{name}: wrote {', '.join(written)}")
+            if removed:
+                self.stdout.write(f"{name}: removed {', '.join(removed)}")
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: {len(written)} partition(s) written, {len(unchanged)} unchanged, {len(removed)} removed '
+                f"({manifest['tables'][name]['rows']} rows, {fmt})"
+            ))
@@ -0,0 +1,334 @@
+import csv
+import gzip
+import io
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+import openpyxl
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from openpyxl.styles import Alignment, Font, PatternFill, numbers
+
+from mainapp.balances import advance_patients, paginate_balances, pending_patients
+from mainapp.exports import VISIT_EXPORT_COLUMNS, XlsxWriter, export_columns, export_rows
+from mainapp.importers import VISIT_COLUMNS, import_patients, import_visits, prepare_visits, read_chunks, visit_column
+from mainapp.models import DailySheet, Patient, PCList
+from mainapp.signals import visits_changed
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """Run the block in a transaction that is always thrown away"""
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def seed_patients(count, visits_per_patient=3, prefix='BM'):
+    """Create `count` patients with alternating pending/advance visit histories"""
+    patients = Patient.objects.bulk_create(
+        Patient(name=f'Bench {i}', case_number=f'{prefix}{i:07d}', contact=f'90000{i:05d}')
+        for i in range(count)
+    )
+    today = timezone.localdate()
+    sheets, pc_lists = [], []
+    for i, patient in enumerate(patients):
+        received = Decimal('600') if i % 2 else Decimal('300')
+        for _ in range(visits_per_patient):
+            sheets.append(DailySheet(patient_id=patient, date=today, case_number=patient.case_number,
+                                     name=patient.name, charge=Decimal('400'), received=received))
+            pc_lists.append(PCList(patient_id=patient, date=today, case_number=patient.case_number,
+                                   name=patient.name, charge=Decimal('400'), received=received))
+    DailySheet.objects.bulk_create(sheets, batch_size=1000)
+    PCList.objects.bulk_create(pc_lists, batch_size=1000)
+    patient_ids = [patient.pk for patient in patients]
+    visits_changed(DailySheet, patient_ids)
+    visits_changed(PCList, patient_ids)
+    return patients
+
+
+def bench_balances(command, sizes):
+    """Pending/advance pages must cost the same number of queries at any patient count"""
+    request = RequestFactory().get('/pending/', {'page': 1})
+    query_counts = set()
+    for size in sizes:
+        with rolled_back():
+            seed_patients(size)
+            for model in (DailySheet, PCList):
+                for label, builder in (('pending', pending_patients), ('advance', advance_patients)):
+                    with CaptureQueriesContext(connection) as ctx:
+                        started = time.perf_counter()
+                        page = paginate_balances(request, builder(model))
+                        rows = list(page)
+                        elapsed = time.perf_counter() - started
+                    query_counts.add(len(ctx.captured_queries))
+                    command.stdout.write(
+                        f'{model.__name__:<10} {label:<8} patients={size:<7} rows={len(rows):<4} '
+                        f'total={page.paginator.count:<7} queries={len(ctx.captured_queries)} '
+                        f'time={elapsed * 1000:.1f}ms'
+                    )
+    if len(query_counts) > 1:
+        raise CommandError(f'Query count varies with patient count: {sorted(query_counts)}')
+    command.stdout.write(command.style.SUCCESS(f'Constant query count: {query_counts.pop()}'))
+
+
+@contextmanager
+def counting_queries():
+    """Count executed queries without keeping them, for runs beyond the debug query log limit"""
+    counter = {'queries': 0}
+
+    def count(execute, sql, params, many, context):
+        counter['queries'] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        yield counter
+
+
+def patient_sheet(count, prefix='BM'):
+    """A patient upload sheet in which every other case number already exists"""
+    return pd.DataFrame({
+        'Name': [f'Bench {i}' for i in range(count)],
+        'Case Number': [f'{prefix}{i:07d}' for i in range(count)],
+        'Age': [str(20 + i % 60) for i in range(count)],
+        'Gender': [('Male', 'Female')[i % 2] for i in range(count)],
+        'Chief Complaint': ['Back pain'] * count,
+        'Reference': ['Walk-in'] * count,
+        'Contact Number': [f'91000{i:05d}' for i in range(count)],
+        'Address': ['Chennai'] * count,
+    })
+
+
+def legacy_patient_upload(df):
+    """The row-by-row update_or_create loop upload_excel used to run"""
+    df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
+    for _, row in df.iterrows():
+        Patient.objects.update_or_create(
+            case_number=row.get('case_number'),
+            defaults={
+                'name': row.get('name'),
+                'age': row.get('age'),
+                'gender': row.get('gender'),
+                'chief_complaint': row.get('chief_complaint'),
+                'reference': row.get('reference'),
+                'contact': row.get('contact_number') or row.get('contact'),
+                'address': row.get('address')
+            }
+        )
+
+
+def bench_patient_upload(command, sizes):
+    """Rows per second of the legacy per-row upload against the batched upsert"""
+    for size in sizes:
+        timings = {}
+        for label, upload in (('legacy', legacy_patient_upload), ('bulk', lambda sheet: import_patients([sheet]))):
+            with rolled_back():
+                Patient.objects.bulk_create(
+                    (Patient(name=f'Old {i}', case_number=f'BM{i:07d}') for i in range(0, size, 2)),
+                    batch_size=1000,
+                )
+                sheet = patient_sheet(size)
+                with counting_queries() as counter:
+                    started = time.perf_counter()
+                    upload(sheet)
+                    elapsed = time.perf_counter() - started
+            timings[label] = elapsed
+            command.stdout.write(
+                f'{label:<7} rows={size:<7} queries={counter["queries"]:<7} '
+                f'time={elapsed:.2f}s rate={size / elapsed:,.0f} rows/s'
+            )
+        command.stdout.write(command.style.SUCCESS(
+            f'rows={size}: bulk upsert is {timings["legacy"] / timings["bulk"]:.1f}x faster'
+        ))
+
+
+def visit_rows(count):
+    """Rows of a daily sheet export, in VISIT_COLUMNS order"""
+    today = timezone.localdate()
+    for i in range(count):
+        yield [
+            today, f'Bench {i}', f'BM{i % 5000:07d}', 'Low back pain', 400, 300 + i % 3 * 100,
+            'Partially Paid', 'Cash', 'Daily Basis', '10:00:00', '10:45:00',
+            'IFT', 'Exercise', None, None, 'Dr. Basidh', None,
+        ]
+
+
+def write_visit_workbook(file, count):
+    """Write a daily sheet export of `count` rows with openpyxl's streaming writer"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Daily Sheet')
+    ws.append(list(VISIT_COLUMNS))
+    for row in visit_rows(count):
+        ws.append(row)
+    wb.save(file)
+    file.seek(0)
+
+
+def write_visit_csv(file, count, compress=False):
+    """Write the same export as write_visit_workbook as CSV, optionally gzip-compressed"""
+    binary = gzip.GzipFile(fileobj=file, mode='wb') if compress else file
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(VISIT_COLUMNS)
+    writer.writerows(visit_rows(count))
+    text.flush()
+    text.detach()
+    if compress:
+        binary.close()
+    file.seek(0)
+
+
+def peak_memory(func):
+    """Run func() and return (peak traced allocation in MB, seconds)
+
+    DEBUG is switched off for the run so Django's query log does not count towards the peak.
+    """
+    with override_settings(DEBUG=False):
+        return traced(func)
+
+
+def traced(func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20, time.perf_counter() - started
+    finally:
+        tracemalloc.stop()
+
+
+def bench_import_memory(command, sizes):
+    """Peak memory of loading a whole sheet with pandas against the streaming chunked import"""
+    peaks = []
+    for size in sizes:
+        with tempfile.TemporaryFile() as file:
+            write_visit_workbook(file, size)
+            full, full_time = peak_memory(lambda: pd.read_excel(file))
+            with rolled_back():
+                file.seek(0)
+                streamed, streamed_time = peak_memory(lambda: import_visits(DailySheet, read_chunks(file)))
+        peaks.append(streamed)
+        command.stdout.write(
+            f'rows={size:<7} read_excel peak={full:7.1f}MB ({full_time:.1f}s)   '
+            f'streaming import peak={streamed:6.1f}MB ({streamed_time:.1f}s)'
+        )
+    command.stdout.write(command.style.SUCCESS(
+        f'Streaming peak ranged {min(peaks):.1f}-{max(peaks):.1f}MB across {min(sizes)}-{max(sizes)} rows'
+    ))
+
+
+def bench_import_formats(command, sizes):
+    """Rows per second of XLSX, CSV and gzip CSV uploads of the same rows, parsing alone and imported"""
+    writers = {
+        'xlsx': write_visit_workbook,
+        'csv': write_visit_csv,
+        'csv.gz': lambda file, count: write_visit_csv(file, count, compress=True),
+    }
+    for size in sizes:
+        for fmt, write in writers.items():
+            with tempfile.TemporaryFile() as file:
+                write(file, size)
+                file_size = file.seek(0, io.SEEK_END) / 2 ** 20
+
+                started = time.perf_counter()
+                for df in read_chunks(file, visit_column):
+                    prepare_visits(DailySheet, df, None)
+                parsed = time.perf_counter() - started
+
+                with rolled_back(), override_settings(DEBUG=False):
+                    started = time.perf_counter()
+                    result = import_visits(DailySheet, read_chunks(file, visit_column))
+                    imported = time.perf_counter() - started
+
+            command.stdout.write(
+                f'{fmt:<7} rows={size:<7} file={file_size:6.1f}MB '
+                f'parse={size / parsed:9,.0f} rows/s ({parsed:.1f}s)   '
+                f'import={size / imported:8,.0f} rows/s ({imported:.1f}s, {result.imported} rows)'
+            )
+
+
+def legacy_daily_sheet_export(sheets):
+    """The old export: a styled cell per value in a full Workbook, then a second pass for widths"""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append([header for header, _, _ in VISIT_EXPORT_COLUMNS])
+    for cell in ws[1]:
+        cell.font = Font(bold=True, color='FFFFFF')
+        cell.fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+    for row_num, sheet in enumerate(sheets, start=2):
+        ws.cell(row=row_num, column=1).value = sheet.date
+        ws.cell(row=row_num, column=1).number_format = numbers.FORMAT_DATE_YYYYMMDD2
+        for col_num, (_, name, labels) in enumerate(VISIT_EXPORT_COLUMNS[1:], start=2):
+            value = getattr(sheet, name)
+            if labels and value:
+                value = getattr(sheet, f'get_{name}_display')()
+            ws.cell(row=row_num, column=col_num).value = value or ''
+    for col in ws.columns:
+        width = max((len(str(cell.value)) for cell in col if cell.value), default=0)
+        ws.column_dimensions[col[0].column_letter].width = min(width + 2, 50)
+    output = io.BytesIO()
+    wb.save(output)
+    return output
+
+
+def streaming_daily_sheet_export(sheets):
+    """What daily_sheet_export writes on a cache miss"""
+    columns = export_columns(DailySheet, VISIT_EXPORT_COLUMNS)
+    writer = XlsxWriter([header for header, _, _ in columns], 'Daily Sheets')
+    for row in export_rows(sheets, columns):
+        writer.append(row)
+    with tempfile.TemporaryFile() as file:
+        writer.save(file)
+
+
+def bench_export(command, sizes):
+    """Peak memory and time of the old in-memory daily sheet export against the streaming writer"""
+    for size in sizes:
+        with tempfile.TemporaryFile() as file, rolled_back():
+            write_visit_csv(file, size)
+            with override_settings(DEBUG=False):
+                import_visits(DailySheet, read_chunks(file, visit_column))
+            sheets = DailySheet.objects.all()
+
+            legacy, legacy_time = peak_memory(lambda: legacy_daily_sheet_export(sheets))
+            streamed, streamed_time = peak_memory(lambda: streaming_daily_sheet_export(sheets))
+        command.stdout.write(
+            f'rows={size:<7} workbook peak={legacy:7.1f}MB ({legacy_time:.1f}s)   '
+            f'streaming peak={streamed:6.1f}MB ({streamed_time:.1f}s)'
+        )
+
+
+SCENARIOS = {
+    'balances': (bench_balances, [100, 1000, 5000]),
+    'patient_upload': (bench_patient_upload, [1000, 10000, 100000]),
+    'import_memory': (bench_import_memory, [10000, 50000, 200000]),
+    'import_formats': (bench_import_formats, [100000]),
+    'export': (bench_export, [10000, 50000]),
+}
+
+
+class Command(BaseCommand):
+    help = 'Run a performance benchmark against the configured database. All seeded data is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--sizes', nargs='+', type=int, help='Dataset sizes to run the scenario at')
+
+    def handle(self, *args, **options):
+        bench, default_sizes = SCENARIOS[options['scenario']]
+        bench(self, options['sizes'] or default_sizes)
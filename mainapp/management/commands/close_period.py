@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mainapp.balances import SERIES
+from mainapp.periods import close_periods, reopen_periods
+
+
+class Command(BaseCommand):
+    help = 'Freeze monthly totals into PeriodSnapshot rows, or reopen closed months with --reopen'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--through', help='Last month to close, as YYYY-MM (default: last month)')
+        parser.add_argument('--series', choices=['UM', 'PC', 'all'], default='all')
+        parser.add_argument('--reopen', metavar='YYYY-MM', help='Reopen this month and every later closed month')
+
+    def handle(self, *args, **options):
+        models = [model for model, series in SERIES.items() if options['series'] in ('all', series)]
+
+        if options['reopen']:
+            month = self.parse_month(options['reopen'])
+            for model in models:
+                count = reopen_periods(model, month)
+                self.stdout.write(f'{SERIES[model]}: reopened {count} month(s) from {month:%Y-%m}')
+            return
+
+        if options['through']:
+            through = self.parse_month(options['through'])
+        else:
+            through = timezone.localdate().replace(day=1) - timedelta(days=1)
+
+        for model in models:
+            try:
+                snapshots = close_periods(model, through)
+            except ValidationError as error:
+                raise CommandError(error.messages[0])
+            for snapshot in snapshots:
+                self.stdout.write(
+                    f'{snapshot}: charge={snapshot.charge} received={snapshot.received} '
+                    f'opening={snapshot.opening} closing={snapshot.closing}'
+                )
+            self.stdout.write(self.style.SUCCESS(f'{SERIES[model]}: closed {len(snapshots)} month(s) through {through:%Y-%m}'))
+
+    def parse_month(self, value):
+        try:
+            return datetime.strptime(value, '%Y-%m').date()
+        except ValueError:
+            raise CommandError(f'Invalid month {value!r}, expected YYYY-MM')
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Now
+
+from mainapp.balances import SERIES
+from mainapp.models import Patient
+from mainapp.signals import visits_changed
+
+
+class Command(BaseCommand):
+    help = 'Set patient_id on DailySheet and PCList rows that have none, matching them to patients by case number'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--series', choices=['UM', 'PC', 'all'], default='all')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows updated per statement and transaction')
+        parser.add_argument('--show', type=int, default=20, help='Unmatched case numbers to list per table')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be linked')
+
+    def handle(self, *args, **options):
+        for model, series in SERIES.items():
+            if options['series'] not in ('all', series):
+                continue
+            orphans = model.objects.filter(patient_id__isnull=True)
+            matched = orphans.filter(case_number__in=Patient.objects.values('case_number'))
+
+            if options['dry_run']:
+                self.stdout.write(f'{series}: {matched.count()} of {orphans.count()} unlinked rows can be linked')
+            else:
+                linked = self.link(model, matched, options['batch_size'])
+                self.stdout.write(self.style.SUCCESS(f'{series}: linked {linked} rows'))
+
+            self.report_unmatched(series, orphans.exclude(case_number__in=Patient.objects.values('case_number')), options['show'])
+
+    def link(self, model, matched, batch_size):
+        """Update the matched rows in primary-key batches with one UPDATE ... SET patient_id = (subquery) each"""
+        patient = Patient.objects.filter(case_number=OuterRef('case_number')).values('pk')[:1]
+        linked = 0
+        last_pk = 0
+        while True:
+            batch = list(matched.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return linked
+            with transaction.atomic():
+                rows = model.objects.filter(pk__in=batch)
+                # update() skips auto_now; the archive snapshots find changed months by updated_at
+                linked += rows.update(patient_id=Subquery(patient), updated_at=Now())
+                visits_changed(model, set(rows.values_list('patient_id', flat=True)))
+            last_pk = batch[-1]
+            self.stdout.write(f'{SERIES[model]}: linked {linked} rows so far')
+
+    def report_unmatched(self, series, unmatched, limit):
+        total = unmatched.count()
+        if not total:
+            self.stdout.write(f'{series}: no unmatched rows')
+            return
+        by_case = list(
+            unmatched.values('case_number').annotate(rows=Count('id')).order_by('-rows', 'case_number')[:limit]
+        )
+        self.stdout.write(self.style.WARNING(f'{series}: {total} rows have no patient with their case number'))
+        for row in by_case:
+            self.stdout.write(f"  {row['case_number'] or '(blank)'}: {row['rows']} rows")
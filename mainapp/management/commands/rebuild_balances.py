@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.balances import SERIES, refresh_balances
+from mainapp.models import Patient, PatientBalance
+
+
+class Command(BaseCommand):
+    help = 'Recompute every PatientBalance row from DailySheet and PCList, one chunk of patients at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Patients refreshed per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        # Rows of deleted patients cascade away; anything else left over is rebuilt below
+        patient_ids = list(Patient.objects.order_by('pk').values_list('pk', flat=True))
+
+        for start in range(0, len(patient_ids), chunk_size):
+            chunk = patient_ids[start:start + chunk_size]
+            for model in SERIES:
+                refresh_balances(model, chunk)
+            self.stdout.write(f'Refreshed {min(start + chunk_size, len(patient_ids))}/{len(patient_ids)} patients')
+
+        self.stdout.write(self.style.SUCCESS(f'{PatientBalance.objects.count()} balance rows rebuilt'))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from mainapp.case_numbers import split_case_number
+from mainapp.models import DailySheet, Patient, PCList
+
+
+class Command(BaseCommand):
+    help = 'Fill case_series/case_seq/case_seq_length from case_number on Patient, DailySheet and PCList rows where they are out of date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows read and updated per transaction')
+
+    def handle(self, *args, **options):
+        for model in (Patient, DailySheet, PCList):
+            updated = self.rebuild(model, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'{model.__name__}: {updated} rows updated'))
+
+    def rebuild(self, model, batch_size):
+        """Walk the table in primary-key batches and rewrite only the rows whose parts changed"""
+        updated = 0
+        last_pk = 0
+        while True:
+            rows = list(
+                model.objects.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'case_number', 'case_series', 'case_seq', 'case_seq_length')[:batch_size]
+            )
+            if not rows:
+                return updated
+            stale = []
+            # bulk_update() skips auto_now; the archive snapshots find changed months by updated_at
+            now = timezone.now()
+            for pk, case_number, *stored in rows:
+                series, seq, length = split_case_number(case_number)
+                if (series, seq, length) != tuple(stored):
+                    stale.append(model(pk=pk, case_series=series, case_seq=seq, case_seq_length=length, updated_at=now))
+            with transaction.atomic():
+                model.objects.bulk_update(stale, ['case_series', 'case_seq', 'case_seq_length', 'updated_at'])
+            updated += len(stale)
+            last_pk = rows[-1][0]
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mainapp.search import fts_available, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Recreate the full-text search tables and triggers and refill them from Patient, DailySheet and PCList'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if not fts_available(connections[options['database']]):
+            raise CommandError('Full-text search needs SQLite with FTS5; lists fall back to icontains filters')
+        for table, rows in rebuild_search_index(options['database']).items():
+            self.stdout.write(self.style.SUCCESS(f'{table}: {rows} rows indexed'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cached dashboard counters from the database. Run it periodically (e.g. from cron, and just after midnight) to correct drift.'
+
+    def handle(self, *args, **options):
+        counts = reconcile_counters()
+        for name, value in counts.items():
+            self.stdout.write(f'{name}: {value}')
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mainapp.jobs import claim_next_job, expire_uploads, run_import_job
+from mainapp.statements import claim_statement_job, run_statement_job
+
+
+class Command(BaseCommand):
+    help = 'Run queued import and statement jobs, polling the database for new ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds to wait between polls when idle')
+        parser.add_argument('--once', action='store_true', help='Exit as soon as the queue is empty')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Waiting for jobs. Press Ctrl+C to stop.')
+        try:
+            while True:
+                job = claim_next_job()
+                if job is None:
+                    statement_job = claim_statement_job()
+                    if statement_job:
+                        self.run_statements(statement_job)
+                        continue
+                    expire_uploads()
+                    if options['once']:
+                        return
+                    time.sleep(options['interval'])
+                    continue
+
+                self.stdout.write(f'{job}: {job.original_name} from row {job.next_row}')
+                run_import_job(job)
+                style = self.style.SUCCESS if job.status == 'completed' else self.style.WARNING
+                self.stdout.write(style(
+                    f'{job}: {job.rows_processed} rows, {job.imported} imported, '
+                    f'{job.updated} updated, {job.error_count} errors. {job.message}'.rstrip()
+                ))
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
+
+    def run_statements(self, job):
+        self.stdout.write(f'{job}: writing statements')
+        run_statement_job(job)
+        style = self.style.SUCCESS if job.status == 'completed' else self.style.WARNING
+        self.stdout.write(style(f'{job}: {job.done} of {job.total} statements. {job.message}'.rstrip()))
@@ -1,12 +1,39 @@
-from django.db import models
+from django.db import models, transaction
 from user_management.models import User
 
+from .case_numbers import split_case_number
 
 
-	
-class Patient(models.Model):
+
+class AtomicWriteMixin:
+	"""Run save/delete together with their signal handlers in one transaction"""
+
+	def save(self, *args, **kwargs):
+		with transaction.atomic():
+			super().save(*args, **kwargs)
+
+	def delete(self, *args, **kwargs):
+		with transaction.atomic():
+			return super().delete(*args, **kwargs)
+
+
+class CaseNumberMixin:
+	"""Keep case_series/case_seq/case_seq_length in step with case_number on every save"""
+
+	def save(self, *args, **kwargs):
+		self.case_series, self.case_seq, self.case_seq_length = split_case_number(self.case_number)
+		update_fields = kwargs.get('update_fields')
+		if update_fields is not None and 'case_number' in update_fields:
+			kwargs['update_fields'] = {*update_fields, 'case_series', 'case_seq', 'case_seq_length'}
+		super().save(*args, **kwargs)
+
+
+class Patient(CaseNumberMixin, models.Model):
 	name = models.CharField(max_length=100, blank=True, null=True)
 	case_number = models.CharField(max_length=20, unique=True)
+	case_series = models.CharField(max_length=10, blank=True, default='', editable=False)
+	case_seq = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+	case_seq_length = models.PositiveSmallIntegerField(blank=True, null=True, editable=False)
 	age = models.CharField(max_length=50, blank=True, null=True)
 	gender = models.CharField(
 		max_length=10,
@@ -20,19 +47,27 @@ class Patient(models.Model):
 	contact = models.CharField(max_length=50, blank=True, null=True)
 	address = models.TextField(blank=True, null=True)
 	created_at = models.DateTimeField(auto_now_add=True)
+	updated_at = models.DateTimeField(auto_now=True)
 
 	def __str__(self):
 		return self.name or "Patient"
 
 	class Meta:
 		ordering = ['-created_at']
+		indexes = [
+			models.Index(fields=['created_at', 'id'], name='patient_created'),
+			models.Index(fields=['case_series', 'case_seq', 'case_seq_length'], name='patient_case_seq'),
+		]
 
 
-class DailySheet(models.Model):
+class DailySheet(CaseNumberMixin, AtomicWriteMixin, models.Model):
 	patient_id = models.ForeignKey(Patient, on_delete=models.CASCADE, blank=True, null=True)
 	date = models.DateField(blank=True, null=True,default="timezone.now", )
 	name = models.CharField(max_length=200,blank=True, null=True ,)
 	case_number = models.CharField(max_length=20,blank=True, null=True ,unique=False ,)
+	case_series = models.CharField(max_length=10, blank=True, default='', editable=False)
+	case_seq = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+	case_seq_length = models.PositiveSmallIntegerField(blank=True, null=True, editable=False)
 	diagnosis = models.TextField(blank=True, null=True,)
 	charge = models.DecimalField(max_digits=10, decimal_places=2,blank=True, null=True,)
 	received = models.DecimalField(max_digits=10, decimal_places=2,blank=True, null=True,)
@@ -55,11 +90,25 @@ class DailySheet(models.Model):
 	def __str__(self):
 		return f'{self.date}'
 
-class PCList(models.Model):
+	class Meta:
+		indexes = [
+			# Date filters and ordering; also covers the money totals of the summaries and dashboard
+			models.Index(fields=['date', 'payment_type', 'charge', 'received'], name='daily_sheet_date_totals'),
+			# Ledgers and balance refreshes
+			models.Index(fields=['patient_id', 'date', 'id'], name='daily_sheet_ledger'),
+			models.Index(fields=['payment_status', 'date'], name='daily_sheet_status_date'),
+			models.Index(fields=['created_at'], name='daily_sheet_created'),
+			models.Index(fields=['case_series', 'case_seq', 'case_seq_length'], name='daily_sheet_case_seq'),
+		]
+
+class PCList(CaseNumberMixin, AtomicWriteMixin, models.Model):
 	patient_id = models.ForeignKey(Patient, on_delete=models.CASCADE, blank=True, null=True)
 	date = models.DateField(blank=True, null=True,default="timezone.now", )
 	name = models.CharField(max_length=200,blank=True, null=True ,)
 	case_number = models.CharField(max_length=20,blank=True, null=True ,unique=False ,)
+	case_series = models.CharField(max_length=10, blank=True, default='', editable=False)
+	case_seq = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+	case_seq_length = models.PositiveSmallIntegerField(blank=True, null=True, editable=False)
 	diagnosis = models.TextField(blank=True, null=True,)
 	charge = models.DecimalField(max_digits=10, decimal_places=2,blank=True, null=True,)
 	received = models.DecimalField(max_digits=10, decimal_places=2,blank=True, null=True,)
@@ -81,4 +130,168 @@ class PCList(models.Model):
 	updated_at=models.DateTimeField(auto_now=True)
 	def __str__(self):
 		return f'{self.date}'
-	
+
+	class Meta:
+		indexes = [
+			# Date filters and ordering; also covers the money totals of the summaries and dashboard
+			models.Index(fields=['date', 'payment_type', 'charge', 'received'], name='pc_list_date_totals'),
+			# Ledgers and balance refreshes
+			models.Index(fields=['patient_id', 'date', 'id'], name='pc_list_ledger'),
+			models.Index(fields=['payment_status', 'date'], name='pc_list_status_date'),
+			models.Index(fields=['created_at'], name='pc_list_created'),
+			models.Index(fields=['case_series', 'case_seq', 'case_seq_length'], name='pc_list_case_seq'),
+		]
+
+
+SERIES_CHOICES = [('UM', 'UM'), ('PC', 'PC')]
+
+
+class PatientBalance(models.Model):
+	"""Running totals per patient and series, kept in step with DailySheet (UM) and PCList (PC)"""
+	patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='balances')
+	series = models.CharField(max_length=2, choices=SERIES_CHOICES)
+	total_charge = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	total_received = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	visit_count = models.PositiveIntegerField(default=0)
+	last_visit_date = models.DateField(blank=True, null=True)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['patient', 'series'], name='unique_patient_balance_series'),
+		]
+		indexes = [
+			models.Index(fields=['series', 'balance'], name='patient_balance_lookup'),
+		]
+
+	def __str__(self):
+		return f'{self.patient} {self.series}: {self.balance}'
+
+	@property
+	def pending(self):
+		return -self.balance if self.balance < 0 else 0
+
+	@property
+	def advance(self):
+		return self.balance if self.balance > 0 else 0
+
+
+class PeriodSnapshot(models.Model):
+	"""Frozen totals of one closed month; visits dated inside it can no longer change"""
+	series = models.CharField(max_length=2, choices=SERIES_CHOICES)
+	month = models.DateField(help_text='First day of the closed month')
+	charge = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	received = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	opening = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	closing = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	visit_count = models.PositiveIntegerField(default=0)
+	closed_at = models.DateTimeField(auto_now_add=True)
+	closed_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+
+	class Meta:
+		ordering = ['series', 'month']
+		constraints = [
+			models.UniqueConstraint(fields=['series', 'month'], name='unique_period_snapshot'),
+		]
+
+	def __str__(self):
+		return f'{self.series} {self.month:%Y-%m}'
+
+
+
+class ImportJob(models.Model):
+	"""An uploaded spreadsheet imported in the background by the run_worker command"""
+	KIND_CHOICES = [
+		('patients', 'Patients'),
+		('daily_sheet', 'Daily Sheet'),
+		('pc_list', 'PC List'),
+	]
+	STATUS_CHOICES = [
+		('pending', 'Pending'),
+		('running', 'Running'),
+		('completed', 'Completed'),
+		('failed', 'Failed'),
+		('cancelled', 'Cancelled'),
+	]
+
+	kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+	file = models.FileField(upload_to='imports/')
+	original_name = models.CharField(max_length=255, blank=True)
+	all_sheets = models.BooleanField(default=False, help_text='Import every sheet of the workbook, or every file of a zip, in one batch')
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+	cancel_requested = models.BooleanField(default=False)
+	total_rows = models.PositiveIntegerField(blank=True, null=True)
+	next_row = models.PositiveIntegerField(default=2, help_text='First spreadsheet row not yet committed')
+	rows_processed = models.PositiveIntegerField(default=0)
+	imported = models.PositiveIntegerField(default=0)
+	updated = models.PositiveIntegerField(default=0)
+	error_count = models.PositiveIntegerField(default=0)
+	report_name = models.CharField(max_length=64, blank=True, null=True)
+	message = models.TextField(blank=True)
+	summary = models.JSONField(blank=True, null=True, help_text='Per-sheet results and timings of a batch import')
+	created_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	started_at = models.DateTimeField(blank=True, null=True)
+	heartbeat_at = models.DateTimeField(blank=True, null=True)
+	finished_at = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		ordering = ['-created_at']
+		indexes = [
+			models.Index(fields=['status', 'created_at'], name='import_job_queue'),
+		]
+
+	def __str__(self):
+		return f'{self.get_kind_display()} import #{self.pk} ({self.status})'
+
+	@property
+	def is_finished(self):
+		return self.status in ('completed', 'failed', 'cancelled')
+
+	@property
+	def percent(self):
+		if self.status == 'completed':
+			return 100
+		if not self.total_rows:
+			return 0
+		return min(100, round(self.rows_processed * 100 / self.total_rows))
+
+
+class StatementJob(models.Model):
+	"""A zip of PDF billing statements for every patient with an outstanding balance in one series"""
+	STATUS_CHOICES = ImportJob.STATUS_CHOICES
+
+	series = models.CharField(max_length=2, choices=SERIES_CHOICES)
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+	cancel_requested = models.BooleanField(default=False)
+	total = models.PositiveIntegerField(blank=True, null=True, help_text='Patients to write a statement for')
+	done = models.PositiveIntegerField(default=0)
+	archive = models.FileField(upload_to='statements/', blank=True)
+	message = models.TextField(blank=True)
+	created_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	started_at = models.DateTimeField(blank=True, null=True)
+	heartbeat_at = models.DateTimeField(blank=True, null=True)
+	finished_at = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		ordering = ['-created_at']
+		indexes = [
+			models.Index(fields=['status', 'created_at'], name='statement_job_queue'),
+		]
+
+	def __str__(self):
+		return f'{self.series} statements #{self.pk} ({self.status})'
+
+	@property
+	def is_finished(self):
+		return self.status in ('completed', 'failed', 'cancelled')
+
+	@property
+	def percent(self):
+		if self.status == 'completed':
+			return 100
+		if not self.total:
+			return 0
+		return min(100, round(self.done * 100 / self.total))
@@ -0,0 +1,127 @@
+"""
+Payment dashboard figures for both series.
+
+Each visit table is read with one conditional-aggregation query that
+returns charge and received for every period (today, this week, this
+month, an optional custom range) and payment type at once. Closed months
+come from their PeriodSnapshot totals. The result is cached and the cache
+is invalidated whenever a visit row changes.
+"""
+import hashlib
+import uuid
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.core.cache import cache
+from django.db.models import Max, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .balances import MONEY, SERIES, ZERO
+from .models import PeriodSnapshot
+from .reports import month_end
+
+
+DASHBOARD_CACHE_TIMEOUT = 60 * 60
+VERSION_KEY = 'payments:version'
+
+PAYMENT_TYPES = ['qr', 'cash']
+
+
+def invalidate_dashboard():
+    """Retire every cached dashboard; called whenever a visit row changes"""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def dashboard_periods(custom_start=None, custom_end=None):
+    """Named (start, end) date ranges shown on the dashboard"""
+    today = timezone.localdate()
+    week_start = today - timedelta(days=today.weekday())
+    periods = {
+        'today': (today, today),
+        'week': (week_start, week_start + timedelta(days=6)),
+        'month': (today.replace(day=1), month_end(today)),
+    }
+    if custom_start and custom_end:
+        periods['custom'] = (custom_start, custom_end)
+    return periods
+
+
+def summarize(charge, received):
+    balance = received - charge
+    return {
+        'charge': charge,
+        'received': received,
+        'pending': -balance if balance < 0 else 0,
+        'advance': balance if balance > 0 else 0,
+    }
+
+
+def money_sum(field, condition):
+    return Coalesce(Sum(field, filter=condition), ZERO, output_field=MONEY)
+
+
+def series_breakdown(model, periods):
+    """All-time and per-period figures of one visit table, from a single aggregate query"""
+    frozen = PeriodSnapshot.objects.filter(series=SERIES[model]).aggregate(
+        month=Max('month'),
+        charge=Coalesce(Sum('charge'), ZERO, output_field=MONEY),
+        received=Coalesce(Sum('received'), ZERO, output_field=MONEY),
+    )
+    live = Q()
+    if frozen['month']:
+        live = Q(date__gt=month_end(frozen['month'])) | Q(date__isnull=True)
+
+    aggregates = {
+        'all_charge': money_sum('charge', live),
+        'all_received': money_sum('received', live),
+    }
+    conditions = [live]
+    for name, (start, end) in periods.items():
+        in_period = Q(date__range=(start, end))
+        conditions.append(in_period)
+        aggregates[f'{name}_charge'] = money_sum('charge', in_period)
+        aggregates[f'{name}_received'] = money_sum('received', in_period)
+        for payment_type in PAYMENT_TYPES:
+            by_type = in_period & Q(payment_type=payment_type)
+            aggregates[f'{name}_{payment_type}_charge'] = money_sum('charge', by_type)
+            aggregates[f'{name}_{payment_type}_received'] = money_sum('received', by_type)
+
+    queryset = model.objects.all()
+    if frozen['month']:
+        # Only the open period and the requested ranges need scanning
+        queryset = queryset.filter(reduce(or_, conditions))
+    row = queryset.aggregate(**aggregates)
+
+    result = {
+        'all': summarize(frozen['charge'] + row['all_charge'], frozen['received'] + row['all_received']),
+    }
+    for name in periods:
+        result[name] = summarize(row[f'{name}_charge'], row[f'{name}_received'])
+        for payment_type in PAYMENT_TYPES:
+            result[name][payment_type] = summarize(
+                row[f'{name}_{payment_type}_charge'], row[f'{name}_{payment_type}_received'],
+            )
+    return result
+
+
+def dashboard_data(custom_start=None, custom_end=None):
+    """Cached dashboard figures keyed by series (UM/PC), then period"""
+    periods = dashboard_periods(custom_start, custom_end)
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(VERSION_KEY, version, None)
+        version = cache.get(VERSION_KEY, version)
+
+    bounds = ';'.join(f'{name}={start}:{end}' for name, (start, end) in periods.items())
+    key = f"payments:{version}:{hashlib.md5(bounds.encode()).hexdigest()}"
+    data = cache.get(key)
+    if data is None:
+        data = {
+            'periods': {name: {'start': start, 'end': end} for name, (start, end) in periods.items()},
+            'series': {series: series_breakdown(model, periods) for model, series in SERIES.items()},
+        }
+        cache.set(key, data, DASHBOARD_CACHE_TIMEOUT)
+    return data
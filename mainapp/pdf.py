@@ -0,0 +1,104 @@
+"""
+A minimal PDF writer for generated documents such as billing statements.
+
+Only what the statements need: pages of text in the standard Helvetica
+fonts (which every PDF viewer has, so nothing is embedded), lines and grey
+boxes. Text is encoded as Windows-1252; characters outside it print as '?'.
+Positions are in points measured from the top-left corner of the page.
+"""
+import zlib
+
+
+A4 = (595, 842)
+
+# Helvetica advance widths (1/1000 em) of printable ASCII, from the font's
+# AFM metrics, for centring and right-aligning; bold text is measured the
+# same way, which is close enough for alignment
+HELVETICA_WIDTHS = dict(zip(
+    (chr(code) for code in range(32, 127)),
+    [
+        278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+        1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+        333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+        556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+    ],
+))
+DEFAULT_WIDTH = 556
+
+FONTS = {False: 'F1', True: 'F2'}
+
+
+def pdf_string(value):
+    text = str(value).encode('cp1252', errors='replace')
+    return b'(' + text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def text_width(value, size):
+    """Width of `value` in points in regular Helvetica"""
+    return sum(HELVETICA_WIDTHS.get(char, DEFAULT_WIDTH) for char in str(value)) * size / 1000
+
+
+class PdfCanvas:
+    """Pages drawn one after another, then written out with render()"""
+
+    def __init__(self, size=A4):
+        self.width, self.height = size
+        self.pages = []
+        self.new_page()
+
+    def new_page(self):
+        self.ops = []
+        self.pages.append(self.ops)
+
+    def text(self, x, top, value, size=10, bold=False, align='left'):
+        if align == 'right':
+            x -= text_width(value, size)
+        elif align == 'center':
+            x -= text_width(value, size) / 2
+        y = self.height - top
+        self.ops.append(b'BT /%s %g Tf %.2f %.2f Td %s Tj ET' % (
+            FONTS[bold].encode(), size, x, y, pdf_string(value),
+        ))
+
+    def line(self, x1, top1, x2, top2, width=0.5):
+        self.ops.append(b'%g w %.2f %.2f m %.2f %.2f l S' % (
+            width, x1, self.height - top1, x2, self.height - top2,
+        ))
+
+    def box(self, x, top, width, height, gray=0.9):
+        self.ops.append(b'%g g %.2f %.2f %.2f %.2f re f 0 g' % (
+            gray, x, self.height - top - height, width, height,
+        ))
+
+    def render(self):
+        """The document as PDF bytes"""
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            None,  # page tree, filled in once the page numbers are known
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+        ]
+        kids = []
+        for ops in self.pages:
+            content = zlib.compress(b'\n'.join(ops))
+            objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(content), content))
+            objects.append(
+                b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+                b'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>'
+                % (self.width, self.height, len(objects))
+            )
+            kids.append(b'%d 0 R' % len(objects))
+        objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), len(kids))
+
+        output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(len(output))
+            output += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+        xref = len(output)
+        output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+        return bytes(output)
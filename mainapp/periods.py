@@ -0,0 +1,92 @@
+"""
+Closing and reopening accounting periods.
+
+Closing a month freezes its totals into PeriodSnapshot rows. Months close in
+order, and every visit dated on or before the last closed day is locked
+until the period is explicitly reopened.
+"""
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .balances import SERIES
+from .models import PeriodSnapshot
+from .reports import balance_before, closed_through, month_end, period_totals
+
+
+class PeriodClosedError(ValidationError):
+    pass
+
+
+def check_period_open(model, *dates):
+    """Raise PeriodClosedError if any of the dates falls inside a closed period"""
+    closed = closed_through(SERIES[model])
+    if not closed:
+        return
+    for date in dates:
+        if date and date <= closed:
+            raise PeriodClosedError(
+                f"The books are closed through {closed:%d-%m-%Y}. Reopen the period before changing visits dated {date:%d-%m-%Y}."
+            )
+
+
+def check_patient_open(patient):
+    """Raise PeriodClosedError if deleting `patient` would delete visits in a closed period"""
+    for model, series in SERIES.items():
+        closed = closed_through(series)
+        if closed and model.objects.filter(patient_id=patient, date__lte=closed).exists():
+            raise PeriodClosedError(
+                f"{patient} has {series} visits in the period closed through {closed:%d-%m-%Y}. Reopen it before deleting the patient."
+            )
+
+
+def close_periods(model, through, user=None):
+    """Freeze every still-open month of a visit table up to and including the month of `through`
+
+    Returns the snapshots created, oldest first.
+    """
+    series = SERIES[model]
+    through = month_end(through)
+    if through >= timezone.localdate().replace(day=1):
+        raise ValidationError('Only months that have already ended can be closed.')
+
+    with transaction.atomic():
+        closed = closed_through(series)
+        if closed:
+            start = closed + timedelta(days=1)
+            opening = PeriodSnapshot.objects.get(series=series, month=closed.replace(day=1)).closing
+        else:
+            first_visit = model.objects.aggregate(d=Min('date'))['d']
+            start = first_visit.replace(day=1) if first_visit else through.replace(day=1)
+            opening = balance_before(model, start)
+        if start > through:
+            return []
+
+        totals = {row['bucket']: row for row in period_totals(model, 'month', start, through)}
+        snapshots = []
+        month = start
+        while month <= through:
+            row = totals.get(month, {'charge': 0, 'received': 0, 'visit_count': 0})
+            closing = opening + row['received'] - row['charge']
+            snapshots.append(PeriodSnapshot(
+                series=series,
+                month=month,
+                charge=row['charge'],
+                received=row['received'],
+                opening=opening,
+                closing=closing,
+                visit_count=row['visit_count'],
+                closed_by=user,
+            ))
+            opening = closing
+            month = month_end(month) + timedelta(days=1)
+        return PeriodSnapshot.objects.bulk_create(snapshots)
+
+
+def reopen_periods(model, month):
+    """Reopen the month of `month` and every later closed month; returns how many were reopened"""
+    deleted, _ = PeriodSnapshot.objects.filter(series=SERIES[model], month__gte=month.replace(day=1)).delete()
+    return deleted
@@ -0,0 +1,129 @@
+"""
+Period summaries for the accounts screens.
+
+Charge and received are summed per month in SQL (one row per bucket), and
+opening/closing balances are a running sum over those buckets. Months that
+have been closed (see periods.py) are read from their PeriodSnapshot rows,
+so only the open period is aggregated live.
+"""
+from datetime import timedelta
+
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce, TruncMonth, TruncYear
+
+from .balances import MONEY, SERIES, ZERO
+from .models import PeriodSnapshot
+
+
+PERIODS = {
+    'month': (TruncMonth, lambda d: d.strftime('%Y-%m')),
+    'year': (TruncYear, lambda d: d.year),
+}
+
+
+def month_end(month):
+    """Last day of the month that `month` falls in"""
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+def closed_through(series):
+    """Last day of the latest closed month of a series, or None if nothing is closed"""
+    month = PeriodSnapshot.objects.filter(series=series).aggregate(m=Max('month'))['m']
+    return month_end(month) if month else None
+
+
+def live_totals(model, start=None, end=None):
+    """Charge, received and net balance of the visits dated in [start, end]"""
+    queryset = model.objects.all()
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    totals = queryset.aggregate(
+        charge=Coalesce(Sum('charge'), ZERO, output_field=MONEY),
+        received=Coalesce(Sum('received'), ZERO, output_field=MONEY),
+    )
+    totals['balance'] = totals['received'] - totals['charge']
+    return totals
+
+
+def period_totals(model, period, start=None, end=None):
+    """Per-bucket charge, received and visit count, oldest bucket first"""
+    trunc, _ = PERIODS[period]
+    queryset = model.objects.filter(date__isnull=False)
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+
+    return list(queryset.annotate(bucket=trunc('date')).values('bucket').annotate(
+        charge=Coalesce(Sum('charge'), ZERO, output_field=MONEY),
+        received=Coalesce(Sum('received'), ZERO, output_field=MONEY),
+        visit_count=Count('id'),
+    ).order_by('bucket'))
+
+
+def balance_before(model, date):
+    """Net balance (received - charge) of every visit dated before `date`"""
+    closed = closed_through(SERIES[model])
+    if closed and closed < date:
+        last = PeriodSnapshot.objects.filter(series=SERIES[model]).order_by('-month').first()
+        return last.closing + live_totals(model, closed + timedelta(days=1), date - timedelta(days=1))['balance']
+    if closed:
+        month = PeriodSnapshot.objects.filter(series=SERIES[model], month=date.replace(day=1)).first()
+        if month is None:
+            # Closing starts at the earliest visit, so nothing precedes the first snapshot
+            return 0
+        return month.opening + live_totals(model, month.month, date - timedelta(days=1))['balance']
+    return live_totals(model, end=date - timedelta(days=1))['balance']
+
+
+def running_summary(buckets, period, opening=0):
+    """Turn bucket rows into the {label: {charge, received, opening, closing}} dict the templates render"""
+    _, label = PERIODS[period]
+    summary = {}
+    balance = opening
+    for bucket in buckets:
+        if not bucket['visit_count']:
+            continue
+        row = summary.setdefault(label(bucket['bucket']), {
+            'charge': 0, 'received': 0, 'opening': balance, 'closing': balance,
+        })
+        row['charge'] += bucket['charge']
+        row['received'] += bucket['received']
+        balance += bucket['received'] - bucket['charge']
+        row['closing'] = balance
+    return summary
+
+
+def period_summary(model, period, start=None, end=None):
+    """Monthly or yearly summary of one visit table, optionally limited to [start, end]
+
+    Closed months come whole from their snapshots, so with a closed period a
+    range starting mid-month reports that month in full.
+    """
+    series = SERIES[model]
+    closed = closed_through(series)
+    if not closed or (start and start > closed):
+        opening = balance_before(model, start) if start else 0
+        return running_summary(period_totals(model, period, start, end), period, opening)
+
+    snapshots = PeriodSnapshot.objects.filter(series=series).order_by('month')
+    if start:
+        snapshots = snapshots.filter(month__gte=start.replace(day=1))
+    if end:
+        snapshots = snapshots.filter(month__lte=end)
+    snapshots = list(snapshots)
+
+    buckets = [
+        {'bucket': s.month, 'charge': s.charge, 'received': s.received, 'visit_count': s.visit_count}
+        for s in snapshots
+    ]
+    live_start = closed + timedelta(days=1)
+    if not end or end >= live_start:
+        # Months, not years: the open period can start mid-year
+        buckets += period_totals(model, 'month', live_start, end)
+
+    opening = snapshots[0].opening if snapshots else balance_before(model, live_start)
+    return running_summary(buckets, period, opening)
+
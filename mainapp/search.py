@@ -0,0 +1,165 @@
+"""
+Full-text search over patients and visits with SQLite FTS5.
+
+Each searchable table has an external-content FTS5 table with the trigram
+tokenizer, so any substring of three or more characters is found through
+the index instead of a LIKE '%...%' scan. The FTS rowid is the row's
+primary key. Triggers on the source tables keep the index in sync, which
+also covers the bulk_create() and update() calls that never send model
+signals. The tables and triggers are created after every migrate, and the
+rebuild_search_index command refills them from the source tables.
+
+Shorter terms, and databases without FTS5, fall back to icontains.
+Case-number filters that look like a series, prefix or range lookup use
+the structured case-number columns instead (see case_numbers.py).
+"""
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .case_numbers import case_number_query
+from .models import DailySheet, Patient, PCList
+
+
+# Model -> (FTS table, indexed fields)
+SEARCH_TABLES = {
+    Patient: ('search_patient', ['name', 'case_number', 'contact', 'diagnosis', 'chief_complaint']),
+    DailySheet: ('search_daily_sheet', ['name', 'case_number', 'diagnosis']),
+    PCList: ('search_pc_list', ['name', 'case_number', 'diagnosis']),
+}
+
+# The trigram tokenizer cannot match anything shorter
+MIN_TERM_LENGTH = 3
+
+SEARCH_RESULTS = 20
+
+# Databases whose search tables are known to exist
+ready = set()
+
+
+def search_ddl(model):
+    """CREATE statements for the FTS table of `model` and the triggers that keep it in sync"""
+    table, fields = SEARCH_TABLES[model]
+    source = model._meta.db_table
+    pk = model._meta.pk.column
+    columns = ', '.join(fields)
+    new = ', '.join(f'new.{field}' for field in fields)
+    old = ', '.join(f'old.{field}' for field in fields)
+    insert = f'INSERT INTO {table}(rowid, {columns}) VALUES (new.{pk}, {new});'
+    delete = f"INSERT INTO {table}({table}, rowid, {columns}) VALUES ('delete', old.{pk}, {old});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+        f"{columns}, content='{source}', content_rowid='{pk}', tokenize='trigram')",
+        f'CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {source} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {source} BEGIN {delete} END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE OF {columns} ON {source} '
+        f'BEGIN {delete} {insert} END',
+    ]
+
+
+def fts_available(conn):
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def create_search_tables(using='default'):
+    """Create any missing FTS table and trigger; new tables are filled from their source table"""
+    conn = connections[using]
+    if not fts_available(conn):
+        return []
+    existing = set(conn.introspection.table_names())
+    created = []
+    with conn.cursor() as cursor:
+        for model, (table, fields) in SEARCH_TABLES.items():
+            # Django rebuilds a SQLite table to alter it, which drops its triggers
+            for statement in search_ddl(model):
+                cursor.execute(statement)
+            if table not in existing:
+                cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+                created.append(table)
+    ready.add(using)
+    return created
+
+
+def search_ready(using='default'):
+    """True if the FTS tables exist; checked against the schema once per process"""
+    if using not in ready:
+        conn = connections[using]
+        tables = {table for table, fields in SEARCH_TABLES.values()}
+        if conn.vendor == 'sqlite' and tables <= set(conn.introspection.table_names()):
+            ready.add(using)
+    return using in ready
+
+
+def match_expression(term, field=None):
+    """FTS5 query for `term` as a substring, optionally of a single column"""
+    phrase = '"' + term.replace('"', '""') + '"'
+    return f'{field} : {phrase}' if field else phrase
+
+
+def search_filter(queryset, term, field=None):
+    """
+    Rows of `queryset` containing `term` in `field`, or in any indexed field;
+    the same rows as icontains, found through the FTS index when possible
+    """
+    term = term.strip()
+    table, fields = SEARCH_TABLES[queryset.model]
+    if len(term) >= MIN_TERM_LENGTH and search_ready(queryset.db):
+        matches = RawSQL(f'SELECT rowid FROM {table} WHERE {table} MATCH %s', (match_expression(term, field),))
+        return queryset.filter(pk__in=matches)
+
+    condition = Q()
+    for name in [field] if field else fields:
+        condition |= Q(**{f'{name}__icontains': term})
+    return queryset.filter(condition)
+
+
+def case_number_filter(queryset, term):
+    """
+    Rows of `queryset` matching a case-number filter: series, prefix, range
+    and exact lookups use the case_series/case_seq index, anything else is
+    a substring search
+    """
+    condition = case_number_query(term)
+    if condition is None:
+        return search_filter(queryset, term, 'case_number')
+    return queryset.filter(condition)
+
+
+def ranked_ids(table, term, limit):
+    """Primary keys of the best FTS5 (bm25) matches for `term`"""
+    with connections['default'].cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid FROM {table} WHERE {table} MATCH %s ORDER BY rank LIMIT %s',
+            [match_expression(term), limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def global_search(term, limit=SEARCH_RESULTS):
+    """{model: [rows]} of the best matches for `term` in every searchable table"""
+    term = term.strip()
+    results = {}
+    for model, (table, fields) in SEARCH_TABLES.items():
+        if len(term) >= MIN_TERM_LENGTH and search_ready():
+            ranked = ranked_ids(table, term, limit)
+            found = model.objects.in_bulk(ranked)
+            results[model] = [found[pk] for pk in ranked if pk in found]
+        else:
+            results[model] = list(search_filter(model.objects.all(), term).order_by('-pk')[:limit])
+    return results
+
+
+def rebuild_search_index(using='default'):
+    """Refill every FTS table from its source table; returns {table: rows indexed}"""
+    create_search_tables(using)
+    counts = {}
+    with connections[using].cursor() as cursor:
+        for model, (table, fields) in SEARCH_TABLES.items():
+            cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+            counts[table] = model.objects.using(using).count()
+    return counts
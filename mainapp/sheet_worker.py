@@ -0,0 +1,60 @@
+"""
+Sheet parsing for the worker processes of a batch import.
+
+Workers are started fresh (spawned, not forked), so they share no database
+connection with the parent. This module is what they import first, before
+Django is set up, which is why everything that touches the app is imported
+inside the functions. Workers only read files; they never query the database.
+"""
+import io
+import os
+import time
+import zipfile
+
+
+def init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def open_source(path, member):
+    """The uploaded file itself, or one member of an uploaded zip"""
+    if member is None:
+        return open(path, 'rb')
+    with zipfile.ZipFile(path) as archive:
+        return io.BytesIO(archive.read(member))
+
+
+def parse_sheet(path, member, sheet, model_label, closed):
+    """Read and validate one sheet
+
+    Returns a dict with the valid `records` and the `errors` of the sheet
+    (both DataFrames, as from prepare_visits), its row count and timing, or
+    a `message` saying why the sheet could not be read at all.
+    """
+    import pandas as pd
+    from django.apps import apps
+    from .importers import ImportFileError, prepare_visits, read_chunks, visit_column
+
+    model = apps.get_model(model_label)
+    started = time.perf_counter()
+    outcome = {'records': None, 'errors': None, 'rows': 0, 'message': '', 'pid': os.getpid()}
+    records, errors = [], []
+    try:
+        with open_source(path, member) as file:
+            for df in read_chunks(file, visit_column, sheet=sheet):
+                valid, invalid = prepare_visits(model, df, closed)
+                records.append(valid)
+                errors.append(invalid)
+                outcome['rows'] += len(df)
+    except ImportFileError as error:
+        outcome['message'] = str(error)
+    except Exception as error:
+        outcome['message'] = f'Could not read the sheet: {error}'
+    else:
+        if records:
+            outcome['records'] = pd.concat(records)
+            outcome['errors'] = pd.concat(errors, ignore_index=True)
+    outcome['seconds'] = time.perf_counter() - started
+    return outcome
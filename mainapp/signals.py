@@ -0,0 +1,88 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import counters
+from .balances import refresh_balances
+from .models import DailySheet, Patient, PCList
+from .payments import invalidate_dashboard
+from .periods import check_period_open
+from .search import create_search_tables
+
+
+VISIT_MODELS = (DailySheet, PCList)
+
+# Visit fields the dashboard counters depend on, in visit_counts() order
+COUNTER_FIELDS = ('date', 'in_time', 'out_time', 'received')
+
+
+def visits_changed(model, patient_ids):
+    """Hook for bulk paths (imports, backfills) that bypass model signals"""
+    refresh_balances(model, patient_ids)
+    transaction.on_commit(invalidate_dashboard)
+    transaction.on_commit(counters.invalidate_counters)
+
+
+def counter_state(instance):
+    return tuple(getattr(instance, field) for field in COUNTER_FIELDS)
+
+
+@receiver(pre_save, sender=DailySheet)
+@receiver(pre_save, sender=PCList)
+def before_visit_save(sender, instance, **kwargs):
+    # A visit moved to another patient must refresh both balances
+    instance._previous_patient_id = None
+    instance._previous_state = None
+    if instance.pk and not kwargs.get('raw'):
+        previous = sender.objects.filter(pk=instance.pk).values_list('patient_id', *COUNTER_FIELDS).first()
+        if previous:
+            instance._previous_patient_id = previous[0]
+            instance._previous_state = previous[1:]
+    previous_date = instance._previous_state[0] if instance._previous_state else None
+    check_period_open(sender, instance.date, previous_date)
+
+
+@receiver(post_save, sender=DailySheet)
+@receiver(post_save, sender=PCList)
+def visit_saved(sender, instance, **kwargs):
+    refresh_balances(sender, {instance.patient_id_id, getattr(instance, '_previous_patient_id', None)})
+    # A dashboard read before the commit would otherwise be cached under the new version
+    transaction.on_commit(invalidate_dashboard)
+    # Counters only move once the change is committed; a rolled-back save leaves them alone
+    transaction.on_commit(partial(
+        counters.visit_changed, sender, getattr(instance, '_previous_state', None), counter_state(instance),
+    ))
+
+
+@receiver(pre_delete, sender=DailySheet)
+@receiver(pre_delete, sender=PCList)
+def before_visit_delete(sender, instance, **kwargs):
+    check_period_open(sender, instance.date)
+
+
+@receiver(post_delete, sender=DailySheet)
+@receiver(post_delete, sender=PCList)
+def visit_deleted(sender, instance, **kwargs):
+    refresh_balances(sender, {instance.patient_id_id})
+    transaction.on_commit(invalidate_dashboard)
+    transaction.on_commit(partial(counters.visit_changed, sender, counter_state(instance), None))
+
+
+@receiver(post_save, sender=Patient)
+def patient_saved(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(partial(counters.bump, {'patients_total': 1, 'patients_today': 1}))
+
+
+@receiver(post_delete, sender=Patient)
+def patient_deleted(sender, instance, **kwargs):
+    created_today = timezone.localtime(instance.created_at).date() == timezone.localdate()
+    transaction.on_commit(partial(counters.bump, {'patients_total': -1, 'patients_today': -1 if created_today else 0}))
+
+
+def create_search_index(sender, using='default', **kwargs):
+    """post_migrate: (re)create the FTS search tables and their triggers"""
+    create_search_tables(using)
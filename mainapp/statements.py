@@ -0,0 +1,237 @@
+"""
+Month-end billing statements as a background job.
+
+A StatementJob covers every patient who owes money in one series. The
+run_worker command claims it and works through the patients in batches:
+the ledgers of a whole batch are read with one query, then the PDFs are
+drawn in a pool of worker processes and written into a zip as they come
+back. Progress is saved after every batch. A cancelled or failed job
+leaves no partial zip behind and starts over when it is queued again.
+"""
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import uuid
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .balances import SERIES, pending_patients
+from .batches import BATCH_WORKERS
+from .jobs import claimable
+from .ledger import running_ledger
+from .models import StatementJob
+from .pdf import PdfCanvas
+from .sheet_worker import init_worker
+
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_DIR = 'statements'
+
+# Patients whose ledgers are read in one query and handed to the pool together
+STATEMENT_BATCH_SIZE = 500
+
+# Statements sent to a worker process at a time
+POOL_CHUNK_SIZE = 25
+
+SERIES_MODELS = {series: model for model, series in SERIES.items()}
+
+SERIES_TITLES = {
+    'UM': 'Unique Physio Care',
+    'PC': 'Unique Physio Care - PC',
+}
+
+
+class StatementsCancelled(Exception):
+    pass
+
+
+def create_statement_job(series, user=None):
+    return StatementJob.objects.create(series=series, created_by=user)
+
+
+def claim_statement_job():
+    """The oldest pending (or abandoned) statement job, claimed for this worker"""
+    now = timezone.now()
+    for pk in StatementJob.objects.filter(claimable(now)).order_by('created_at').values_list('pk', flat=True)[:10]:
+        if StatementJob.objects.filter(claimable(now), pk=pk).update(status='running', heartbeat_at=now):
+            return StatementJob.objects.get(pk=pk)
+    return None
+
+
+def statement_patients(model):
+    """Patients who owe money in the series of `model`, as plain dicts in case-number order"""
+    return list(
+        pending_patients(model, 'case_number').values(
+            'patient_id',
+            'balance',
+            name=F('patient__name'),
+            case_number=F('patient__case_number'),
+            contact=F('patient__contact'),
+        )
+    )
+
+
+def prefetch_ledgers(model, patient_ids):
+    """{patient id: [(date, case_number, charge, received), ...]} for the whole batch in one query"""
+    ledgers = defaultdict(list)
+    rows = model.objects.filter(patient_id__in=patient_ids).order_by('patient_id', 'date', 'id').values_list(
+        'patient_id', 'date', 'case_number', 'charge', 'received',
+    )
+    for patient_id, *row in rows.iterator(chunk_size=2000):
+        ledgers[patient_id].append(tuple(row))
+    return ledgers
+
+
+def statement_filename(patient):
+    name = re.sub(r'\W+', '_', patient['name'] or '').strip('_')
+    case_number = re.sub(r'[^A-Za-z0-9-]+', '_', patient['case_number'] or str(patient['patient_id']))
+    return f"{case_number}_{name or 'patient'}.pdf"
+
+
+def money(value):
+    return f'{value:,.2f}'
+
+
+def render_statement(statement):
+    """(zip member name, PDF bytes) of one patient's statement; runs in a worker process"""
+    patient = statement['patient']
+    entries, balance = running_ledger(statement['rows'])
+    pdf = PdfCanvas()
+    left, right = 50, pdf.width - 50
+    columns = [(left, 'Date', 'left'), (150, 'Case Number', 'left'), (370, 'Charge', 'right'),
+               (450, 'Received', 'right'), (right, 'Balance', 'right')]
+
+    def table_header(top):
+        pdf.box(left - 5, top - 12, right - left + 10, 18)
+        for x, title, align in columns:
+            pdf.text(x, top, title, size=10, bold=True, align=align)
+        return top + 20
+
+    pdf.text(pdf.width / 2, 60, SERIES_TITLES[statement['series']], size=18, bold=True, align='center')
+    pdf.text(pdf.width / 2, 82, 'STATEMENT OF ACCOUNT', size=12, align='center')
+    pdf.line(left, 95, right, 95)
+    pdf.text(left, 120, f"Name: {patient['name'] or ''}", size=11)
+    pdf.text(left, 137, f"Case Number: {patient['case_number'] or ''}", size=11)
+    pdf.text(left, 154, f"Contact: {patient['contact'] or ''}", size=11)
+    pdf.text(right, 120, f"Date: {statement['generated']:%d/%m/%Y}", size=11, align='right')
+
+    top = table_header(190)
+    for entry in entries:
+        if top > pdf.height - 90:
+            pdf.new_page()
+            top = table_header(60)
+        pdf.text(columns[0][0], top, f"{entry['date']:%d/%m/%Y}" if entry['date'] else '-')
+        pdf.text(columns[1][0], top, entry['case_number'] or '')
+        pdf.text(columns[2][0], top, money(entry['charge']), align='right')
+        pdf.text(columns[3][0], top, money(entry['received']), align='right')
+        pdf.text(columns[4][0], top, money(entry['balance']), align='right')
+        top += 16
+
+    if top > pdf.height - 120:
+        pdf.new_page()
+        top = 60
+    pdf.line(left, top - 8, right, top - 8)
+    pdf.text(columns[2][0], top + 8, money(sum(entry['charge'] for entry in entries)), bold=True, align='right')
+    pdf.text(columns[3][0], top + 8, money(sum(entry['received'] for entry in entries)), bold=True, align='right')
+    pdf.text(left, top + 8, 'Total', bold=True)
+    label = 'Amount due' if balance < 0 else 'Advance'
+    pdf.text(right, top + 36, f'{label}: Rs. {money(abs(balance))}', size=13, bold=True, align='right')
+    pdf.text(pdf.width / 2, pdf.height - 40, 'Unique Physio Care', size=8, align='center')
+    return statement_filename(patient), pdf.render()
+
+
+def cancel_requested(job):
+    return StatementJob.objects.filter(pk=job.pk, cancel_requested=True).exists()
+
+
+def finish_job(job, status, message=''):
+    job.status = status
+    job.message = message
+    job.cancel_requested = False
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'message', 'cancel_requested', 'finished_at', 'archive', 'total', 'done'])
+
+
+def write_statements(job, model, archive):
+    """Add every statement of the job to the open zip, saving progress after each batch"""
+    patients = statement_patients(model)
+    job.total = len(patients)
+    job.done = 0
+    job.save(update_fields=['total', 'done'])
+    generated = timezone.localdate()
+
+    pool = ProcessPoolExecutor(
+        max_workers=BATCH_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(settings.SETTINGS_MODULE,),
+    )
+    try:
+        for start in range(0, len(patients), STATEMENT_BATCH_SIZE):
+            if cancel_requested(job):
+                raise StatementsCancelled
+            batch = patients[start:start + STATEMENT_BATCH_SIZE]
+            ledgers = prefetch_ledgers(model, [patient['patient_id'] for patient in batch])
+            statements = [
+                {'patient': patient, 'rows': ledgers[patient['patient_id']],
+                 'series': job.series, 'generated': generated}
+                for patient in batch
+            ]
+            for name, data in pool.map(render_statement, statements, chunksize=POOL_CHUNK_SIZE):
+                archive.writestr(name, data)
+
+            job.done += len(batch)
+            job.heartbeat_at = timezone.now()
+            job.save(update_fields=['done', 'heartbeat_at'])
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def download_name(job):
+    """File name a statement zip is downloaded under"""
+    return f'statements_{job.series}_{timezone.localtime(job.started_at):%Y%m%d_%H%M%S}.zip'
+
+
+def run_statement_job(job):
+    """Write the statements of a claimed job into a zip under MEDIA_ROOT/statements"""
+    model = SERIES_MODELS[job.series]
+    directory = os.path.join(settings.MEDIA_ROOT, STATEMENT_DIR)
+    os.makedirs(directory, exist_ok=True)
+    # MEDIA_ROOT is served without a login in DEBUG, so the name on disk must not be guessable
+    name = f'{uuid.uuid4().hex}.zip'
+
+    job.started_at = timezone.now()
+    job.save(update_fields=['started_at'])
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            write_statements(job, model, archive)
+        os.replace(temp_path, os.path.join(directory, name))
+    except StatementsCancelled:
+        os.remove(temp_path)
+        finish_job(job, 'cancelled', 'Cancelled. No statements were kept.')
+    except Exception as error:
+        os.remove(temp_path)
+        logger.exception('Statement job %s failed', job.pk)
+        finish_job(job, 'failed', f'Error writing statements: {error}')
+    else:
+        job.archive.name = f'{STATEMENT_DIR}/{name}'
+        finish_job(job, 'completed', '' if job.total else 'No patient has an outstanding balance.')
+    return job
+
+
+def cancel_statement_job(job):
+    """Cancel a pending job at once, or ask a running one to stop after its current batch"""
+    now = timezone.now()
+    if StatementJob.objects.filter(pk=job.pk, status='pending').update(status='cancelled', finished_at=now):
+        return True
+    return bool(StatementJob.objects.filter(pk=job.pk, status='running').update(cancel_requested=True))
@@ -1,3 +1,561 @@
-from django.test import TestCase
+import io
+import os
+import re
+import tempfile
+from datetime import timedelta
+from unittest import skipUnless
 
-# Create your tests here.
+import pandas as pd
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .archive import snapshot_table
+from .balances import SERIES, advance_patients, patient_balance, pending_patients, refresh_balances
+from .case_numbers import split_case_number
+from .counters import compute_counters, dashboard_counters, reconcile_counters
+from .exports import VISIT_EXPORT_COLUMNS, export_columns, export_rows, filter_by_period
+from .forms import DailySheetFilterForm, PatientFilterForm, PatientForm, PCListFilterForm
+from .importers import case_number_parts
+from .jobs import (
+    BATCH_MAX_RUNTIME, STALE_AFTER, UPLOAD_RETENTION, claim_next_job, create_import_job, expire_uploads, finish_job,
+    resume_job,
+)
+from .ledger import encode_cursor as ledger_cursor, ledger_page
+from .listing import encode_cursor as patient_cursor, patient_page, recent_window, visit_day_page
+from .management.commands.benchmark import seed_patients
+from .models import DailySheet, ImportJob, Patient, PatientBalance, PCList
+from .periods import PeriodClosedError, close_periods, reopen_periods
+from .payments import VERSION_KEY, dashboard_periods, series_breakdown
+from .reports import period_summary
+from .search import SEARCH_TABLES, case_number_filter, global_search, ranked_ids, search_filter, search_ready
+from .signals import visits_changed
+from .statements import claim_statement_job, create_statement_job, run_statement_job
+from .statements import prefetch_ledgers
+from .views import filter_patients, filter_visit_list
+from user_management.models import Function, Role, User
+
+# Keep the tests away from the file cache of the development server
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CaseNumberLookupTests(TestCase):
+    """Case-number filters on mixed-width numbers, where UM12 and UM0012 are different cases"""
+
+    CASE_NUMBERS = ['UM12', 'UM0012', 'UM0150', 'UM1200', 'UM120', 'PC0012', 'um-0099']
+
+    @classmethod
+    def setUpTestData(cls):
+        for case_number in cls.CASE_NUMBERS:
+            Patient.objects.create(name=f'Patient {case_number}', case_number=case_number)
+            DailySheet.objects.create(name=f'Patient {case_number}', case_number=case_number, date=timezone.localdate())
+
+    def found(self, term, model=Patient):
+        return sorted(case_number_filter(model.objects.all(), term).values_list('case_number', flat=True))
+
+    def test_split_keeps_the_digit_count(self):
+        self.assertEqual(split_case_number('UM0012'), ('UM', 12, 4))
+        self.assertEqual(split_case_number('um-0099'), ('UM', 99, 4))
+        self.assertEqual(split_case_number('UM'), ('UM', None, None))
+        self.assertEqual(split_case_number(None), ('', None, None))
+
+    def test_save_fills_the_structured_columns(self):
+        patient = Patient.objects.get(case_number='UM0012')
+        self.assertEqual((patient.case_series, patient.case_seq, patient.case_seq_length), ('UM', 12, 4))
+
+    def test_prefix_matches_the_digits_as_written(self):
+        self.assertEqual(self.found('UM001'), ['UM0012'])
+        self.assertEqual(self.found('UM0012'), ['UM0012'])
+        self.assertEqual(self.found('UM12'), ['UM12', 'UM120', 'UM1200'])
+        self.assertEqual(self.found('UM01'), ['UM0150'])
+        self.assertEqual(self.found('UM00'), ['UM0012', 'um-0099'])
+        self.assertEqual(self.found('UM 12', DailySheet), ['UM12', 'UM120', 'UM1200'])
+
+    def test_numbers_longer_than_a_lookup_are_a_substring_search(self):
+        self.assertEqual(self.found('UM1234567890'), [])
+        self.assertEqual(self.found('=UM1234567890'), [])
+        self.assertEqual(self.found('UM1-UM1234567890'), [])
+        Patient.objects.create(name='Long', case_number='UM12345678901')
+        self.assertEqual(self.found('UM1234567890'), ['UM12345678901'])
+
+    def test_exact_lookup_does_not_collide_on_leading_zeros(self):
+        self.assertEqual(self.found('=UM12'), ['UM12'])
+        self.assertEqual(self.found('=UM0012'), ['UM0012'])
+        self.assertEqual(self.found('=UM012'), [])
+
+    def test_range_compares_numbers(self):
+        self.assertEqual(self.found('UM100-UM200'), ['UM0150', 'UM120'])
+        self.assertEqual(self.found('UM1300..1200'), ['UM1200'])
+        self.assertEqual(self.found('UM10-PC20'), [])
+
+    def test_series_lookup(self):
+        self.assertEqual(self.found('PC'), ['PC0012'])
+        self.assertEqual(self.found('um'), ['UM0012', 'UM0150', 'UM12', 'UM120', 'UM1200', 'um-0099'])
+
+    def test_other_terms_are_a_substring_search(self):
+        self.assertEqual(self.found('M001'), ['UM0012'])
+        self.assertEqual(self.found('0012'), ['PC0012', 'UM0012'])
+        self.assertEqual(self.found('XY12'), [])
+        self.assertEqual(self.found('-00'), ['um-0099'])
+
+    def test_importers_split_like_save(self):
+        values = ['UM0012', 'PC-7', 'um12', 'UM', None]
+        parts = pd.DataFrame(case_number_parts(pd.Series(values, dtype=object)))
+        parts = parts.astype(object).where(parts.notna(), None)
+        expected = [split_case_number(value) for value in values]
+        self.assertEqual(list(parts.itertuples(index=False, name=None)), expected)
+
+
+class PatientFormCaseNumberTests(TestCase):
+
+    def form(self, case_number):
+        return PatientForm({'name': 'Test', 'case_number': case_number})
+
+    def test_series_must_be_in_capitals(self):
+        self.assertTrue(self.form('UM123').is_valid())
+        self.assertTrue(self.form('PC-9').is_valid())
+        self.assertFalse(self.form('um123').is_valid())
+        self.assertFalse(self.form('XY123').is_valid())
+
+    def test_update_uses_the_same_check(self):
+        patient = Patient.objects.create(name='Test', case_number='UM1')
+        form = PatientForm({'name': 'Test', 'case_number': 'um1'}, instance=patient)
+        self.assertFalse(form.is_valid())
+        self.assertIn('case_number', form.errors)
+
+
+class StaleJobTests(TestCase):
+
+    def running_job(self, **fields):
+        fields.setdefault('heartbeat_at', timezone.now() - STALE_AFTER * 3)
+        return ImportJob.objects.create(kind='daily_sheet', file='imports/test.xlsx', status='running', **fields)
+
+    def test_silent_job_is_taken_over(self):
+        job = self.running_job()
+        self.assertEqual(claim_next_job(), job)
+
+    def test_silent_batch_job_is_left_to_its_worker(self):
+        self.running_job(all_sheets=True)
+        self.assertIsNone(claim_next_job())
+
+    def test_batch_job_past_its_maximum_runtime_is_taken_over(self):
+        job = self.running_job(all_sheets=True, heartbeat_at=timezone.now() - BATCH_MAX_RUNTIME * 2)
+        self.assertEqual(claim_next_job(), job)
+
+
+class UploadStorageTests(TestCase):
+    """Uploads hold patient details, so they get a random name and do not outlive their job"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.job = create_import_job('patients', SimpleUploadedFile('patients.xlsx', b'data'))
+        self.path = self.job.file.path
+
+    def test_upload_is_saved_under_a_random_name(self):
+        self.assertNotIn('patients', self.job.file.name)
+        self.assertTrue(self.job.file.name.endswith('.xlsx'))
+        self.assertEqual(self.job.original_name, 'patients.xlsx')
+
+    def test_completed_job_deletes_its_upload(self):
+        finish_job(self.job, 'completed')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(ImportJob.objects.get(pk=self.job.pk).file.name, '')
+
+    def test_failed_upload_is_kept_for_resuming_until_it_expires(self):
+        finish_job(self.job, 'failed', 'Broken row')
+        expire_uploads()
+        self.assertTrue(os.path.exists(self.path))
+
+        ImportJob.objects.filter(pk=self.job.pk).update(finished_at=timezone.now() - UPLOAD_RETENTION * 2)
+        expire_uploads()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(resume_job(self.job))
+
+
+class ImportPermissionTests(TestCase):
+    """Import pages and their jobs and reports need the create permission of the job's kind"""
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admin@example.com', 'secret', first_name='Admin')
+        role = Role.objects.create(name='Front desk', created_by=admin)
+        role.permissions.add(Function.objects.create(function_name='dailysheet_create', created_by=admin))
+        self.user = User.objects.create_user('desk@example.com', 'secret', first_name='Desk', roles=role)
+        self.client.force_login(self.user)
+
+    def job(self, kind):
+        return ImportJob.objects.create(kind=kind, file='imports/test.xlsx', status='failed', report_name=f'{kind}.csv')
+
+    def test_upload_pages_need_the_kind_permission(self):
+        self.assertTemplateUsed(self.client.get(reverse('daily_sheet_import')), 'daily_sheet_import.html')
+        self.assertEqual(self.client.get(reverse('pc_list_import')).status_code, 404)
+        self.assertEqual(self.client.get(reverse('upload_excel')).status_code, 404)
+
+    def test_jobs_of_other_kinds_are_not_found(self):
+        allowed, hidden = self.job('daily_sheet'), self.job('patients')
+        self.assertEqual(self.client.get(reverse('import_job', args=[allowed.pk])).status_code, 200)
+        for name in ('import_job', 'import_job_progress', 'import_job_cancel', 'import_job_resume'):
+            self.assertEqual(self.client.post(reverse(name, args=[hidden.pk])).status_code, 404)
+        self.assertEqual(ImportJob.objects.get(pk=hidden.pk).status, 'failed')
+
+    def test_reports_of_other_kinds_are_not_found(self):
+        self.job('patients')
+        self.assertEqual(self.client.get(reverse('import_report', args=['patients.csv'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('import_report', args=['unknown.csv'])).status_code, 404)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Search tables are only built on SQLite')
+@override_settings(CACHES=TEST_CACHES)
+class SearchIndexTests(TestCase):
+    """The FTS tables follow every write through their triggers; short terms use icontains"""
+
+    def setUp(self):
+        if not search_ready():
+            self.skipTest('SQLite was built without FTS5')
+        self.patient = Patient.objects.create(name='Meenakshi Raman', case_number='UM41', diagnosis='Frozen shoulder')
+        self.table = SEARCH_TABLES[Patient][0]
+
+    def search(self, term, field=None):
+        with CaptureQueriesContext(connection) as queries:
+            found = list(search_filter(Patient.objects.all(), term, field))
+        self.used_index = any(self.table in query['sql'] for query in queries.captured_queries)
+        return found
+
+    def test_new_rows_are_found_through_the_index(self):
+        self.assertEqual(self.search('akshi'), [self.patient])
+        self.assertTrue(self.used_index)
+        self.assertEqual(self.search('shoulder', 'diagnosis'), [self.patient])
+        self.assertEqual(self.search('shoulder', 'name'), [])
+        self.assertEqual(global_search('frozen')[Patient], [self.patient])
+
+    def test_updates_leave_no_stale_matches(self):
+        self.patient.name = 'Lakshmi Iyer'
+        self.patient.save()
+        self.assertEqual(self.search('Meenakshi'), [])
+        self.assertEqual(self.search('Iyer'), [self.patient])
+
+        # update() sends no signals; the trigger still sees it
+        Patient.objects.filter(pk=self.patient.pk).update(diagnosis='Tennis elbow')
+        self.assertEqual(self.search('shoulder'), [])
+        self.assertEqual(self.search('elbow'), [self.patient])
+
+    def test_deleted_rows_leave_the_index(self):
+        self.patient.delete()
+        self.assertEqual(ranked_ids(self.table, 'Meenakshi', 10), [])
+        self.assertEqual(global_search('Meenakshi')[Patient], [])
+
+    def test_short_terms_fall_back_to_icontains(self):
+        self.assertEqual(self.search('ee'), [self.patient])
+        self.assertFalse(self.used_index)
+        self.assertEqual(self.search(' 41 ', 'case_number'), [self.patient])
+        self.assertEqual(self.search('zz'), [])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BalanceTests(TestCase):
+    """PatientBalance follows every visit write, per patient and series"""
+
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.alice = Patient.objects.create(name='Alice', case_number='UM1')
+        self.bob = Patient.objects.create(name='Bob', case_number='UM2')
+
+    def visit(self, patient, charge, received, model=DailySheet):
+        return model.objects.create(patient_id=patient, date=self.today, charge=charge, received=received)
+
+    def stored(self, patient, series='UM'):
+        return PatientBalance.objects.filter(patient=patient, series=series).values_list(
+            'total_charge', 'total_received', 'balance', 'visit_count',
+        ).first()
+
+    def test_saves_update_the_totals(self):
+        self.visit(self.alice, 400, 300)
+        self.visit(self.alice, 400, 600)
+        self.visit(self.alice, 100, 0, PCList)
+        self.assertEqual(self.stored(self.alice), (800, 900, 100, 2))
+        self.assertEqual(self.stored(self.alice, 'PC'), (100, 0, -100, 1))
+        self.assertEqual(patient_balance(self.alice, DailySheet), 100)
+        self.assertEqual(patient_balance(self.bob, DailySheet), 0)
+
+    def test_edit_delete_and_move(self):
+        visit = self.visit(self.alice, 400, 300)
+        visit.received = 400
+        visit.save()
+        self.assertEqual(self.stored(self.alice), (400, 400, 0, 1))
+
+        visit.patient_id = self.bob
+        visit.save()
+        self.assertIsNone(self.stored(self.alice))
+        self.assertEqual(self.stored(self.bob), (400, 400, 0, 1))
+
+        visit.delete()
+        self.assertIsNone(self.stored(self.bob))
+
+    def test_pending_and_advance_lists(self):
+        self.visit(self.alice, 400, 100)
+        self.visit(self.bob, 400, 500)
+        self.assertEqual([row.patient for row in pending_patients(DailySheet)], [self.alice])
+        self.assertEqual([row.pending for row in pending_patients(DailySheet)], [300])
+        self.assertEqual([row.patient for row in advance_patients(DailySheet)], [self.bob])
+
+    def test_bulk_writes_are_refreshed_by_visits_changed(self):
+        DailySheet.objects.bulk_create([
+            DailySheet(patient_id=self.alice, date=self.today, charge=400, received=0),
+            DailySheet(patient_id=self.alice, date=self.today, charge=400, received=0),
+        ])
+        self.assertIsNone(self.stored(self.alice))
+        visits_changed(DailySheet, [self.alice.pk])
+        self.assertEqual(self.stored(self.alice), (800, 0, -800, 2))
+
+    def test_rebuild_matches_the_visits(self):
+        self.visit(self.alice, 400, 100)
+        PatientBalance.objects.update(balance=0, total_received=0)
+        call_command('rebuild_balances', stdout=io.StringIO())
+        self.assertEqual(self.stored(self.alice), (400, 100, -300, 1))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DashboardInvalidationTests(TestCase):
+
+    def setUp(self):
+        cache.set(VERSION_KEY, 'before', None)
+
+    def test_version_changes_once_the_visit_commits(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            visit = DailySheet.objects.create(date=timezone.localdate(), charge=400, received=300)
+            self.assertEqual(cache.get(VERSION_KEY), 'before')
+        self.assertNotEqual(cache.get(VERSION_KEY), 'before')
+
+        cache.set(VERSION_KEY, 'before', None)
+        with self.captureOnCommitCallbacks(execute=True):
+            visit.delete()
+            self.assertEqual(cache.get(VERSION_KEY), 'before')
+        self.assertNotEqual(cache.get(VERSION_KEY), 'before')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CounterTests(TestCase):
+
+    def setUp(self):
+        reconcile_counters()
+
+    def test_committed_writes_move_the_counters(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(name='Test', case_number='UM1')
+            DailySheet.objects.create(date=timezone.localdate(), charge=400, received=250)
+        counts = dashboard_counters()
+        self.assertEqual((counts['patients_total'], counts['patients_today']), (1, 1))
+        self.assertEqual((counts['sheets_today'], counts['revenue_today']), (1, 250))
+
+    def test_rolled_back_writes_leave_them_alone(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Patient.objects.create(name='Test', case_number='UM1')
+                    DailySheet.objects.create(date=timezone.localdate(), charge=400, received=250)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        counts = dashboard_counters()
+        self.assertEqual((counts['patients_total'], counts['sheets_today'], counts['revenue_today']), (0, 0, 0))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ArchiveTests(TestCase):
+
+    def test_linking_visits_rewrites_their_month(self):
+        Patient.objects.create(name='Test', case_number='UM1')
+        DailySheet.objects.create(date=timezone.localdate(), case_number='UM1', charge=400, received=400)
+        manifest = {'tables': {}}
+        with tempfile.TemporaryDirectory() as directory:
+            written, unchanged, removed = snapshot_table(directory, manifest, 'daily_sheet', 'csv.gz')
+            self.assertEqual((len(written), unchanged), (1, []))
+
+            call_command('link_visits_to_patients', stdout=io.StringIO())
+            written, unchanged, removed = snapshot_table(directory, manifest, 'daily_sheet', 'csv.gz')
+            self.assertEqual((len(written), unchanged), (1, []))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PeriodLockTests(TestCase):
+    """Visits dated in a closed month cannot be created, changed, moved or deleted until it is reopened"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.closed_day = timezone.localdate().replace(day=1) - timedelta(days=1)
+        cls.patient = Patient.objects.create(name='Test', case_number='UM1')
+        cls.old_visit = DailySheet.objects.create(patient_id=cls.patient, date=cls.closed_day, charge=400, received=300)
+        cls.new_visit = DailySheet.objects.create(patient_id=cls.patient, date=timezone.localdate(), charge=400, received=400)
+        close_periods(DailySheet, cls.closed_day)
+
+    def test_closed_visits_are_locked(self):
+        self.old_visit.received = 400
+        with self.assertRaises(PeriodClosedError):
+            self.old_visit.save()
+        with self.assertRaises(PeriodClosedError):
+            self.old_visit.delete()
+        with self.assertRaises(PeriodClosedError):
+            DailySheet.objects.create(patient_id=self.patient, date=self.closed_day, charge=100, received=0)
+        self.assertEqual(DailySheet.objects.get(pk=self.old_visit.pk).received, 300)
+
+    def test_open_visit_cannot_move_into_a_closed_month(self):
+        self.new_visit.date = self.closed_day
+        with self.assertRaises(PeriodClosedError):
+            self.new_visit.save()
+
+    def test_other_series_is_not_locked(self):
+        PCList.objects.create(patient_id=self.patient, date=self.closed_day, charge=100, received=0)
+
+    def test_reopened_month_can_be_changed(self):
+        reopen_periods(DailySheet, self.closed_day)
+        self.old_visit.received = 400
+        self.old_visit.save()
+        self.old_visit.delete()
+
+    def test_deleting_a_patient_with_closed_visits_is_refused(self):
+        user = User.objects.create_superuser('admin@example.com', 'secret', first_name='Admin')
+        self.client.force_login(user)
+        response = self.client.get(reverse('patient_delete', args=[self.patient.pk]), follow=True)
+        self.assertRedirects(response, reverse('patient_list'))
+        self.assertIn('Reopen it before deleting the patient', ' '.join(str(message) for message in response.context['messages']))
+        self.assertTrue(Patient.objects.filter(pk=self.patient.pk).exists())
+        self.assertEqual(DailySheet.objects.filter(patient_id=self.patient).count(), 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StatementArchiveTests(TestCase):
+
+    def test_zip_name_is_random_and_served_only_through_the_view(self):
+        user = User.objects.create_superuser('admin@example.com', 'secret', first_name='Admin')
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            create_statement_job('UM', user)
+            job = run_statement_job(claim_statement_job())
+            self.assertEqual(job.status, 'completed')
+            self.assertRegex(job.archive.name, r'^statements/[0-9a-f]{32}\.zip$')
+
+            self.client.force_login(user)
+            response = self.client.get(reverse('statement_download', args=[job.pk]))
+            self.assertIn('filename="statements_UM_', response['Content-Disposition'])
+            response.close()
+
+
+FILTER_FORMS = {
+    DailySheet: DailySheetFilterForm,
+    PCList: PCListFilterForm,
+}
+
+# A plain "SCAN <table>" step reads every row of the table; index scans, virtual
+# tables and subquery results are reported with more words
+FULL_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?([A-Za-z_]\w*)(?: AS \w+)?$')
+
+
+def patient_scenarios(patient_ids):
+    today = timezone.localdate()
+
+    def listed(data):
+        records = filter_patients(Patient.objects.all(), PatientFilterForm(data))
+        patient_page(records)
+        records.count()
+
+    return {
+        'patient list': lambda: listed({}),
+        'patient list, next page': lambda: patient_page(
+            Patient.objects.all(), patient_cursor(timezone.now(), patient_ids[-1], 50),
+        ),
+        'patient list, registration year': lambda: listed({'year': today.year}),
+        'patient list, registration dates': lambda: listed({'date_from': today - timedelta(days=30), 'date_to': today}),
+        'patient list, case number prefix': lambda: listed({'case_number': 'UM12'}),
+        'patient list, case number range': lambda: listed({'case_number': 'UM1200-UM1300'}),
+        'patient list, exact case number': lambda: listed({'case_number': '=UM0000012'}),
+        'dashboard counters': compute_counters,
+    }
+
+
+def visit_scenarios(model, patient_ids):
+    today = timezone.localdate()
+    label = model._meta.verbose_name
+    columns = export_columns(model, VISIT_EXPORT_COLUMNS)
+
+    def listed(data, cursor=None):
+        form = FILTER_FORMS[model](data)
+        visits, _ = recent_window(filter_visit_list(model.objects.all(), form), form)
+        visit_day_page(visits, cursor)
+
+    def exported(filter_type):
+        visits = filter_by_period(model.objects.order_by('date', 'id'), {'filter_type': filter_type})
+        list(export_rows(visits, columns))
+
+    def ledger():
+        patient = Patient.objects.get(pk=patient_ids[0])
+        ledger_page(model, patient)
+        ledger_page(model, patient, ledger_cursor(today, 1))
+
+    scenarios = {
+        'list': lambda: listed({}),
+        'list, older page': lambda: listed({}, (today - timedelta(days=7)).isoformat()),
+        'list, payment status': lambda: listed({'payment_status': 'paid', 'date_from': today - timedelta(days=90)}),
+        'list, year': lambda: listed({'year': today.year}),
+        'ledger': ledger,
+        'statement ledgers': lambda: prefetch_ledgers(model, patient_ids),
+        'balance refresh': lambda: refresh_balances(model, patient_ids),
+        'pending balances': lambda: list(pending_patients(model)[:50]),
+        'monthly summary': lambda: period_summary(model, 'month'),
+        'yearly summary, range': lambda: period_summary(model, 'year', today.replace(month=1, day=1), today),
+        'payment dashboard': lambda: series_breakdown(model, dashboard_periods()),
+    }
+    for filter_type in ('week', 'month', 'year', 'custom'):
+        scenarios[f'export, {filter_type}'] = lambda filter_type=filter_type: exported(filter_type)
+    return {f'{label}: {name}': scenario for name, scenario in scenarios.items()}
+
+
+def query_plan(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        return [row[-1] for row in cursor.fetchall()]
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are only checked on SQLite')
+@override_settings(CACHES=TEST_CACHES)
+class QueryPlanTests(TestCase):
+    """Every query of the hot paths (lists, ledgers, summaries, exports, dashboard) uses an index"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # A few rows so every code path has ids to work with; the plans do not depend on them
+        cls.patient_ids = [patient.pk for patient in seed_patients(50, prefix='UM')]
+
+    def full_scans(self, scenario):
+        """(plan step, sql) of every SELECT of `scenario` that reads a whole table"""
+        tables = {model._meta.db_table for model in (Patient, DailySheet, PCList)}
+        with CaptureQueriesContext(connection) as queries:
+            scenario()
+        scans = []
+        for query in queries.captured_queries:
+            if not query['sql'].lstrip().upper().startswith('SELECT'):
+                continue
+            for step in query_plan(query['sql']):
+                match = FULL_SCAN_RE.match(step)
+                if match and match[1] in tables:
+                    scans.append((step, query['sql']))
+        return scans
+
+    def assert_indexed(self, scenarios):
+        for name, scenario in scenarios.items():
+            with self.subTest(name):
+                self.assertEqual(self.full_scans(scenario), [])
+
+    def test_patient_paths(self):
+        self.assert_indexed(patient_scenarios(self.patient_ids))
+
+    def test_visit_paths(self):
+        for model in SERIES:
+            self.assert_indexed(visit_scenarios(model, self.patient_ids))
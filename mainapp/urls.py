@@ -5,6 +5,7 @@ urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
     path('logout/', views.user_logout, name='logout'),
     path('', views.user_login, name='user_login'),
+    path('search/', views.search, name='search'),
 
     
     path('patient/', views.patient_list, name='patient_list'),
@@ -22,6 +23,11 @@ urlpatterns = [
     path('dailysheet/<int:pk>/delete/', views.daily_sheet_delete, name='daily_sheet_delete'),
     path('dailysheet/export/', views.daily_sheet_export, name='daily_sheet_export'),
     path('dailysheet/import/', views.daily_sheet_import, name='daily_sheet_import'),
+    path('import/<int:pk>/', views.import_job, name='import_job'),
+    path('import/<int:pk>/progress/', views.import_job_progress, name='import_job_progress'),
+    path('import/<int:pk>/cancel/', views.import_job_cancel, name='import_job_cancel'),
+    path('import/<int:pk>/resume/', views.import_job_resume, name='import_job_resume'),
+    path('import/report/<str:name>/', views.import_report, name='import_report'),
 
 
     path('pclist/', views.pc_list_list, name='pc_list_list'),
@@ -35,6 +41,7 @@ urlpatterns = [
 
 
     path("payment_dashboard/", views.payment_dashboard, name="payment_dashboard"),
+    path("payment_dashboard/data/", views.payment_dashboard_data, name="payment_dashboard_data"),
     path("pending/", views.pending_list, name="pending_list"),
     path("advance/", views.advance_list, name="advance_list"),
     path("ledger/<int:patient_id>/", views.patient_ledger_view, name="patient_ledger"),
@@ -50,6 +57,12 @@ urlpatterns = [
     path("pc/monthly/", views.pc_monthly_summary, name="pc_monthly_summary"),
     path("pc/yearly/", views.pc_yearly_summary, name="pc_yearly_summary"),
 
+    path("statements/<str:series>/new/", views.statement_job_create, name="statement_job_create"),
+    path("statements/<int:pk>/", views.statement_job, name="statement_job"),
+    path("statements/<int:pk>/progress/", views.statement_job_progress, name="statement_job_progress"),
+    path("statements/<int:pk>/cancel/", views.statement_job_cancel, name="statement_job_cancel"),
+    path("statements/<int:pk>/download/", views.statement_download, name="statement_download"),
+
     
 
 ]
\ No newline at end of file
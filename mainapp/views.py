@@ -6,7 +6,7 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from user_management.models import User
 from django.shortcuts import get_object_or_404
-from user_management.decorators import check_permission
+from user_management.decorators import check_permission, has_permission
 
 def user_login(request):
     if request.method == 'POST':
@@ -32,17 +32,37 @@ def user_login(request):
     }
     return render(request, 'Auth/login.html', context)
 
-from django.utils.timezone import now
+from .case_numbers import has_case_series
+from .counters import dashboard_counters, day_start
+from .listing import patient_page, recent_window, visit_day_page
+from .search import case_number_filter, global_search, search_filter
 
 def dashboard(request):
-    records = Patient.objects.all()
-    today = now().date()
- 
-    sheets_today = DailySheet.objects.filter(date=today)
-    pc_lists_today = PCList.objects.filter(date=today)
+    counts = dashboard_counters()
+
+    return render(request, 'dashboard.html', {
+        'dashboard': 'active',
+        'total_count': counts['patients_total'],
+        'sheets_count': counts['sheets_today'],
+        'pc_lists_count': counts['pc_lists_today'],
+        'new_patients_count': counts['patients_today'],
+        'in_progress_count': counts['in_progress_today'],
+        'revenue_today': counts['revenue_today'],
+    })
 
 
-    return render(request, 'dashboard.html',{'dashboard':'active','total_count': records.count(), 'sheets_count': sheets_today.count(), 'pc_lists_count': pc_lists_today.count()})
+@login_required(login_url='/')
+def search(request):
+    """Global search box: patients, daily sheets and PC lists matching ?q="""
+    query = request.GET.get('q', '').strip()
+    results = global_search(query) if query else {}
+    return render(request, 'search.html', {
+        'query': query,
+        'patients': results.get(Patient, []),
+        'sheets': results.get(DailySheet, []),
+        'pc_lists': results.get(PCList, []),
+        'screen_name': 'Search',
+    })
 
 
 def user_logout(request):
@@ -63,7 +83,7 @@ def patient_create(request):
             if form.is_valid():
                 # Additional case number validation
                 case_number = form.cleaned_data.get('case_number')
-                if case_number and not (case_number.startswith('UM') or case_number.startswith('PC')):
+                if case_number and not has_case_series(case_number):
                     form.add_error('case_number', "Case number must start with 'UM' or 'PC'.")
                 else:
                     form.save()
@@ -80,50 +100,65 @@ def patient_create(request):
     except Exception as error:
         return render(request, '500.html', {'error': error})
 
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+
+def filter_patients(records, filter_form):
+    """Apply a PatientFilterForm to a Patient queryset"""
+    if not filter_form.is_valid():
+        return records
+
+    case_number = filter_form.cleaned_data.get('case_number')
+    if case_number:
+        records = case_number_filter(records, case_number)
+
+    name = filter_form.cleaned_data.get('name')
+    if name:
+        records = search_filter(records, name, 'name')
+
+    gender = filter_form.cleaned_data.get('gender')
+    if gender:
+        records = records.filter(gender=gender)
+
+    year = filter_form.cleaned_data.get('year')
+    if year:
+        records = records.filter(created_at__year=year)
+
+    date_from = filter_form.cleaned_data.get('date_from')
+    date_to = filter_form.cleaned_data.get('date_to')
+    if date_from:
+        records = records.filter(created_at__gte=day_start(date_from))
+    if date_to:
+        records = records.filter(created_at__lt=day_start(date_to + timedelta(days=1)))
+
+    return records
+
+
 @login_required(login_url='/')
 @check_permission('patient_view')
 def patient_list(request):
     """
     Displays a filtered list of Patient records with optional filtering
     - Supports filtering by case number, name, gender, year, and date range
-    - Scrollable table (no pagination)
+    - Newest first, paged with a keyset cursor (?after=...)
     """
     records = Patient.objects.all()
     
     # Initialize filter form with GET parameters
     filter_form = PatientFilterForm(request.GET or None)
-    
-    if filter_form.is_valid():
-        case_number = filter_form.cleaned_data.get('case_number')
-        if case_number:
-            records = records.filter(case_number__icontains=case_number)
-        
-        name = filter_form.cleaned_data.get('name')
-        if name:
-            records = records.filter(name__icontains=name)
-        
-        gender = filter_form.cleaned_data.get('gender')
-        if gender:
-            records = records.filter(gender=gender)
-        
-        year = filter_form.cleaned_data.get('year')
-        if year:
-            records = records.filter(created_at__year=year)
-        
-        date_from = filter_form.cleaned_data.get('date_from')
-        date_to = filter_form.cleaned_data.get('date_to')
-        if date_from:
-            records = records.filter(created_at__date__gte=date_from)
-        if date_to:
-            records = records.filter(created_at__date__lte=date_to)
+    records = filter_patients(records, filter_form)
+    filtered = filter_form.is_valid() and any(filter_form.cleaned_data.values())
+    page = patient_page(records, request.GET.get('after'), filtered)
+
+    # Filters are carried over to the First/Next links
+    params = request.GET.copy()
+    params.pop('after', None)
     
     context = {
-        'records': records,       # Full queryset
-        'patients': records,      # Alias if needed
+        'records': page['patients'],
+        'page': page,
         'filter_form': filter_form,
+        'filter_query': params.urlencode(),
         'screen_name': 'Patient',
-        'total_count': records.count()
+        'total_count': page['total'],
     }
     
     return render(request, 'patient_list.html', context)
@@ -164,65 +199,37 @@ def patient_delete(request, pk):
     """
     try:
         patient = get_object_or_404(Patient, pk=pk)
+        # The patient's visits are deleted with them
+        check_patient_open(patient)
         patient.delete()
         return redirect('patient_list')
+    except PeriodClosedError as error:
+        messages.error(request, error.messages[0])
+        return redirect('patient_list')
     except Exception as error:
         return render(request, '500.html', {'error': error})
-import pandas as pd
-from django.http import HttpResponse
-from io import BytesIO
+import os
+from .exports import patient_export
+from .importers import report_path, report_preview
+from .jobs import INLINE_IMPORT_BYTES, cancel_job, claim_job, create_import_job, resume_job, run_import_job
+from .models import ImportJob
 
 
+@check_permission('patient_create')
 def upload_excel(request):
     if request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
-            file = request.FILES['file']
-            df = pd.read_excel(file)
-
-            # Normalize headers
-            df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
-
-            for _, row in df.iterrows():
-                Patient.objects.update_or_create(
-                    case_number=row.get('case_number'),
-                    defaults={
-                        'name': row.get('name'),
-                        'age': row.get('age'),
-                        'gender': row.get('gender'),
-                        'chief_complaint': row.get('chief_complaint'),
-                        'reference': row.get('reference'),
-                        'contact': row.get('contact_number') or row.get('contact'),
-                        'address': row.get('address')
-                    }
-                )
-            return redirect('patient_list')
+            return start_import(request, 'patients', request.FILES['file'])
     else:
         form = UploadFileForm()
     return render(request, 'upload_excel.html', {'form': form})
 
 
 def download_excel(request):
-    patients = Patient.objects.all()
-    data = {
-        'Name': [p.name for p in patients],
-        'Case Number': [p.case_number for p in patients],
-        'Age': [p.age for p in patients],
-        'Gender': [p.get_gender_display() for p in patients],
-        'Chief Complaint': [p.chief_complaint for p in patients],
-        'Reference': [p.reference for p in patients],
-        'Contact': [p.contact for p in patients],
-        'Address': [p.address for p in patients],
-    }
-    
-    df = pd.DataFrame(data)
-    output = BytesIO()
-    df.to_excel(output, index=False)
-    output.seek(0)
-    
-    response = HttpResponse(output, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response['Content-Disposition'] = 'attachment; filename=patients.xlsx'
-    return response
+    """Export the patient list with its current filters as Excel, or as streamed CSV with ?format=csv"""
+    records = filter_patients(Patient.objects.all(), PatientFilterForm(request.GET or None))
+    return patient_export(request, records, request.GET.get('format', 'xlsx'))
 
 
 from datetime import datetime
@@ -233,48 +240,64 @@ from .models import DailySheet
 from .forms import DailySheetFilterForm
 
 
-@login_required(login_url='/')
-def daily_sheet_list(request):
-    sheets = DailySheet.objects.all().order_by('-date')
+def filter_visit_list(visits, filter_form):
+    """Apply a DailySheetFilterForm / PCListFilterForm to a visit queryset"""
+    if not filter_form.is_valid():
+        return visits
 
-    filter_form = DailySheetFilterForm(request.GET or None)
+    case_number = filter_form.cleaned_data.get('case_number')
+    if case_number:
+        visits = case_number_filter(visits, case_number)
+
+    name = filter_form.cleaned_data.get('name')
+    if name:
+        visits = search_filter(visits, name, 'name')
+
+    payment_status = filter_form.cleaned_data.get('payment_status')
+    if payment_status:
+        visits = visits.filter(payment_status=payment_status)
+
+    year = filter_form.cleaned_data.get('year')
+    if year:
+        visits = visits.filter(created_at__year=year)
+
+    date_from = filter_form.cleaned_data.get('date_from')
+    if date_from:
+        visits = visits.filter(date__gte=date_from)
 
-    if filter_form.is_valid():
-        case_number = filter_form.cleaned_data.get('case_number')
-        if case_number:
-            sheets = sheets.filter(case_number__icontains=case_number)
+    date_to = filter_form.cleaned_data.get('date_to')
+    if date_to:
+        visits = visits.filter(date__lte=date_to)
 
-        name = filter_form.cleaned_data.get('name')
-        if name:
-            sheets = sheets.filter(name__icontains=name)
+    return visits
 
-        payment_status = filter_form.cleaned_data.get('payment_status')
-        if payment_status:
-            sheets = sheets.filter(payment_status=payment_status)
 
-        year = filter_form.cleaned_data.get('year')
-        if year:
-            sheets = sheets.filter(created_at__year=year)
+@login_required(login_url='/')
+def daily_sheet_list(request):
+    """Visits grouped by day, a page of whole days at a time (?after=<last day shown>)"""
+    sheets = DailySheet.objects.all()
 
-        date_from = filter_form.cleaned_data.get('date_from')
-        if date_from:
-            sheets = sheets.filter(date__gte=date_from)
+    filter_form = DailySheetFilterForm(request.GET or None)
+    sheets = filter_visit_list(sheets, filter_form)
+    sheets, window_start = recent_window(sheets, filter_form)
+    page = visit_day_page(sheets, request.GET.get('after'))
 
-        date_to = filter_form.cleaned_data.get('date_to')
-        if date_to:
-            sheets = sheets.filter(date__lte=date_to)
+    params = request.GET.copy()
+    params.pop('after', None)
 
     context = {
-        'sheets': sheets,
+        'page': page,
         'filter_form': filter_form,
-        'total_count': sheets.count(),
+        'filter_query': params.urlencode(),
+        'window_start': window_start,
+        'total_count': page['totals']['visits'],
         'screen_name': 'Daily Sheet'
     }
     return render(request, 'daily_sheet_list.html', context)
 
 
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, JsonResponse
 from django.utils import timezone
 from django.contrib import messages
 from .models import DailySheet, Patient
@@ -325,8 +348,7 @@ def check_case_number(request):
     try:
         patient = Patient.objects.get(case_number=case_number)
         
-        # Check if case number starts with "UM"
-        if not case_number.startswith('UM'):
+        if patient.case_series != 'UM':
             return JsonResponse({
                 'exists': False,
                 'error': 'Case number must start with "UM" for daily sheets. Please use the UM series.'
@@ -376,236 +398,156 @@ def daily_sheet_delete(request, pk):
     sheet = get_object_or_404(DailySheet, pk=pk)
     
     if request.method == 'POST':
-        sheet.delete()
+        try:
+            sheet.delete()
+        except PeriodClosedError as error:
+            messages.error(request, error.messages[0])
+            return redirect('daily_sheet_list')
         messages.success(request, 'Daily sheet entry deleted successfully!')
         return redirect('daily_sheet_list')
     
     return render(request, 'daily_sheet_confirm_delete.html', {'sheet': sheet})
-import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment
 from datetime import datetime, timedelta
 
-from django.http import HttpResponse
 from django.utils import timezone
 from datetime import timedelta
-import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment, numbers
+from .exports import filter_by_period, visit_export
 
 from .models import DailySheet
 
 
 def daily_sheet_export(request):
-    """Export daily sheets to Excel (Safe, IST-based, Production-ready)"""
-
-    # Base queryset
-    sheets = DailySheet.objects.all()
+    """Export daily sheets to Excel, streamed row by row through a spooled temp file"""
+    sheets = filter_by_period(DailySheet.objects.all(), request.GET)
+    return visit_export(request, sheets, 'Daily Sheets', 'daily_sheets', request.GET.get('format', 'xlsx'))
 
-    # Filters
-    filter_type = request.GET.get('filter_type', 'all')
-    custom_start = request.GET.get('custom_start')
-    custom_end = request.GET.get('custom_end')
-
-    today = timezone.localdate()
-
-    if filter_type == 'week':
-        start_date = today - timedelta(days=today.weekday())
-        end_date = start_date + timedelta(days=6)
-        sheets = sheets.filter(date__range=[start_date, end_date])
-
-    elif filter_type == 'month':
-        sheets = sheets.filter(date__year=today.year, date__month=today.month)
-
-    elif filter_type == 'year':
-        sheets = sheets.filter(date__year=today.year)
-
-    elif filter_type == 'custom' and custom_start and custom_end:
-        sheets = sheets.filter(date__range=[custom_start, custom_end])
-
-    # Create workbook
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = 'Daily Sheets'
-
-    # Headers
-    headers = [
-        'Date', 'Name', 'Case Number', 'Diagnosis',
-        'Charge', 'Received', 'Payment Status',
-        'Payment Type', 'Payment Frequency',
-        'In Time', 'Out Time',
-        'Treatment 1', 'Treatment 2', 'Treatment 3', 'Treatment 4',
-        'Therapist 1', 'Therapist 2'
-    ]
-
-    header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-    header_font = Font(bold=True, color='FFFFFF')
-
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_num)
-        cell.value = header
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    # Data rows
-    for row_num, sheet in enumerate(sheets, start=2):
-
-        # Date (safe)
-        date_cell = ws.cell(row=row_num, column=1)
-        date_cell.value = sheet.date if sheet.date else ''
-        date_cell.number_format = numbers.FORMAT_DATE_YYYYMMDD2
-
-        ws.cell(row=row_num, column=2).value = sheet.name or ''
-        ws.cell(row=row_num, column=3).value = sheet.case_number or ''
-        ws.cell(row=row_num, column=4).value = sheet.diagnosis or ''
-
-        ws.cell(row=row_num, column=5).value = float(sheet.charge) if sheet.charge else 0
-        ws.cell(row=row_num, column=6).value = float(sheet.received) if sheet.received else 0
-
-        ws.cell(row=row_num, column=7).value = sheet.get_payment_status_display() if sheet.payment_status else ''
-        ws.cell(row=row_num, column=8).value = sheet.get_payment_type_display() if sheet.payment_type else ''
-        ws.cell(row=row_num, column=9).value = sheet.get_payment_frequency_display() if sheet.payment_frequency else ''
-
-        ws.cell(row=row_num, column=10).value = sheet.in_time.strftime('%H:%M') if sheet.in_time else ''
-        ws.cell(row=row_num, column=11).value = sheet.out_time.strftime('%H:%M') if sheet.out_time else ''
-
-        ws.cell(row=row_num, column=12).value = sheet.treatment_1 or ''
-        ws.cell(row=row_num, column=13).value = sheet.treatment_2 or ''
-        ws.cell(row=row_num, column=14).value = sheet.treatment_3 or ''
-        ws.cell(row=row_num, column=15).value = sheet.treatment_4 or ''
-
-        ws.cell(row=row_num, column=16).value = sheet.get_therapist_1_display() if sheet.therapist_1 else ''
-        ws.cell(row=row_num, column=17).value = sheet.get_therapist_2_display() if sheet.therapist_2 else ''
-
-    # Auto column width
-    for col in ws.columns:
-        max_length = 0
-        col_letter = col[0].column_letter
-        for cell in col:
-            if cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        ws.column_dimensions[col_letter].width = min(max_length + 2, 50)
-
-    # Response
-    response = HttpResponse(
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
-
-    filename = f"daily_sheets_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-
-    wb.save(response)
-    return response
-
-def daily_sheet_import(request):
-    """Import daily sheets from Excel"""
+def visit_import(request, kind, template_name):
+    """Shared upload handler for the DailySheet and PCList importers"""
     if request.method == 'POST':
         form = ExcelUploadForm(request.POST, request.FILES)
         if form.is_valid():
-            excel_file = request.FILES['excel_file']
-            
-            try:
-                # Read Excel file
-                df = pd.read_excel(excel_file)
-                
-                # Map payment status
-                payment_status_map = {
-                    'Paid': 'paid',
-                    'Partially Paid': 'partially_paid',
-                    'Not Paid': 'not_paid'
-                }
-                
-                payment_type_map = {
-                    'QR': 'qr',
-                    'Cash': 'cash'
-                }
-                
-                payment_frequency_map = {
-                    'Daily Basis': 'daily',
-                    'Weekly Basis': 'weekly',
-                    'Monthly Basis': 'monthly'
-                }
-                
-                therapist_map = {
-                    'Dr. Basidh': 'dr_basidh',
-                    'Dr. Visitra': 'dr_visitra',
-                    'Dr. Bharatiselvi': 'dr_bharatiselvi'
-                }
-                
-                imported_count = 0
-                
-                for index, row in df.iterrows():
-                    try:
-                        sheet = DailySheet(
-                            date=pd.to_datetime(row['Date'], dayfirst=True).date(),
-                            name=row['Name'],
-                            case_number=str(row['Case Number']),
-                            diagnosis=row['Diagnosis'],
-                            charge=float(row['Charge']),
-                            received=float(row['Received']),
-                            payment_status=payment_status_map.get(row['Payment Status'], 'not_paid'),
-                            payment_type=payment_type_map.get(row['Payment Type'], 'cash'),
-                            payment_frequency=payment_frequency_map.get(row['Payment Frequency'], 'daily'),
-                            in_time=pd.to_datetime(row['In Time']).time() if pd.notna(row['In Time']) else None,
-                            out_time=pd.to_datetime(row['Out Time']).time() if pd.notna(row['Out Time']) else None,
-                            treatment_1=row.get('Treatment 1', ''),
-                            treatment_2=row.get('Treatment 2', ''),
-                            treatment_3=row.get('Treatment 3', ''),
-                            treatment_4=row.get('Treatment 4', ''),
-                            therapist_1=therapist_map.get(row['Therapist 1'], 'dr_basidh'),
-                            therapist_2=therapist_map.get(row.get('Therapist 2', ''), None) if pd.notna(row.get('Therapist 2')) else None
-                        )
-                        sheet.save()
-                        imported_count += 1
-                    except Exception as e:
-                        messages.warning(request, f'Error importing row {index + 2}: {str(e)}')
-                        continue
-                
-                messages.success(request, f'Successfully imported {imported_count} records!')
-                return redirect('daily_sheet_list')
-                
-            except Exception as e:
-                messages.error(request, f'Error reading Excel file: {str(e)}')
+            return start_import(request, kind, request.FILES['excel_file'], form.cleaned_data['all_sheets'])
     else:
         form = ExcelUploadForm()
-    
-    return render(request, 'daily_sheet_import.html', {'form': form})
 
+    return render(request, template_name, {'form': form})
+
+@check_permission('dailysheet_create')
+def daily_sheet_import(request):
+    """Import daily sheets from Excel"""
+    return visit_import(request, 'daily_sheet', 'daily_sheet_import.html')
+
+IMPORT_LIST_URLS = {
+    'patients': 'patient_list',
+    'daily_sheet': 'daily_sheet_list',
+    'pc_list': 'pc_list_list',
+}
+
+# Permission needed to follow, cancel or resume an import of each kind
+IMPORT_PERMISSIONS = {
+    'patients': 'patient_create',
+    'daily_sheet': 'dailysheet_create',
+    'pc_list': 'pclist_create',
+}
+
+def permitted_import(request, job):
+    """The job, or a 404 for users who may not import its kind"""
+    if job is None or not has_permission(request.user, IMPORT_PERMISSIONS[job.kind]):
+        raise Http404('Import not found')
+    return job
+
+def start_import(request, kind, upload, all_sheets=False):
+    """Queue an uploaded sheet as an ImportJob; small single-sheet files are imported right away"""
+    job = create_import_job(kind, upload, request.user if request.user.is_authenticated else None, all_sheets)
+    if not job.all_sheets and upload.size <= INLINE_IMPORT_BYTES and claim_job(job.pk):
+        job = run_import_job(ImportJob.objects.get(pk=job.pk))
+        if job.status == 'completed' and not job.error_count:
+            if kind == 'patients':
+                messages.success(request, f'Imported {job.imported} new and updated {job.updated} existing patients.')
+            else:
+                messages.success(request, f'Successfully imported {job.imported} records!')
+            return redirect(IMPORT_LIST_URLS[kind])
+    else:
+        messages.info(request, 'The file has been queued for import. This page updates as it progresses.')
+    return redirect('import_job', pk=job.pk)
 
 @login_required(login_url='/')
-def pc_list_list(request):
-    pc_lists = PCList.objects.all().order_by('-date')
+def import_job(request, pk):
+    """Progress and outcome of one import"""
+    job = permitted_import(request, get_object_or_404(ImportJob, pk=pk))
+    return render(request, 'import_job.html', {
+        'job': job,
+        'errors': report_preview(job.report_name) if job.is_finished else [],
+        'list_url': IMPORT_LIST_URLS[job.kind],
+    })
 
-    filter_form = PCListFilterForm(request.GET or None)
+@login_required(login_url='/')
+def import_job_progress(request, pk):
+    """JSON progress of an import, polled by the job page"""
+    job = permitted_import(request, get_object_or_404(ImportJob, pk=pk))
+    return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'finished': job.is_finished,
+        'cancel_requested': job.cancel_requested,
+        'total_rows': job.total_rows,
+        'rows_processed': job.rows_processed,
+        'percent': job.percent,
+        'imported': job.imported,
+        'updated': job.updated,
+        'error_count': job.error_count,
+        'message': job.message,
+    })
+
+@login_required(login_url='/')
+def import_job_cancel(request, pk):
+    job = permitted_import(request, get_object_or_404(ImportJob, pk=pk))
+    if request.method == 'POST':
+        if cancel_job(job):
+            messages.success(request, 'The import will stop after the rows it is working on.')
+        else:
+            messages.error(request, 'This import has already finished.')
+    return redirect('import_job', pk=pk)
 
-    if filter_form.is_valid():
-        case_number = filter_form.cleaned_data.get('case_number')
-        if case_number:
-            pc_lists = pc_lists.filter(case_number__icontains=case_number)
+@login_required(login_url='/')
+def import_job_resume(request, pk):
+    job = permitted_import(request, get_object_or_404(ImportJob, pk=pk))
+    if request.method == 'POST':
+        if resume_job(job):
+            messages.success(request, f'The import will continue from row {job.next_row}.')
+        else:
+            messages.error(request, 'Only failed or cancelled imports whose upload is still kept can be resumed.')
+    return redirect('import_job', pk=pk)
 
-        name = filter_form.cleaned_data.get('name')
-        if name:
-            pc_lists = pc_lists.filter(name__icontains=name)
+@login_required(login_url='/')
+def import_report(request, name):
+    """Download the CSV of rows an import skipped"""
+    permitted_import(request, ImportJob.objects.filter(report_name=name).first())
+    path = report_path(name)
+    if not os.path.exists(path):
+        raise Http404('Report not found')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'import_errors_{name}', content_type='text/csv')
 
-        payment_status = filter_form.cleaned_data.get('payment_status')
-        if payment_status:
-            pc_lists = pc_lists.filter(payment_status=payment_status)
 
-        year = filter_form.cleaned_data.get('year')
-        if year:
-            pc_lists = pc_lists.filter(created_at__year=year)
+@login_required(login_url='/')
+def pc_list_list(request):
+    """Visits grouped by day, a page of whole days at a time (?after=<last day shown>)"""
+    pc_lists = PCList.objects.all()
 
-        date_from = filter_form.cleaned_data.get('date_from')
-        if date_from:
-            pc_lists = pc_lists.filter(date__gte=date_from)
+    filter_form = PCListFilterForm(request.GET or None)
+    pc_lists = filter_visit_list(pc_lists, filter_form)
+    pc_lists, window_start = recent_window(pc_lists, filter_form)
+    page = visit_day_page(pc_lists, request.GET.get('after'))
 
-        date_to = filter_form.cleaned_data.get('date_to')
-        if date_to:
-            pc_lists = pc_lists.filter(date__lte=date_to)
+    params = request.GET.copy()
+    params.pop('after', None)
 
     context = {
-        'pc_lists': pc_lists,
+        'page': page,
         'filter_form': filter_form,
-        'total_count': pc_lists.count(),
+        'filter_query': params.urlencode(),
+        'window_start': window_start,
+        'total_count': page['totals']['visits'],
         'screen_name': 'PC List'
     }
     return render(request, 'pc_list_list.html', context)
@@ -643,8 +585,7 @@ def check_pc_number(request):
     try:
         patient = Patient.objects.get(case_number=case_number)
         
-        # Check if case number starts with "PC"
-        if not case_number.startswith('PC'):
+        if patient.case_series != 'PC':
             return JsonResponse({
                 'exists': False,
                 'error': 'Case number must start with "PC" for PC lists. Please use the PC series.'
@@ -694,327 +635,207 @@ def pc_list_delete(request, pk):
     pc_list = get_object_or_404(PCList, pk=pk)
     
     if request.method == 'POST':
-        pc_list.delete()
+        try:
+            pc_list.delete()
+        except PeriodClosedError as error:
+            messages.error(request, error.messages[0])
+            return redirect('pc_list_list')
         messages.success(request, 'PC List entry deleted successfully!')
         return redirect('pc_list_list')
     
     return render(request, 'pc_list_confirm_delete.html', {'pc_list': pc_list})
 
 def pc_list_export(request):
-    """Export PC Lists to Excel"""
-    # Same logic as daily_sheet_export but using PCList model
-    pc_lists = PCList.objects.all()
-    
-    # [Filtering logic identical to daily_sheet_export]
-    
-    # Create workbook
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = 'PC Lists'
-    
-    # [Headers and data rows logic identical to daily_sheet_export]
-    
-    # Response
-    response = HttpResponse(
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
-    
-    filename = f"pc_lists_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    
-    wb.save(response)
-    return response
+    """Export PC Lists to Excel, or to CSV with ?format=csv for long ranges
+
+    Takes the same period filter as daily_sheet_export plus the PC list's own filters.
+    """
+    pc_lists = filter_by_period(PCList.objects.order_by('date', 'id'), request.GET)
+    pc_lists = filter_visit_list(pc_lists, PCListFilterForm(request.GET or None))
+    return visit_export(request, pc_lists, 'PC Lists', 'pc_lists', request.GET.get('format', 'xlsx'))
 
+@check_permission('pclist_create')
 def pc_list_import(request):
     """Import PC Lists from Excel"""
-    if request.method == 'POST':
-        form = ExcelUploadForm(request.POST, request.FILES)
-        if form.is_valid():
-            excel_file = request.FILES['excel_file']
-            
-            try:
-                # Read Excel file
-                df = pd.read_excel(excel_file)
-                
-                # [Mapping logic identical to daily_sheet_import]
-                
-                imported_count = 0
-                
-                for index, row in df.iterrows():
-                    try:
-                        pc_list = PCList(
-                            date=pd.to_datetime(row['Date'], dayfirst=True).date(),
-                            name=row['Name'],
-                            case_number=str(row['Case Number']),
-                            diagnosis=row['Diagnosis'],
-                            charge=float(row['Charge']),
-                            received=float(row['Received']),
-                            payment_status=payment_status_map.get(row['Payment Status'], 'not_paid'),
-                            payment_type=payment_type_map.get(row['Payment Type'], 'cash'),
-                            payment_frequency=payment_frequency_map.get(row['Payment Frequency'], 'daily'),
-                            in_time=pd.to_datetime(row['In Time']).time() if pd.notna(row['In Time']) else None,
-                            out_time=pd.to_datetime(row['Out Time']).time() if pd.notna(row['Out Time']) else None,
-                            treatment_1=row.get('Treatment 1', ''),
-                            treatment_2=row.get('Treatment 2', ''),
-                            treatment_3=row.get('Treatment 3', ''),
-                            treatment_4=row.get('Treatment 4', ''),
-                            therapist_1=therapist_map.get(row['Therapist 1'], 'Basidh'),
-                            therapist_2=therapist_map.get(row.get('Therapist 2', ''), None) if pd.notna(row.get('Therapist 2')) else None
-                        )
-                        pc_list.save()
-                        imported_count += 1
-                    except Exception as e:
-                        messages.warning(request, f'Error importing row {index + 2}: {str(e)}')
-                        continue
-                
-                messages.success(request, f'Successfully imported {imported_count} records!')
-                return redirect('pc_list_list')
-                
-            except Exception as e:
-                messages.error(request, f'Error reading Excel file: {str(e)}')
-    else:
-        form = ExcelUploadForm()
-    
-    return render(request, 'pc_list_import.html', {'form': form})
-
-
-from collections import defaultdict
-from django.db.models import Sum
-
-
-def patient_ledger(patient):
-    sheets = DailySheet.objects.filter(patient_id=patient).order_by("date", "id")
-    balance = 0
-    ledger = []
-
-    for s in sheets:
-        charge = s.charge or 0
-        received = s.received or 0
-        balance += received - charge
-
-        ledger.append({
-            "date": s.date,
-            "case_number": s.case_number,
-            "contact": s.patient_id.contact,
-            "charge": charge,
-            "received": received,
-            "balance": balance,
-        })
-    return ledger, balance
+    return visit_import(request, 'pc_list', 'pc_list_import.html')
+
+
+from .balances import advance_patients, paginate_balances, patient_balance, pending_patients
+from .ledger import ledger_download, ledger_page
+from .periods import PeriodClosedError, check_patient_open
+from .payments import dashboard_data
+from .reports import period_summary
+from .models import StatementJob
+from .statements import cancel_statement_job, create_statement_job, download_name
+
+DASHBOARD_PERIOD_LABELS = {
+    "today": "Today",
+    "week": "This Week",
+    "month": "This Month",
+    "custom": "Selected Range",
+}
+
+
+def payment_dashboard_context(request, series):
+    range_form = SummaryRangeForm(request.GET or None)
+    data = dashboard_data(*range_form.get_range())
+    breakdown = data["series"][series]
+    totals = breakdown["all"]
+
+    return {
+        "total_charge": totals["charge"],
+        "total_received": totals["received"],
+        "total_pending": totals["pending"],
+        "total_advance": totals["advance"],
+        "breakdown": [(DASHBOARD_PERIOD_LABELS[name], breakdown[name]) for name in data["periods"]],
+        "range_form": range_form,
+    }
 
 def payment_dashboard(request):
-    total_charge = DailySheet.objects.aggregate(t=Sum("charge"))["t"] or 0
-    total_received = DailySheet.objects.aggregate(t=Sum("received"))["t"] or 0
-
-    balance = total_received - total_charge
-
-    context = {
-        "total_charge": total_charge,
-        "total_received": total_received,
-        "total_pending": abs(balance) if balance < 0 else 0,
-        "total_advance": balance if balance > 0 else 0,
-    }
+    context = payment_dashboard_context(request, "UM")
     return render(request, "accounts/payment_dashboard.html", context)
 
-def pending_list(request):
-    data = []
+@login_required(login_url='/')
+def payment_dashboard_data(request):
+    """JSON figures for both series, for front-desk screens that poll"""
+    range_form = SummaryRangeForm(request.GET or None)
+    return JsonResponse(dashboard_data(*range_form.get_range()))
 
-    for patient in Patient.objects.all():
-        _, balance = patient_ledger(patient)
-        if balance < 0:
-            data.append({
-                "patient": patient,
-                "pending": abs(balance)
-            })
+def pending_list(request):
+    sort = request.GET.get("sort", "amount")
+    data = paginate_balances(request, pending_patients(DailySheet, sort))
 
-    return render(request, "accounts/pending_list.html", {"data": data})
+    return render(request, "accounts/pending_list.html", {"data": data, "sort": sort})
 
 def advance_list(request):
-    data = []
-
-    for patient in Patient.objects.all():
-        _, balance = patient_ledger(patient)
-        if balance > 0:
-            data.append({
-                "patient": patient,
-                "advance": balance
-            })
+    sort = request.GET.get("sort", "amount")
+    data = paginate_balances(request, advance_patients(DailySheet, sort))
 
-    return render(request, "accounts/advance_list.html", {"data": data})
+    return render(request, "accounts/advance_list.html", {"data": data, "sort": sort})
 
 
 def patient_ledger_view(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    ledger, balance = patient_ledger(patient)
+
+    download = request.GET.get("format")
+    if download in ("csv", "xlsx"):
+        return ledger_download(DailySheet, patient, download)
+
+    page = ledger_page(DailySheet, patient, request.GET.get("after"))
 
     return render(request, "accounts/patient_ledger.html", {
         "patient": patient,
-        "ledger": ledger,
-        "final_balance": balance
+        "ledger": page["entries"],
+        "page": page,
+        "final_balance": patient_balance(patient, DailySheet)
     })
 
 
 def monthly_summary(request):
-    records = DailySheet.objects.order_by("date")
-
-    summary = defaultdict(lambda: {
-        "charge": 0, "received": 0, "opening": 0, "closing": 0
-    })
-
-    balance = 0
+    range_form = SummaryRangeForm(request.GET or None)
+    start, end = range_form.get_range()
+    summary = period_summary(DailySheet, "month", start, end)
 
-    for r in records:
-        key = r.date.strftime("%Y-%m")
-        charge = r.charge or 0
-        received = r.received or 0
-
-        if summary[key]["charge"] == 0 and summary[key]["received"] == 0:
-            summary[key]["opening"] = balance
-
-        summary[key]["charge"] += charge
-        summary[key]["received"] += received
-        balance += received - charge
-        summary[key]["closing"] = balance
-
-    return render(request, "accounts/monthly_summary.html", {"summary": dict(summary)})
+    return render(request, "accounts/monthly_summary.html", {"summary": summary, "range_form": range_form})
 
 def yearly_summary(request):
-    records = DailySheet.objects.order_by("date")
-
-    summary = defaultdict(lambda: {
-        "charge": 0, "received": 0, "opening": 0, "closing": 0
-    })
+    range_form = SummaryRangeForm(request.GET or None)
+    start, end = range_form.get_range()
+    summary = period_summary(DailySheet, "year", start, end)
 
-    balance = 0
+    return render(request, "accounts/yearly_summary.html", {"summary": summary, "range_form": range_form})
 
-    for r in records:
-        key = r.date.year
-        charge = r.charge or 0
-        received = r.received or 0
+STATEMENT_LIST_URLS = {
+    'UM': 'pending_list',
+    'PC': 'pc_pending_list',
+}
 
-        if summary[key]["charge"] == 0 and summary[key]["received"] == 0:
-            summary[key]["opening"] = balance
-
-        summary[key]["charge"] += charge
-        summary[key]["received"] += received
-        balance += received - charge
-        summary[key]["closing"] = balance
-
-    return render(request, "accounts/yearly_summary.html", {"summary": dict(summary)})
+@login_required(login_url='/')
+def statement_job_create(request, series):
+    """Queue statements for every patient with an outstanding balance in one series"""
+    if series not in STATEMENT_LIST_URLS:
+        raise Http404('Unknown series')
+    if request.method != 'POST':
+        return redirect(STATEMENT_LIST_URLS[series])
+    job = create_statement_job(series, request.user)
+    messages.info(request, 'Statements have been queued. This page updates as they are written.')
+    return redirect('statement_job', pk=job.pk)
 
-from collections import defaultdict
-from django.db.models import Sum
-from django.shortcuts import render, get_object_or_404
+@login_required(login_url='/')
+def statement_job(request, pk):
+    """Progress and download of one statement run"""
+    job = get_object_or_404(StatementJob, pk=pk)
+    return render(request, 'statement_job.html', {'job': job, 'list_url': STATEMENT_LIST_URLS[job.series]})
 
-def pc_patient_ledger_calc(patient):
-    records = PCList.objects.filter(patient_id=patient).order_by("date", "id")
-    balance = 0
-    ledger = []
+@login_required(login_url='/')
+def statement_job_progress(request, pk):
+    """JSON progress of a statement run, polled by its page"""
+    job = get_object_or_404(StatementJob, pk=pk)
+    return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'finished': job.is_finished,
+        'total': job.total,
+        'done': job.done,
+        'percent': job.percent,
+        'message': job.message,
+    })
 
-    for r in records:
-        charge = r.charge or 0
-        received = r.received or 0
-        balance += received - charge
+@login_required(login_url='/')
+def statement_job_cancel(request, pk):
+    job = get_object_or_404(StatementJob, pk=pk)
+    if request.method == 'POST':
+        if cancel_statement_job(job):
+            messages.success(request, 'The statements will stop after the batch being written.')
+        else:
+            messages.error(request, 'This run has already finished.')
+    return redirect('statement_job', pk=pk)
 
-        ledger.append({
-            "date": r.date,
-            "case_number": r.case_number,
-            "charge": charge,
-            "received": received,
-            "balance": balance,
-        })
+@login_required(login_url='/')
+def statement_download(request, pk):
+    job = get_object_or_404(StatementJob, pk=pk, status='completed')
+    if not job.archive or not os.path.exists(job.archive.path):
+        raise Http404('Statements not found')
+    return FileResponse(job.archive.open('rb'), as_attachment=True, filename=download_name(job))
 
-    return ledger, balance
 def pc_payment_dashboard(request):
-    total_charge = PCList.objects.aggregate(t=Sum("charge"))["t"] or 0
-    total_received = PCList.objects.aggregate(t=Sum("received"))["t"] or 0
-
-    balance = total_received - total_charge
-
-    context = {
-        "total_charge": total_charge,
-        "total_received": total_received,
-        "total_pending": abs(balance) if balance < 0 else 0,
-        "total_advance": balance if balance > 0 else 0,
-    }
+    context = payment_dashboard_context(request, "PC")
     return render(request, "accounts/pc/payment_dashboard.html", context)
 
 def pc_pending_list(request):
-    data = []
-
-    for patient in Patient.objects.all():
-        _, balance = pc_patient_ledger_calc(patient)
-        if balance < 0:
-            data.append({
-                "patient": patient,
-                "pending": abs(balance)
-            })
+    sort = request.GET.get("sort", "amount")
+    data = paginate_balances(request, pending_patients(PCList, sort))
 
-    return render(request, "accounts/pc/pending_list.html", {"data": data})
+    return render(request, "accounts/pc/pending_list.html", {"data": data, "sort": sort})
 def pc_advance_list(request):
-    data = []
-
-    for patient in Patient.objects.all():
-        _, balance = pc_patient_ledger_calc(patient)
-        if balance > 0:
-            data.append({
-                "patient": patient,
-                "advance": balance
-            })
+    sort = request.GET.get("sort", "amount")
+    data = paginate_balances(request, advance_patients(PCList, sort))
 
-    return render(request, "accounts/pc/advance_list.html", {"data": data})
+    return render(request, "accounts/pc/advance_list.html", {"data": data, "sort": sort})
 def pc_patient_ledger(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    ledger, balance = pc_patient_ledger_calc(patient)
+
+    download = request.GET.get("format")
+    if download in ("csv", "xlsx"):
+        return ledger_download(PCList, patient, download)
+
+    page = ledger_page(PCList, patient, request.GET.get("after"))
 
     return render(request, "accounts/pc/patient_ledger.html", {
         "patient": patient,
-        "ledger": ledger,
-        "final_balance": balance
+        "ledger": page["entries"],
+        "page": page,
+        "final_balance": patient_balance(patient, PCList)
     })
 def pc_monthly_summary(request):
-    records = PCList.objects.order_by("date")
-
-    summary = defaultdict(lambda: {
-        "charge": 0, "received": 0, "opening": 0, "closing": 0
-    })
+    range_form = SummaryRangeForm(request.GET or None)
+    start, end = range_form.get_range()
+    summary = period_summary(PCList, "month", start, end)
 
-    balance = 0
-
-    for r in records:
-        key = r.date.strftime("%Y-%m")
-        charge = r.charge or 0
-        received = r.received or 0
-
-        if summary[key]["charge"] == 0 and summary[key]["received"] == 0:
-            summary[key]["opening"] = balance
-
-        summary[key]["charge"] += charge
-        summary[key]["received"] += received
-        balance += received - charge
-        summary[key]["closing"] = balance
-
-    return render(request, "accounts/pc/monthly_summary.html", {"summary": dict(summary)})
+    return render(request, "accounts/pc/monthly_summary.html", {"summary": summary, "range_form": range_form})
 def pc_yearly_summary(request):
-    records = PCList.objects.order_by("date")
-
-    summary = defaultdict(lambda: {
-        "charge": 0, "received": 0, "opening": 0, "closing": 0
-    })
-
-    balance = 0
-
-    for r in records:
-        key = r.date.year
-        charge = r.charge or 0
-        received = r.received or 0
-
-        if summary[key]["charge"] == 0 and summary[key]["received"] == 0:
-            summary[key]["opening"] = balance
-
-        summary[key]["charge"] += charge
-        summary[key]["received"] += received
-        balance += received - charge
-        summary[key]["closing"] = balance
+    range_form = SummaryRangeForm(request.GET or None)
+    start, end = range_form.get_range()
+    summary = period_summary(PCList, "year", start, end)
 
-    return render(request, "accounts/pc/yearly_summary.html", {"summary": dict(summary)})
+    return render(request, "accounts/pc/yearly_summary.html", {"summary": summary, "range_form": range_form})
@@ -2,7 +2,17 @@
 from functools import wraps
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render
+from django.http import Http404
+
+def has_permission(user, permission_codename):
+    """
+    Whether the user is a superuser or has a role granting the permission.
+
+    :param permission_codename: The function_name of the permission to check (e.g., 'patient_view').
+    """
+    if user.is_superuser:
+        return True
+    return user.roles is not None and user.roles.permissions.filter(function_name=permission_codename).exists()
 
 def check_permission(permission_codename):
     """
@@ -15,12 +25,12 @@ def check_permission(permission_codename):
         @login_required    # Ensures that the user is logged in before checking permissions
         def _wrapped_view(request, *args, **kwargs):
             # Check if the user has the required permission
-            if request.user.is_superuser or request.user.roles.permissions.filter(function_name=permission_codename):
+            if has_permission(request.user, permission_codename):
                 # If the user has the permission, call the original view
                 return view_func(request, *args, **kwargs)
             else:
-                # If the user does not have permission, raise PermissionDenied
-                return render(request,'404.html')
+                # If the user does not have permission, answer as if the page did not exist
+                raise Http404('Page not found')
 
         return _wrapped_view
 